@@ -3,45 +3,493 @@ import re
 import sys
 import json
 import glob
+import errno
+import contextlib
+import cPickle
+import hashlib
+import stat
 import shutil
 import tarfile
+import zlib
 import zipfile
+import time
+import Queue
 import platform
-from urllib2 import urlopen, URLError, HTTPError
+import threading
+import multiprocessing
+import urllib
+import BaseHTTPServer
+import SocketServer
+from urllib2 import urlopen, Request, URLError, HTTPError
+from versions import version_key
 
 
 url_prefix = "https://www.dropbox.com/s/"
 url_suffix = "?dl=1"
+index_url = "https://www.dropbox.com/s/eg1wqjr1gdrx2u6/index.json?dl=1"
+compiled_index_format = 4
+install_state_format = 1
+lockfile_format = 1
+download_chunk_size = 1024 * 1024
+cache_dir = os.environ.get("DROPBOXPM_CACHE", os.path.expanduser("~/.dropboxpm/cache"))
+cache_size = 50 * 1024 * 1024 * 1024
+# base URL of a dropboxpm server (see --serve) used instead of dropbox
+mirror_url = os.environ.get("DROPBOXPM_MIRROR", None)
+
+output_lock = threading.Lock()
+
+def log(msg):
+    # downloads may run on worker threads, keep lines from interleaving
+    with output_lock:
+        print(msg)
 
 def dropbox_download_url(url):
+    if mirror_url:
+        # mirrors serve all archives from a flat downloads directory
+        return mirror_url.rstrip("/") + "/downloads/" + os.path.basename(url)
     return url_prefix + url + url_suffix
 
-def download(url, outdir, outname=None):
+def open_download(url, partpath, resume=True):
+    # Content is first streamed to a .part file so that an interrupted
+    # transfer can be resumed using a HTTP Range request
+    # Returns the response, the offset its content starts at and the expected
+    # final size (None if unknown)
+    offset = 0
+    if resume and os.path.isfile(partpath):
+        offset = os.stat(partpath).st_size
+    
+    req = Request(url)
+    if offset > 0:
+        req.add_header("Range", "bytes=%d-" % offset)
+    
     try:
+        u = urlopen(req)
+    except HTTPError, e:
+        if e.code != 416 or offset == 0:
+            raise
+        # Range not satisfiable, partial content cannot be trusted
+        offset = 0
         u = urlopen(url)
-        print("Downloading %s" % url)
-        
+    
+    if offset > 0 and u.getcode() == 206 and u.info().getheader("Content-Range", "").startswith("bytes %d-" % offset):
+        log("Resuming %s (%d bytes already downloaded)" % (url, offset))
+    else:
+        log("Downloading %s" % url)
+        offset = 0
+    
+    expected = u.info().getheader("Content-Length")
+    if expected is not None:
+        expected = offset + int(expected)
+    
+    return (u, offset, expected)
+
+def complete_download(url, partpath, outpath, expected, digest=None, checksum=None):
+    size = os.stat(partpath).st_size
+    if expected is not None and size != expected:
+        log("Incomplete download: %d/%d bytes %s" % (size, expected, url))
+        return False
+    
+    if checksum and digest is not None and digest.hexdigest() != checksum.lower():
+        # corrupted content cannot be resumed
+        log("Checksum mismatch: %s" % url)
+        os.remove(partpath)
+        return False
+    
+    if os.path.exists(outpath):
+        os.remove(outpath)
+    os.rename(partpath, outpath)
+    
+    return True
+
+def log_download_error(url, e):
+    if isinstance(e, HTTPError):
+        log("HTTP Error: %s %s" % (e.code, url))
+    elif isinstance(e, URLError):
+        log("URL Error: %s %s" % (e.reason, url))
+    else:
+        log("Unexpected error: %s" % e)
+
+def part_digest(partpath, size, algorithm="sha256"):
+    # digest of the first size bytes of a partial download being resumed
+    h = hashlib.new(algorithm)
+    with open(partpath, "rb") as f:
+        while size > 0:
+            chunk = f.read(min(size, download_chunk_size))
+            if not chunk:
+                break
+            h.update(chunk)
+            size -= len(chunk)
+    return h
+
+def download(url, outdir, outname=None, resume=True, checksum=None):
+    # checksum is the expected sha256 hex digest of the content, computed
+    # while it is downloaded
+    try:
         if outname is None:
             outname = os.path.basename(url.split("?")[0])
         
         outpath = outdir + "/" + outname
+        partpath = outpath + ".part"
+        
+        u, offset, expected = open_download(url, partpath, resume)
+        
+        digest = None
+        if checksum:
+            digest = (part_digest(partpath, offset) if offset > 0 else hashlib.sha256())
+        
+        try:
+            with open(partpath, ("ab" if offset > 0 else "wb")) as f:
+                while True:
+                    chunk = u.read(download_chunk_size)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    if digest is not None:
+                        digest.update(chunk)
+        finally:
+            u.close()
         
-        with open(outpath, "wb") as f:
-            f.write(u.read())
+        if not complete_download(url, partpath, outpath, expected, digest, checksum):
+            if checksum and offset > 0 and not os.path.exists(partpath):
+                log("Download %s again" % url)
+                return download(url, outdir, outname, resume=False, checksum=checksum)
+            return None
         
         return outpath
     
-    except HTTPError, e:
-        print("HTTP Error: %s %s" % (e.code, url))
+    except Exception, e:
+        log_download_error(url, e)
         return None
+
+class TeeReader(object):
+    # Read only file object returning the first 'prefixsize' bytes of 'prefix'
+    # then the content of 'stream', also written to 'out'
+    # All returned data also goes to 'digest' when set
+    def __init__(self, stream, out, prefix=None, prefixsize=0, digest=None):
+        super(TeeReader, self).__init__()
+        self.stream = stream
+        self.out = out
+        self.prefix = prefix
+        self.prefixsize = (prefixsize if prefix is not None else 0)
+        self.digest = digest
     
-    except URLError, e:
-        print("URL Error: %s %s" % (e.reason, url))
-        return None
+    def read(self, size=-1):
+        if self.prefixsize > 0:
+            data = self.prefix.read(self.prefixsize if size < 0 else min(size, self.prefixsize))
+            self.prefixsize -= len(data)
+            if data:
+                if self.digest is not None:
+                    self.digest.update(data)
+                return data
+            self.prefixsize = 0
+        data = (self.stream.read() if size < 0 else self.stream.read(size))
+        if data:
+            self.out.write(data)
+            if self.digest is not None:
+                self.digest.update(data)
+        return data
+
+def download_extract(url, outdir, extractdir, rootdir=None, resume=True, checksum=None, verbose=False):
+    # Download a tar archive to outdir while it is extracted to extractdir
+    # Returns a (archive path, extracted files manifest) tuple
+    # If the transfer or the extraction fails, extracted files are removed
+    # (the partial download is kept to be resumed unless it is found corrupted,
+    # in which case it is downloaded again) and (None, None) is returned
+    outpath = outdir + "/" + os.path.basename(url.split("?")[0])
+    partpath = outpath + ".part"
+    names = []
+    offset = 0
+    
+    try:
+        u, offset, expected = open_download(url, partpath, resume)
+        
+        try:
+            with open(partpath, ("ab" if offset > 0 else "wb")) as f:
+                prefix = (open(partpath, "rb") if offset > 0 else None)
+                try:
+                    tee = TeeReader(u, f, prefix, offset, (hashlib.sha256() if checksum else None))
+                    if verbose:
+                        log("Extracting %s..." % outpath)
+                    with tarfile.open(fileobj=tee, mode="r|*") as t:
+                        t.extractall(extractdir, members=tar_members(t, names))
+                    # whatever follows the end of archive marker
+                    while tee.read(download_chunk_size):
+                        pass
+                finally:
+                    if prefix is not None:
+                        prefix.close()
+        finally:
+            u.close()
+        
+        if complete_download(url, partpath, outpath, expected, tee.digest, checksum):
+            return (outpath, names)
+    
+    except (tarfile.TarError, zlib.error), e:
+        log("Failed to extract %s (%s)." % (outpath, e))
+        if offset > 0 and os.path.exists(partpath):
+            # the data being resumed is likely corrupted
+            os.remove(partpath)
     
     except Exception, e:
-        print("Unexpected error: %s" % e)
-        return None
+        log_download_error(url, e)
+    
+    log("Rollback %s extraction" % os.path.basename(outpath))
+    remove_manifest_files(names, extractdir)
+    remove_empty_dirs(extractdir, (rootdir if rootdir else os.path.dirname(extractdir)))
+    
+    if offset > 0 and not os.path.exists(partpath):
+        log("Download %s again" % url)
+        return download_extract(url, outdir, extractdir, rootdir=rootdir, resume=False, checksum=checksum, verbose=verbose)
+    
+    return (None, None)
+
+def fetch_index(outdir, force=False, ttl=0, verbose=False):
+    indexpath = outdir + "/index.json"
+    metapath = indexpath + ".meta"
+    
+    index = None
+    meta = {}
+    
+    try:
+        with open(indexpath, "r") as f:
+            index = json.load(f)
+        with open(metapath, "r") as f:
+            meta = json.load(f)
+    except:
+        # Invalid or missing index content -> download, missing validators
+        # -> unconditional refresh
+        pass
+    
+    if index is not None and not force:
+        # With a TTL, the index is refreshed once it gets older than TTL
+        # seconds and used as is otherwise
+        age = time.time() - meta.get("fetched", 0)
+        if ttl <= 0 or age < ttl:
+            if verbose and ttl > 0:
+                print("Index refreshed %d second(s) ago, skip update." % age)
+            return index
+    
+    # A forced refresh is unconditional (i.e. to recover from a broken index
+    # served with the same validators), a TTL one is conditional
+    req = Request(index_url)
+    if index is not None and not force:
+        if meta.get("etag"):
+            req.add_header("If-None-Match", meta["etag"])
+        if meta.get("last_modified"):
+            req.add_header("If-Modified-Since", meta["last_modified"])
+    
+    try:
+        try:
+            u = urlopen(req)
+        except HTTPError, e:
+            if e.code != 304 or index is None:
+                raise
+            if verbose:
+                print("Index is up to date.")
+            u = None
+        
+        if u is not None:
+            if verbose:
+                print("Downloading %s" % index_url)
+            
+            partpath = indexpath + ".part"
+            try:
+                with open(partpath, "wb") as f:
+                    while True:
+                        chunk = u.read(download_chunk_size)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+            finally:
+                u.close()
+            
+            with open(partpath, "r") as f:
+                index = json.load(f)
+            
+            if os.path.exists(indexpath):
+                os.remove(indexpath)
+            os.rename(partpath, indexpath)
+            
+            info = u.info()
+            meta = {"etag": info.getheader("ETag"),
+                    "last_modified": info.getheader("Last-Modified")}
+        
+        meta["fetched"] = time.time()
+        with open(metapath, "w") as f:
+            json.dump(meta, f)
+    
+    except Exception, e:
+        if index is None:
+            print("Failed to retrieve index (%s)" % e)
+        else:
+            print("Failed to update index, use local copy (%s)" % e)
+    
+    return index
+
+version_spec_exp = re.compile(r"^(>=|<=|==|!=|>|<)?([^<>=!+]*)(\+)?$")
+
+def parse_version_spec(spec):
+    # Comma separated list of constraints, each one of:
+    #   <version>     exact version
+    #   <version>+    version or greater
+    #   <op><version> with op one of >=, >, <=, <, ==, !=
+    # i.e. '5.0.1.4+', '4.2.12.0+,<5', '>=1.4,<2.0'
+    # An empty spec accepts any version
+    constraints = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        m = version_spec_exp.match(item)
+        if m is None or not m.group(2) or (m.group(1) and m.group(3)):
+            raise ValueError("Invalid version specification '%s'" % spec)
+        if m.group(3):
+            op = ">="
+        else:
+            op = m.group(1) or "=="
+        constraints.append((op, version_key(m.group(2))))
+    return constraints
+
+def version_matches(version, constraints):
+    key = version_key(version)
+    for op, ref in constraints:
+        if op == "==":
+            rv = (key == ref)
+        elif op == "!=":
+            rv = (key != ref)
+        elif op == ">=":
+            rv = (key >= ref)
+        elif op == ">":
+            rv = (key > ref)
+        elif op == "<=":
+            rv = (key <= ref)
+        else:
+            rv = (key < ref)
+        if not rv:
+            return False
+    return True
+
+def compile_index(index):
+    # lookup tables used to resolve package requests:
+    #   trie        name prefix tree, the end of a name is marked by a "" key
+    #   packages    {name: [(version, keys), ...]} latest first, keys being
+    #   environments  the version entries ("common" or platform) providing
+    #               a package/environment
+    #   dependencies  {name: {version: {key: {depname: depver}}}}
+    #               common dependencies merged with platform ones
+    # only the keys found in the index are stored, platform filtering is done
+    # on lookup so the tables do not depend on the host compiling them
+    trie = {}
+    packages = {}
+    environments = {}
+    dependencies = {}
+    
+    for name, info in index.iteritems():
+        node = trie
+        for c in name:
+            node = node.setdefault(c, {})
+        node[""] = name
+        
+        pkgvers = []
+        envvers = []
+        deps = {}
+        
+        for version, verinfo in info.get("versions", {}).iteritems():
+            cmndeps = verinfo.get("common", {}).get("dependencies", {})
+            deps[version] = {"common": cmndeps}
+            
+            pkgkeys = []
+            envkeys = []
+            for key, keyinfo in verinfo.iteritems():
+                if keyinfo.get("package", None) is not None:
+                    pkgkeys.append(key)
+                if keyinfo.get("environment", None) is not None:
+                    envkeys.append(key)
+                if key != "common":
+                    platdeps = cmndeps.copy()
+                    platdeps.update(keyinfo.get("dependencies", {}))
+                    deps[version][key] = platdeps
+            if pkgkeys:
+                pkgvers.append((version, tuple(pkgkeys)))
+            if envkeys:
+                envvers.append((version, tuple(envkeys)))
+        
+        for vers in (pkgvers, envvers):
+            vers.sort(key=lambda x: version_key(x[0]), reverse=True)
+        
+        packages[name] = pkgvers
+        environments[name] = envvers
+        dependencies[name] = deps
+    
+    return {"trie": trie,
+            "packages": packages,
+            "environments": environments,
+            "dependencies": dependencies}
+
+compiled_indices = {}
+
+def get_compiled_index(index):
+    # compiled tables are memoized per index object
+    entry = compiled_indices.get(id(index), None)
+    if entry is None or entry[0] is not index:
+        entry = (index, compile_index(index))
+        compiled_indices[id(index)] = entry
+    return entry[1]
+
+def load_compiled_index(index, indexpath, verbose=False):
+    # compiled tables are cached on disk next to the index, keyed by the
+    # index size and modification time (the index is always replaced by a
+    # rename, never rewritten in place)
+    cachepath = indexpath + ".compiled"
+    
+    st = os.stat(indexpath)
+    key = (st.st_size, st.st_mtime)
+    
+    compiled = None
+    try:
+        with open(cachepath, "rb") as f:
+            data = cPickle.load(f)
+        if data.get("format") == compiled_index_format and data.get("key") == key:
+            compiled = data["compiled"]
+    except:
+        pass
+    
+    if compiled is None:
+        if verbose:
+            print("Compile index...")
+        compiled = compile_index(index)
+        try:
+            tmppath = "%s.%d.tmp" % (cachepath, os.getpid())
+            with open(tmppath, "wb") as f:
+                cPickle.dump({"format": compiled_index_format, "key": key, "compiled": compiled}, f, cPickle.HIGHEST_PROTOCOL)
+            if os.path.exists(cachepath):
+                os.remove(cachepath)
+            os.rename(tmppath, cachepath)
+        except Exception, e:
+            print("Failed to write compiled index (%s)" % e)
+    
+    compiled_indices[id(index)] = (index, compiled)
+    
+    return compiled
+
+def match_index_name(compiled, package):
+    # longest index name package starts with
+    node = compiled["trie"]
+    name = node.get("", None)
+    for c in package:
+        node = node.get(c, None)
+        if node is None:
+            break
+        name = node.get("", name)
+    return name
+
+def get_compiled_versions(compiled, kind, name, plat):
+    # versions of name providing a package/environment on plat, latest first
+    return [x[0] for x in compiled[kind].get(name, []) if plat in x[1] or "common" in x[1]]
+
+def get_compiled_dependencies(compiled, name, version, plat):
+    deps = compiled["dependencies"].get(name, {}).get(version, {})
+    return deps.get(plat, deps.get("common", {}))
 
 def list_packages(index):
     tools = index.keys()
@@ -54,7 +502,7 @@ def list_packages(index):
         else:
             print(toolname)
         versions = d0.get("versions", {}).keys()
-        versions.sort(reverse=True)
+        versions.sort(key=version_key, reverse=True)
         for version in versions:
             d1 = d0["versions"][version]
             plats = d1.keys()
@@ -83,7 +531,7 @@ def list_packages(index):
                 if env is not None:
                     print("    %s environment: %s" % (plat, os.path.basename(env)))
 
-def list_installed(index, outdir, env=False):
+def scan_installed(index, outdir, env=False):
     plat = platform.system().lower()
     
     rv = set()
@@ -115,44 +563,254 @@ def list_installed(index, outdir, env=False):
                         rv.add((name, version))
     
     else:
-        names = index.keys()
-        names.sort(key=lambda x: len(x), reverse=True)
+        compiled = get_compiled_index(index)
         
-        for item in glob.glob(outdir + "/downloads/*.tgz"):
+        for item in glob.glob(outdir + "/downloads/*.tgz") + glob.glob(outdir + "/downloads/*.zip"):
             bn = os.path.splitext(os.path.basename(item))[0]
-            for name in names:
-                if bn.startswith(name):
-                    category = index[name].get("category", "")
-                    installname = index[name].get("installname", name)
-                    version = re.sub(r"_(darwin|windows|linux|common)$", "", bn.replace(name, ""))
-                    prefix = ("/%s" % category if category else "")
-                    verinfo = index[name].get("versions", {}).get(version, {})
-                    checklist = verinfo.get(plat, {}).get("checklist", []) + verinfo.get("common", {}).get("checklist", [])
-                    foundall = True
-                    topdir = outdir + prefix + "/" + installname + "/" + version + "/" + plat
-                    if len(checklist) == 0:
-                        checklist.append(topdir)
-                    for entry in checklist:
-                        if not os.path.exists(topdir + "/" + entry):
-                            foundall = False
-                            break
-                    if foundall:
-                        rv.add((name, version))
-                    break
+            name = match_index_name(compiled, bn)
+            if name is not None:
+                category = index[name].get("category", "")
+                installname = index[name].get("installname", name)
+                version = re.sub(r"_(darwin|windows|linux|common)$", "", bn[len(name):])
+                prefix = ("/%s" % category if category else "")
+                verinfo = index[name].get("versions", {}).get(version, {})
+                checklist = verinfo.get(plat, {}).get("checklist", []) + verinfo.get("common", {}).get("checklist", [])
+                foundall = True
+                topdir = outdir + prefix + "/" + installname + "/" + version + "/" + plat
+                if len(checklist) == 0:
+                    checklist.append("")
+                for entry in checklist:
+                    if not os.path.exists(topdir + "/" + entry):
+                        foundall = False
+                        break
+                if foundall:
+                    rv.add((name, version))
     
     rv = list(rv)
     rv.sort()
     
     return rv
 
-def list_installed_packages(index, outdir, indent=""):
-    for name, version in list_installed(index, outdir, env=False):
+# Install state
+#
+# installed.json in the output directory records what install and uninstall
+# did so that listing installed packages and skipping already installed ones
+# do not require scanning the install tree:
+#   {"format": 1,
+#    "packages": {"<name> <version> <platform>": {"name": ..., "version": ...,
+#                                                 "platform": ..., "archives": [...]}},
+#    "environments": {"<name> <version>": {"name": ..., "version": ..., "file": ...}}}
+# Updates are done under a lock file and written to a temporary file that
+# then replaces installed.json.
+# The lock file holds "<host> <pid>" of its owner, it is considered stale
+# once that process is gone (a lock held from another host is waited for).
+# When the file is missing (tree installed by an older version), it is
+# created from a filesystem scan
+
+def process_alive(pid):
+    if sys.platform == "win32":
+        # os.kill would terminate the process on windows
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid) # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return (kernel32.GetLastError() == 5) # ERROR_ACCESS_DENIED
+        code = ctypes.c_ulong()
+        try:
+            if not kernel32.GetExitCodeProcess(handle, ctypes.byref(code)):
+                return True
+        finally:
+            kernel32.CloseHandle(handle)
+        return (code.value == 259) # STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return (e.errno == errno.EPERM)
+    return True
+
+@contextlib.contextmanager
+def install_state_lock(outdir, timeout=60):
+    # timeout only applies to a lock file whose owner was never written
+    lockpath = outdir + "/installed.json.lock"
+    host = platform.node()
+    waiting = False
+    while True:
+        try:
+            fd = os.open(lockpath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            try:
+                os.write(fd, "%s %d" % (host, os.getpid()))
+            finally:
+                os.close(fd)
+            break
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            try:
+                with open(lockpath, "r") as f:
+                    owner = f.read().rsplit(" ", 1)
+                if len(owner) == 2 and owner[1].isdigit():
+                    stale = (owner[0] == host and not process_alive(int(owner[1])))
+                    if not stale and not waiting:
+                        print("Waiting for %s (held by process %s on %s)" % (lockpath, owner[1], owner[0]))
+                        waiting = True
+                else:
+                    stale = (time.time() - os.stat(lockpath).st_mtime > timeout)
+                if stale:
+                    # left over by an interrupted process
+                    os.remove(lockpath)
+                    continue
+            except (IOError, OSError):
+                continue
+            time.sleep(0.1)
+    try:
+        yield
+    finally:
+        os.remove(lockpath)
+
+def read_install_state(outdir):
+    try:
+        with open(outdir + "/installed.json", "r") as f:
+            state = json.load(f)
+        if state.get("format") == install_state_format:
+            return state
+    except:
+        pass
+    return None
+
+def write_install_state(outdir, state):
+    statepath = outdir + "/installed.json"
+    tmppath = "%s.%d.tmp" % (statepath, os.getpid())
+    with open(tmppath, "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    if os.path.exists(statepath) and sys.platform == "win32":
+        os.remove(statepath)
+    os.rename(tmppath, statepath)
+
+def scan_install_state(index, outdir, state=None):
+    # (re)build current platform entries from the install tree
+    plat = platform.system().lower()
+    
+    if state is None:
+        state = {"format": install_state_format, "packages": {}, "environments": {}}
+    
+    for key, entry in state["packages"].items():
+        if entry["platform"] == plat:
+            del(state["packages"][key])
+    for name, version in scan_installed(index, outdir, env=False):
+        set_package_state(state, name, version, plat)
+    
+    state["environments"] = {}
+    for name, version in scan_installed(index, outdir, env=True):
+        set_environment_state(state, name, version)
+    
+    return state
+
+def set_package_state(state, name, version, plat, archives=[]):
+    state["packages"]["%s %s %s" % (name, version, plat)] = {"name": name, "version": version, "platform": plat, "archives": list(archives)}
+
+def set_environment_state(state, name, version, envfile=None):
+    state["environments"]["%s %s" % (name, version)] = {"name": name, "version": version, "file": envfile}
+
+def update_install_state(index, outdir, func, rescan=False):
+    with install_state_lock(outdir):
+        state = (None if rescan else read_install_state(outdir))
+        if state is None:
+            state = scan_install_state(index, outdir, read_install_state(outdir))
+        func(state)
+        write_install_state(outdir, state)
+    return state
+
+def list_installed(index, outdir, env=False, verify=False, update=True):
+    # update=False leaves installed.json untouched (i.e. list only commands)
+    plat = platform.system().lower()
+    
+    state = None
+    if not verify:
+        state = read_install_state(outdir)
+    if state is None and os.path.isdir(outdir):
+        # verify or missing state: scan the install tree (and update state)
+        if update:
+            state = update_install_state(index, outdir, lambda x: None, rescan=True)
+        else:
+            state = scan_install_state(index, outdir, read_install_state(outdir))
+    if state is None:
+        return []
+    
+    # names and versions are unicode when read from installed.json
+    if env:
+        rv = [(str(x["name"]), str(x["version"])) for x in state["environments"].itervalues()]
+    else:
+        rv = [(str(x["name"]), str(x["version"])) for x in state["packages"].itervalues() if x["platform"] == plat]
+    
+    rv.sort()
+    
+    return rv
+
+def list_installed_packages(index, outdir, indent="", verify=False):
+    for name, version in list_installed(index, outdir, env=False, verify=verify, update=False):
         print("%s%s %s" % (indent, name, version))
 
-def list_installed_environments(index, outdir, indent=""):
-    for name, version in list_installed(index, outdir, env=True):
+def list_installed_environments(index, outdir, indent="", verify=False):
+    for name, version in list_installed(index, outdir, env=True, verify=verify, update=False):
         print("%s%s %s" % (indent, name, version))
 
+def manifest_name(name, isdir=False):
+    # archive member name as recorded in manifests, directories end with '/'
+    name = os.path.normpath(name).replace("\\", "/")
+    if name == ".":
+        return None
+    return (name + "/" if isdir else name)
+
+def write_manifest(path, names):
+    tmppath = path + ".tmp"
+    with open(tmppath, "w") as f:
+        for name in names:
+            f.write(name.encode("utf-8") if isinstance(name, unicode) else name)
+            f.write("\n")
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmppath, path)
+
+def read_manifest(path):
+    with open(path, "r") as f:
+        return [x for x in f.read().split("\n") if x]
+
+def get_manifest_path(outdir, archivepath):
+    return outdir + "/manifests/" + os.path.basename(archivepath) + ".files"
+
+def remove_manifest_files(names, topdir, verbose=False):
+    # remove files first then directories left empty, deepest first
+    dirs = set()
+    count = 0
+    for name in names:
+        if name.endswith("/"):
+            dirs.add(name[:-1])
+            continue
+        path = topdir + "/" + name
+        if os.path.islink(path) or os.path.isfile(path):
+            os.remove(path)
+            count += 1
+        d = os.path.dirname(name)
+        while d:
+            dirs.add(d)
+            d = os.path.dirname(d)
+    for d in sorted(dirs, key=lambda x: x.count("/"), reverse=True):
+        path = topdir + "/" + d
+        if os.path.isdir(path) and not os.path.islink(path) and len(os.listdir(path)) == 0:
+            os.rmdir(path)
+    if verbose:
+        print("Removed %d file(s) from %s" % (count, topdir))
+
+def remove_empty_dirs(path, topdir):
+    # remove path and its parents up to topdir (excluded) while they are empty
+    topdir = os.path.abspath(topdir)
+    path = os.path.abspath(path)
+    while path != topdir and path.startswith(topdir + os.sep):
+        if not os.path.isdir(path) or len(os.listdir(path)) != 0:
+            break
+        os.rmdir(path)
+        path = os.path.dirname(path)
+
 def list_tar(path):
     try:
         with tarfile.open(path, "r") as t:
@@ -161,117 +819,568 @@ def list_tar(path):
         print("Failed to list %s (%s)." % (path, e))
         return []
 
+def tar_members(t, names):
+    # iterate over the members of a tar archive opened in stream mode, record
+    # their manifest names in names
+    for member in t:
+        if os.path.basename(member.name).startswith("._"):
+            continue
+        name = manifest_name(member.name, member.isdir())
+        if name is not None:
+            names.append(name)
+        yield member
+
 def extract_tar(path, outdir, verbose=False):
+    # Members are read and extracted in a single sequential pass over the
+    # archive, returns the manifest of extracted files (None on failure)
+    names = []
+    
     try:
         if verbose:
             print("Extracting %s..." % path)
-        with tarfile.open(path, "r") as t:
-            members = filter(lambda x: not os.path.basename(x.name).startswith("._"), t.getmembers())
-            t.extractall(outdir, members=members)
+        with tarfile.open(path, "r|*") as t:
+            t.extractall(outdir, members=tar_members(t, names))
+        return names
     except Exception, e:
         print("Failed to extract %s (%s)." % (path, e))
+        return None
+
+def zip_members(z):
+    # skip resource fork entries, same as with tar archives, and entries that
+    # would end up outside of the output directory
+    for info in z.infolist():
+        name = info.filename.replace("\\", "/")
+        if os.path.basename(name.rstrip("/")).startswith("._") or name.split("/")[0] == "__MACOSX":
+            continue
+        if name.startswith("/") or ".." in name.split("/"):
+            print("Skip unsafe zip entry %s" % info.filename)
+            continue
+        yield info
 
 def list_zip(path):
-    raise Exception("Not Yet Implemented.")
+    try:
+        with zipfile.ZipFile(path, "r") as z:
+            return [x.filename for x in zip_members(z)]
+    except Exception, e:
+        print("Failed to list %s (%s)." % (path, e))
+        return []
 
 def extract_zip(path, outdir, verbose=False):
-    raise Exception("Not Yet Implemented.")
+    # Entries are streamed to disk one chunk at a time, returns the manifest
+    # of extracted files (None on failure)
+    # Permissions and symbolic links are restored for entries created on unix
+    # systems (the only ones recording them)
+    names = []
+    dirs = []
+    
+    try:
+        if verbose:
+            print("Extracting %s..." % path)
+        with zipfile.ZipFile(path, "r") as z:
+            for info in zip_members(z):
+                mode = ((info.external_attr >> 16) & 0xFFFF if info.create_system == 3 else 0)
+                # directory entries are not always '/' terminated, their
+                # attributes (unix mode or MS-DOS directory flag) tell
+                isdir = (info.filename.endswith("/") or stat.S_ISDIR(mode) or bool(info.external_attr & 0x10))
+                name = manifest_name(info.filename, isdir)
+                if name is None:
+                    continue
+                names.append(name)
+                
+                target = outdir + "/" + name.rstrip("/")
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                
+                if isdir:
+                    if not os.path.isdir(target):
+                        os.makedirs(target)
+                    dirs.append((target, mode, mtime))
+                    continue
+                
+                parent = os.path.dirname(target)
+                if not os.path.isdir(parent):
+                    os.makedirs(parent)
+                
+                if os.path.islink(target) or os.path.isfile(target):
+                    os.remove(target)
+                
+                if stat.S_ISLNK(mode) and hasattr(os, "symlink"):
+                    os.symlink(z.read(info), target)
+                    continue
+                
+                src = z.open(info)
+                try:
+                    with open(target, "wb") as dst:
+                        shutil.copyfileobj(src, dst, download_chunk_size)
+                finally:
+                    src.close()
+                
+                if mode:
+                    os.chmod(target, stat.S_IMODE(mode))
+                os.utime(target, (mtime, mtime))
+            
+            # set directories attributes last, deepest first, as their content
+            # modifies them
+            dirs.sort(reverse=True)
+            for target, mode, mtime in dirs:
+                if mode:
+                    os.chmod(target, stat.S_IMODE(mode))
+                os.utime(target, (mtime, mtime))
+        
+        return names
+    
+    except Exception, e:
+        print("Failed to extract %s (%s)." % (path, e))
+        return None
 
-def build_package_urls(index, packages, outdir, ignoredeps=False, verbose=False):
-    names = index.keys()
-    names.sort(key=lambda x: len(x), reverse=True)
+def get_list_func(path):
+    ext = os.path.splitext(path)[1]
+    if ext == ".zip":
+        return list_zip
+    return list_tar
+
+def resolve_packages(index, packages, kind="packages", plat=None, ignoredeps=False, verbose=False):
+    # Select one version per package for the whole request graph
+    # packages are <name>(<version spec>) strings, kind is one of 'packages'
+    # or 'environments'
+    # Packages are selected in discovery order, each one gets the latest
+    # version satisfying the constraints put on it so far. When a package is
+    # left without candidates, or a new dependency rejects an already selected
+    # version, older versions of the packages that added the conflicting
+    # constraints are tried (conflict directed backjumping)
+    # Returns a list of (name, version) tuples in request order, or None when
+    # no consistent set of versions exists
+    compiled = get_compiled_index(index)
     
-    plat = platform.system().lower()
-    urls = {}
+    if plat is None:
+        plat = platform.system().lower()
     
-    n = len(packages)
-    i = 0
+    # name -> [(required by (name, version) or None, constraints, spec), ...]
+    constraints = {}
+    roots = []
     
-    while i < n:
-        package = packages[i]
+    for package in packages:
+        name = match_index_name(compiled, package)
+        if name is None:
+            print("%s not found" % package)
+            return None
+        spec = package[len(name):]
+        try:
+            cons = parse_version_spec(spec)
+        except ValueError, e:
+            print(e)
+            return None
+        constraints.setdefault(name, []).append((None, cons, spec))
+        if not name in roots:
+            roots.append(name)
+    
+    def describe(name, cons):
+        reqs = []
+        for origin, _, spec in cons:
+            if origin is None:
+                reqs.append("requested %s" % (spec or "any version"))
+            else:
+                reqs.append("%s %s requires %s" % (origin[0], origin[1], spec or "any version"))
+        return "; ".join(reqs)
+    
+    def origins(cons):
+        return set([x[0][0] for x in cons if x[0] is not None])
+    
+    def get_dependencies(name, version):
+        # [(depname, (origin, constraints, spec)), ...]
+        rv = []
+        if ignoredeps:
+            return rv
+        for depname, depspec in sorted(get_compiled_dependencies(compiled, name, version, plat).iteritems()):
+            if not depname in index:
+                print("%s %s dependency %s not found" % (name, version, depname))
+                continue
+            try:
+                cons = parse_version_spec(depspec)
+            except ValueError, e:
+                print("%s %s dependency %s: %s" % (name, version, depname, e))
+                continue
+            rv.append((depname, ((name, version), cons, depspec)))
+        return rv
+    
+    # first conflict found, reported when the resolution fails
+    failure = []
+    iterations = [0]
+    maxiterations = 1000 * max(1, len(index))
+    
+    def search(queue, selected, constraints, order):
+        # Returns (selected, order) or (None, conflict set), the conflict set
+        # holding the names of the packages whose selection caused the failure
+        while queue and queue[0] in selected:
+            queue = queue[1:]
+        if not queue:
+            return (selected, order)
         
-        if package in index:
-            # No version specified
-            vers = []
-            for ver, verinfo in index[package].get("versions", {}).iteritems():
-                valid = False
-                if plat in verinfo:
-                    pkg = verinfo[plat].get("package", None)
-                    if pkg is not None:
-                        valid = True
-                if not valid and "common" in verinfo:
-                    pkg = verinfo["common"].get("package", None)
-                    if pkg is not None:
-                        valid = True
-                
-                if valid:
-                    vers.append(ver)
+        iterations[0] += 1
+        if iterations[0] > maxiterations:
+            return (None, None)
+        
+        name = queue[0]
+        cons = constraints.get(name, [])
+        candidates = [x for x in get_compiled_versions(compiled, kind, name, plat) if all(version_matches(x, y[1]) for y in cons)]
+        
+        if not candidates:
+            if not failure:
+                failure.append("%s is not available for %s (%s)." % (name, plat, describe(name, cons)))
+            return (None, origins(cons))
+        
+        conflict = set()
+        
+        for version in candidates:
+            deps = get_dependencies(name, version)
             
-            if len(vers) > 0:
-                vers.sort(reverse=True)
-                if verbose:
-                    print("Use version %s for %s (latest)." % (vers[0], package))
-                packages[i] = "%s%s" % (package, vers[0])
+            # dependencies rejecting an already selected version
+            rejected = [x for x in deps if x[0] in selected and not version_matches(selected[x[0]], x[1][1])]
+            if rejected:
+                for depname, entry in rejected:
+                    if not failure:
+                        failure.append("%s %s is not compatible with %s (%s)." % (depname, selected[depname], name, describe(depname, constraints.get(depname, []) + [entry])))
+                    conflict.add(depname)
                 continue
             
-            else:
-                print("%s is not available for %s." % (package, plat))
-        
-        else:
-            found = False
+            if verbose:
+                specs = [x[2] for x in cons if x[2]]
+                if specs:
+                    print("Use version %s for %s (%s)." % (version, name, ", ".join(specs)))
+                else:
+                    print("Use version %s for %s (latest)." % (version, name))
             
-            for name in names:
-                if package.startswith(name):
-                    version = package.replace(name, "")
-                    category = index[name].get("category", "")
-                    versions = index[name].get("versions", {})
-                    if version in versions:
-                        verinfo = versions[version]
-                        
-                        deps = {}
-                        if not ignoredeps:
-                            deps = verinfo.get("common", {}).get("dependencies", {})
-                            deps.update(verinfo.get(plat, {}).get("dependencies", {}))
-                        
-                        pkgurls = []
-                        pkgurl = verinfo.get("common", {}).get("package", None)
-                        if pkgurl is not None:
-                            pkgurls.append("%s/%s%s_common.tgz" % (pkgurl, name, version))
-                        pkgurl = verinfo.get(plat, {}).get("package", None)
-                        if pkgurl is not None:
-                            pkgurls.append("%s/%s%s_%s.tgz" % (pkgurl, name, version, plat))
-                        
-                        if len(pkgurls) > 0:
-                            for depname, depver in deps.iteritems():
-                                depkey = "%s%s" % (depname, depver)
-                                if depname in packages:
-                                    # already specified without version but not yet processed
-                                    # (would have been replaced)
-                                    if verbose:
-                                        print("Use version %s for %s (fix by dependency)." % (depver, depname))
-                                    idx = packages.index(name)
-                                    packages[idx] = depkey
-                                    continue
-                                elif depkey in packages:
-                                    if verbose:
-                                        print("%s %s dependency %s %s already required." % (name, version, depname, depver))
-                                else:
-                                    if verbose:
-                                        print("Add %s %s dependency: %s %s." % (name, version, depname, depver))
-                                    packages.append(depkey)
-                                    n = len(packages)
-                            urls[(name, version)] = (category, map(dropbox_download_url, pkgurls))
-                            found = True
-                    break
+            newselected = selected.copy()
+            newselected[name] = version
+            newconstraints = constraints.copy()
+            newqueue = queue[1:]
+            neworder = order + [name]
+            for depname, entry in deps:
+                if verbose:
+                    print("Add %s %s dependency: %s." % (name, version, ("%s %s" % (depname, entry[2])).strip()))
+                newconstraints[depname] = newconstraints.get(depname, []) + [entry]
+                if not depname in newqueue and not depname in newselected:
+                    newqueue.append(depname)
             
-            if not found:
-                print("%s not found" % package)
-        i += 1
+            rv, info = search(newqueue, newselected, newconstraints, neworder)
+            if rv is not None:
+                return (rv, info)
+            if info is None:
+                # too many iterations
+                return (None, None)
+            if not name in info:
+                # another version of this package would not help
+                return (None, info)
+            conflict.update(info)
+            conflict.discard(name)
+            if verbose:
+                print("Backtrack from %s %s." % (name, version))
+        
+        # candidates were restricted by the packages that constrained this one
+        conflict.update(origins(cons))
+        conflict.discard(name)
+        return (None, conflict)
+    
+    selected, info = search(list(roots), {}, constraints, [])
+    
+    if selected is None:
+        if info is None:
+            print("Too many combinations to try for %s." % ", ".join(packages))
+        elif failure:
+            print(failure[0])
+        print("Could not find a consistent set of versions for %s." % ", ".join(packages))
+        return None
+    
+    order = info
+    return [(x, selected[x]) for x in roots + [y for y in order if not y in roots]]
+
+def build_package_urls(index, packages, outdir, ignoredeps=False, verbose=False):
+    # None when the packages cannot be resolved
+    plat = platform.system().lower()
+    pkgversions = resolve_packages(index, packages, "packages", plat, ignoredeps, verbose)
+    if pkgversions is None:
+        return None
+    return get_package_urls(index, pkgversions, plat)
+
+def get_package_urls(index, pkgversions, plat=None):
+    # pkgversions is a list of (name, version) tuples as returned by
+    # resolve_packages
+    if plat is None:
+        plat = platform.system().lower()
+    urls = {}
+    
+    for name, version in pkgversions:
+        category = index[name].get("category", "")
+        verinfo = index[name]["versions"][version]
+        
+        # archives are .tgz files unless the entry "format" says otherwise
+        pkgurls = []
+        for key in ("common", plat):
+            pkgurl = verinfo.get(key, {}).get("package", None)
+            if pkgurl is not None:
+                pkgurls.append("%s/%s%s_%s.%s" % (pkgurl, name, version, key, verinfo[key].get("format", "tgz")))
+        
+        urls[(name, version)] = (category, map(dropbox_download_url, pkgurls))
     
     return urls
 
-def install_packages(index, packages, outdir, ignoredeps=False, force=False, verbose=False):
-    urls = build_package_urls(index, packages, outdir, ignoredeps, verbose)
+def download_many(tasks, jobs=1, func=download):
+    # tasks is a list of func arguments tuples, (url, outdir) by default
+    # yields (task index, func result) as downloads complete
+    if jobs <= 1 or len(tasks) <= 1:
+        for i, task in enumerate(tasks):
+            yield (i, func(*task))
+        return
+    
+    pending = Queue.Queue()
+    done = Queue.Queue()
+    
+    for i, task in enumerate(tasks):
+        pending.put((i, task))
+    
+    def worker():
+        while True:
+            try:
+                i, task = pending.get_nowait()
+            except Queue.Empty:
+                return
+            rv = None
+            try:
+                rv = func(*task)
+            finally:
+                done.put((i, rv))
+    
+    for _ in xrange(min(jobs, len(tasks))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+    
+    for _ in xrange(len(tasks)):
+        while True:
+            # use a timeout so that the wait stays interruptible
+            try:
+                yield done.get(True, 1.0)
+                break
+            except Queue.Empty:
+                pass
+
+def get_archive_hash(index, name, version, url):
+    # archives are named <name><version>_<common|platform>.<format>
+    key = os.path.splitext(os.path.basename(url.split("?")[0]))[0].rsplit("_", 1)[-1]
+    return index[name].get("versions", {}).get(version, {}).get(key, {}).get("sha256", None)
+
+def file_hash(path, algorithm="sha256"):
+    h = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(download_chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def parse_size(size):
+    m = re.match(r"^(\d+)([kmgt]?)b?$", size.strip().lower())
+    if m is None:
+        raise ValueError("Invalid size '%s'" % size)
+    return int(m.group(1)) * (1024 ** " kmgt".index(m.group(2) or " "))
+
+def remove_file(path):
+    # read-only files (i.e. cache entries) cannot be removed on windows
+    if sys.platform == "win32":
+        os.chmod(path, stat.S_IWRITE)
+    os.remove(path)
+
+def clone_file(src, dst, mode=0644):
+    # Copy-on-write clone when the file system supports it, plain copy
+    # otherwise
+    # Cache entries and downloaded archives never share an inode (no
+    # hardlinks): modifying one copy in place cannot corrupt the others
+    if os.path.exists(dst):
+        remove_file(dst)
+    cloned = False
+    if sys.platform.startswith("linux"):
+        try:
+            import fcntl
+            FICLONE = 0x40049409
+            with open(src, "rb") as fsrc:
+                with open(dst, "wb") as fdst:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            cloned = True
+        except (IOError, OSError):
+            if os.path.exists(dst):
+                os.remove(dst)
+    if not cloned:
+        shutil.copyfile(src, dst)
+    os.chmod(dst, mode)
+
+def cache_key(url, hash=None):
+    # content hash from the index when available, url based otherwise
+    if hash:
+        return "sha256-" + hash.lower()
+    else:
+        return "url-" + hashlib.sha1(url.split("?")[0]).hexdigest()
+
+def cache_lookup(key):
+    if not cache_dir:
+        return None
+    path = cache_dir + "/" + key
+    if not os.path.isfile(path):
+        return None
+    try:
+        # cache entries modification time is used to track last access
+        os.utime(path, None)
+    except OSError:
+        pass
+    return path
+
+def cache_store(path, key, verbose=False):
+    if not cache_dir:
+        return
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        cachepath = cache_dir + "/" + key
+        tmppath = "%s.%d.tmp" % (cachepath, os.getpid())
+        # entries are read-only, they are only ever replaced as a whole
+        clone_file(path, tmppath, 0444)
+        if os.path.exists(cachepath):
+            remove_file(cachepath)
+        os.rename(tmppath, cachepath)
+        os.utime(cachepath, None)
+        if verbose:
+            print("Cached %s as %s" % (os.path.basename(path), key))
+        cache_evict(keep=key, verbose=verbose)
+    except Exception, e:
+        print("Failed to add %s to cache (%s)" % (path, e))
+
+def cache_evict(keep=None, verbose=False):
+    # remove least recently used entries until the cache fits its size limit
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        if name.endswith(".tmp"):
+            continue
+        path = cache_dir + "/" + name
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        total += st.st_size
+        if name != keep:
+            entries.append((st.st_mtime, st.st_size, path))
+    entries.sort()
+    for mtime, size, path in entries:
+        if total <= cache_size:
+            break
+        try:
+            remove_file(path)
+            total -= size
+            if verbose:
+                print("Evict %s from cache" % os.path.basename(path))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                print("Failed to evict %s from cache (%s)" % (path, e))
+
+def get_extract_func(path):
+    ext = os.path.splitext(path)[1]
+    if ext == ".tgz":
+        return extract_tar
+    elif ext == ".zip":
+        return extract_zip
+    elif ext == ".gz":
+        ext = os.path.splitext(os.path.splitext(path)[0])[1]
+        if ext == ".tar":
+            return extract_tar
+    return None
+
+def parse_archive_name(compiled, filename):
+    # <name><version>_<common|platform>.<format> -> (name, version, key)
+    # None for anything else (partial downloads, unrelated files)
+    bn = os.path.basename(filename)
+    if get_extract_func(bn) is None:
+        return None
+    bn = (bn[:-7] if bn.endswith(".tar.gz") else os.path.splitext(bn)[0])
+    name = match_index_name(compiled, bn)
+    if name is None:
+        return None
+    suffix = bn[len(name):]
+    if not "_" in suffix:
+        return None
+    version, key = suffix.rsplit("_", 1)
+    return (name, version, key)
+
+def verify_all(index, outdir, jobs=None, verbose=False):
+    # Check the downloaded archives and the shared cache entries against the
+    # index checksums, hashing files on a process pool
+    # Corrupted downloads are fetched again, corrupted cache entries removed
+    compiled = get_compiled_index(index)
+    downloaddir = outdir + "/downloads"
+    
+    # (path, expected checksum, url or None)
+    items = []
+    
+    if os.path.isdir(downloaddir):
+        for path in sorted(glob.glob(downloaddir + "/*")):
+            parsed = parse_archive_name(compiled, path)
+            if parsed is None:
+                continue
+            name, version, key = parsed
+            info = index[name].get("versions", {}).get(version, {}).get(key, {})
+            if info.get("sha256") and info.get("package"):
+                url = dropbox_download_url("%s/%s" % (info["package"], os.path.basename(path)))
+                items.append((path, info["sha256"].lower(), url))
+    
+    if cache_dir and os.path.isdir(cache_dir):
+        for path in sorted(glob.glob(cache_dir + "/sha256-*")):
+            if not path.endswith(".tmp"):
+                items.append((path, os.path.basename(path)[7:], None))
+    
+    if len(items) == 0:
+        print("No archive to verify")
+        return True
+    
+    if verbose:
+        print("Verify %d file(s)..." % len(items))
+    
+    pool = multiprocessing.Pool(jobs)
+    try:
+        digests = pool.map(file_hash, [x[0] for x in items], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    
+    refetch = []
+    
+    for (path, checksum, url), digest in zip(items, digests):
+        if digest == checksum:
+            if verbose:
+                print("OK      %s" % path)
+            continue
+        
+        print("CORRUPT %s" % path)
+        remove_file(path)
+        
+        if url is not None:
+            refetch.append((url, checksum))
+    
+    rv = True
+    
+    for url, checksum in refetch:
+        path = download(url, downloaddir, checksum=checksum)
+        if path is None:
+            rv = False
+        else:
+            cache_store(path, cache_key(url, checksum), verbose=verbose)
+    
+    return rv
+
+def install_packages(index, packages, outdir, ignoredeps=False, force=False, verbose=False, jobs=1, verify=False, pipeline=False, urls=None, checksums=None):
+    # urls, as returned by get_package_urls, skips packages resolution
+    # checksums, {archive name: sha256}, complete the index ones (lockfile)
+    if urls is None:
+        urls = build_package_urls(index, packages, outdir, ignoredeps, verbose)
+        if urls is None:
+            return False
     
     plat = platform.system().lower()
     
@@ -279,97 +1388,277 @@ def install_packages(index, packages, outdir, ignoredeps=False, force=False, ver
     if not os.path.isdir(downloaddir):
         os.makedirs(downloaddir)
     
-    for k, v in urls.iteritems():
+    installed = set()
+    if not force and not verify:
+        installed = set(list_installed(index, outdir))
+    
+    # (name, version, install prefix, url, archive path, download required, cache key, checksum)
+    archives = []
+    
+    for k in sorted(urls.keys()):
         name, version = k
-        category, urll = v
+        category, urll = urls[k]
         installname = index[name].get("installname", name)
         
         prefix = ("/%s" % category if category else "")
         prefix += "/" + installname + "/" + version + "/" + plat
         
+        if not force and not verify:
+            if (name, version) in installed:
+                if verbose:
+                    print("%s %s already installed." % (name, version))
+                continue
+        
+        elif not force:
+            foundall = True
+            
+            verinfo = index[name].get("versions", {}).get(version, {})
+            checklist = verinfo.get("common", {}).get("checklist", []) + verinfo.get(plat, {}).get("checklist", [])
+            if len(checklist) == 0:
+                checklist.append("")
+            
+            for entry in checklist:
+                if not os.path.exists(outdir + prefix + "/" + entry):
+                    foundall = False
+                    break
+            
+            if foundall:
+                if verbose:
+                    print("%s %s already installed." % (name, version))
+                continue
+        
         for url in urll:
             targetname = os.path.basename(url.split("?")[0])
             targetpath = downloaddir + "/" + targetname
+            checksum = get_archive_hash(index, name, version, url)
+            if checksum is None and checksums:
+                checksum = checksums.get(targetname, None)
+            key = cache_key(url, checksum)
             dl = True
             
             if not force:
-                foundall = True
-                
-                verinfo = index[name].get("versions", {}).get(version, {})
-                checklist = verinfo.get("common", {}).get("checklist", []) + verinfo.get(plat, {}).get("checklist", [])
-                
-                for entry in checklist:
-                    if not os.path.exists(outdir + prefix + "/" + entry):
-                        foundall = False
-                        break
-                
-                if foundall:
-                    if verbose:
-                        print("%s %s already installed." % (name, version))
-                    continue
-                
                 if os.path.isfile(targetpath) and os.stat(targetpath).st_size > 0:
-                    if verbose:
-                        print("%s %s already downloaded." % (name, version))
-                    dl = False
+                    if checksum and file_hash(targetpath) != checksum.lower():
+                        print("%s is corrupted, download it again." % targetpath)
+                        os.remove(targetpath)
+                    else:
+                        if verbose:
+                            print("%s %s already downloaded." % (name, version))
+                        dl = False
+                
+                if dl:
+                    cachedpath = cache_lookup(key)
+                    if cachedpath is not None and checksum and file_hash(cachedpath) != checksum.lower():
+                        print("Cached %s is corrupted, download it again." % os.path.basename(targetpath))
+                        remove_file(cachedpath)
+                        cachedpath = None
+                    if cachedpath is not None:
+                        if verbose:
+                            print("%s %s found in cache." % (name, version))
+                        clone_file(cachedpath, targetpath)
+                        dl = False
             
+            archives.append((name, version, prefix, url, targetpath, dl, key, checksum))
+    
+    # All archives go through the worker pool so that downloads start right
+    # away: archives already available locally complete immediately, the
+    # others as soon as their download does or, in pipeline mode, once they
+    # are extracted while downloaded (tar archives only)
+    # Other archives are extracted on this thread as they complete
+    
+    # archives sharing an install directory are not extracted concurrently
+    locks = dict([(x[2], threading.Lock()) for x in archives])
+    
+    def fetch(i):
+        name, version, prefix, url, targetpath, dl, key, checksum = archives[i]
+        if not dl:
+            return (targetpath, None)
+        if pipeline and get_extract_func(targetpath) == extract_tar:
+            with locks[prefix]:
+                return download_extract(url, downloaddir, outdir + prefix, rootdir=outdir, checksum=checksum, verbose=verbose)
+        else:
+            return (download(url, downloaddir, checksum=checksum), None)
+    
+    # packages in install order and their archives
+    pkgorder = []
+    pkgarchives = {}
+    for i, archive in enumerate(archives):
+        k = (archive[0], archive[1])
+        if not k in pkgarchives:
+            pkgorder.append(k)
+            pkgarchives[k] = []
+        pkgarchives[k].append(i)
+    
+    # {(name, version): [(archive index, reason), ...]}
+    errors = {}
+    remaining = dict([(k, len(v)) for k, v in pkgarchives.iteritems()])
+    count = 0
+    
+    for i, rv in download_many([(x,) for x in xrange(len(archives))], jobs=jobs, func=fetch):
+        name, version, prefix, url, targetpath, dl, key, checksum = archives[i]
+        path, names = (rv if rv is not None else (None, None))
+        k = (name, version)
+        remaining[k] -= 1
+        
+        if path is None:
+            errors.setdefault(k, []).append((i, "download failed"))
+        else:
             if dl:
-                path = download(url, downloaddir)
-            else:
-                path = targetpath
+                cache_store(path, key, verbose=verbose)
             
-            extract = None
-            ext = os.path.splitext(path)[1]
-            if ext == ".tgz":
-                extract = extract_tar
-            elif ext == ".zip":
-                extract = extract_zip
-            elif ext == ".gz":
-                ext = os.path.splitext(os.path.splitext(path)[0])[1]
-                if ext == ".tar":
-                    extract = extract_tar
+            extract = get_extract_func(path)
             
             if extract is None:
-                print("Cannot install %s (unsupported package format)." % path)
+                errors.setdefault(k, []).append((i, "unsupported package format"))
             else:
-                print("Install %s %s to %s%s" % (name, version, outdir, prefix))
-                extract(path, outdir + prefix, verbose=verbose)
+                if names is None:
+                    # pipelined tar extractions of the same prefix may still run
+                    with locks[prefix]:
+                        names = extract(path, outdir + prefix, verbose=verbose)
+                if names is None:
+                    errors.setdefault(k, []).append((i, "extraction failed"))
+                else:
+                    manifestpath = get_manifest_path(outdir, path)
+                    if not os.path.isdir(os.path.dirname(manifestpath)):
+                        os.makedirs(os.path.dirname(manifestpath))
+                    write_manifest(manifestpath, names)
+        
+        if remaining[k] > 0:
+            continue
+        
+        count += 1
+        if k in errors:
+            log("[%d/%d] Failed to install %s %s" % (count, len(pkgorder), name, version))
+        else:
+            log("[%d/%d] Installed %s %s to %s%s" % (count, len(pkgorder), name, version, outdir, prefix))
+            names = [os.path.basename(archives[x][4]) for x in pkgarchives[k]]
+            update_install_state(index, outdir, lambda state: set_package_state(state, name, version, plat, names))
+    
+    if errors:
+        # in install order whatever the order downloads completed in
+        print("Failed to install:")
+        for name, version in pkgorder:
+            for i, reason in sorted(errors.get((name, version), [])):
+                print("  %s %s: %s (%s)" % (name, version, os.path.basename(archives[i][4]), reason))
+        return False
+    
+    return True
+
+def prefetch_archives(index, packages, outdir, plats, mode="pkg", ignoredeps=False, force=False, verbose=False, jobs=1):
+    # Download package archives and environments for several platforms to
+    # outdir/downloads (and the shared cache) without installing anything
+    # Archives shared by platforms ('common' ones) are only fetched once
+    downloaddir = outdir + "/downloads"
+    if not os.path.isdir(downloaddir):
+        os.makedirs(downloaddir)
+    
+    # url -> (name, version, checksum)
+    archives = {}
+    
+    for plat in plats:
+        if verbose:
+            print("Resolve for %s..." % plat)
+        if mode in ("both", "pkg"):
+            pkgversions = resolve_packages(index, packages, "packages", plat, ignoredeps, verbose)
+            if pkgversions is None:
+                return False
+            urls = get_package_urls(index, pkgversions, plat)
+            for (name, version), (category, urll) in urls.iteritems():
+                for url in urll:
+                    archives[url] = (name, version, get_archive_hash(index, name, version, url))
+        if mode in ("both", "env"):
+            envversions = resolve_packages(index, packages, "environments", plat, ignoredeps, verbose)
+            if envversions is None:
+                return False
+            urls = get_environment_urls(index, envversions, plat)
+            for (name, version), (category, url) in urls.iteritems():
+                archives[url] = (name, version, None)
+    
+    tasks = []
+    
+    for url in sorted(archives.keys()):
+        name, version, checksum = archives[url]
+        targetname = os.path.basename(url.split("?")[0])
+        targetpath = downloaddir + "/" + targetname
+        key = cache_key(url, checksum)
+        
+        if not force:
+            if os.path.isfile(targetpath) and os.stat(targetpath).st_size > 0:
+                if not checksum or file_hash(targetpath) == checksum.lower():
+                    if verbose:
+                        print("%s already downloaded." % targetname)
+                    continue
+                print("%s is corrupted, download it again." % targetpath)
+                os.remove(targetpath)
+            
+            cachedpath = cache_lookup(key)
+            if cachedpath is not None and (not checksum or file_hash(cachedpath) == checksum.lower()):
+                if verbose:
+                    print("%s found in cache." % targetname)
+                clone_file(cachedpath, targetpath)
+                continue
+        
+        tasks.append((url, downloaddir, None, True, checksum))
+    
+    failed = []
+    
+    for i, path in download_many(tasks, jobs=jobs):
+        url = tasks[i][0]
+        if path is None:
+            failed.append(url)
+        else:
+            cache_store(path, cache_key(url, tasks[i][4]), verbose=verbose)
+    
+    print("Prefetched %d archive(s) for %s (%d downloaded)" % (len(archives) - len(failed), ", ".join(plats), len(tasks) - len(failed)))
+    
+    if failed:
+        print("Failed to download:")
+        for url in sorted(failed):
+            print("  %s" % os.path.basename(url.split("?")[0]))
+        return False
+    
+    return True
+
+def keep_required(index, urls, outdir, env=False):
+    compiled = get_compiled_index(index)
+    plat = platform.system().lower()
+    
+    for pkgname, pkgver in list_installed(index, outdir, env=env):
+        if (pkgname, pkgver) in urls:
+            continue
+        
+        deps = get_compiled_dependencies(compiled, pkgname, pkgver, plat)
+        for depname, depspec in deps.iteritems():
+            for name, version in urls.keys():
+                if name != depname:
+                    continue
+                try:
+                    required = version_matches(version, parse_version_spec(depspec))
+                except ValueError:
+                    required = True
+                if required:
+                    print("Remove %s %s from uninstall list as it is required for %s %s" % (name, version, pkgname, pkgver))
+                    print("  (use -f/--force to ignore this check at your own risk)")
+                    del(urls[(name, version)])
 
-def uninstall_packages(index, packages, outdir, ignoredeps=False, force=False, verbose=False):
-    urls = build_package_urls(index, packages, outdir, ignoredeps, verbose)
+def uninstall_packages(index, packages, outdir, ignoredeps=False, force=False, verbose=False, urls=None):
+    if urls is None:
+        urls = build_package_urls(index, packages, outdir, ignoredeps, verbose)
+        if urls is None:
+            return False
     
     plat = platform.system().lower()
     
     # when including dependencies, keep packages to be removed that are
     # required by other installed packages not to be uninstalled
     if not force:
-        for pkgname, pkgver in list_installed(index, outdir):
-            pkginfo = index[pkgname]
-            verinfo = pkginfo["versions"][pkgver]
-            uninstall = False
-            
-            for k, v in urls.iteritems():
-                name, version = k
-                if name == pkgname:
-                    uninstall = (version == pkgver)
-                    break
-            
-            if not uninstall:
-                deps = verinfo.get("common", {}).get("dependencies", {})
-                deps.update(verinfo.get(plat, {}).get("dependencies", {}))
-                for depname, depver in deps.iteritems():
-                    if (depname, depver) in urls:
-                        print("Remove %s %s from uninstall list as it is required for %s %s" % (depname, depver, pkgname, pkgver))
-                        print("  (use -f/--force to ignore this check at your own risk)")
-                        del(urls[(depname, depver)])
+        keep_required(index, urls, outdir, env=False)
     
     if len(urls) == 0:
         print("Nothing to uninstall")
         return
     
     downloaddir = outdir + "/downloads"
-    if not os.path.isdir(downloaddir):
-        return
     
     for k, v in urls.iteritems():
         name, version = k
@@ -384,114 +1673,74 @@ def uninstall_packages(index, packages, outdir, ignoredeps=False, force=False, v
         for url in urll:
             targetname = os.path.basename(url.split("?")[0])
             targetpath = downloaddir + "/" + targetname
+            manifestpath = get_manifest_path(outdir, targetpath)
             
-            for f in list_tar(targetpath):
-                installedfile = outdir + prefix + "/" + f
-                if os.path.isdir(installedfile):
-                    shutil.rmtree(installedfile)
-                elif os.path.isfile(installedfile):
-                    os.remove(installedfile)
+            if os.path.isfile(manifestpath):
+                remove_manifest_files(read_manifest(manifestpath), outdir + prefix, verbose=verbose)
+                os.remove(manifestpath)
             
-            # TODO
-            #   if outdir + prefix is empty, remove
-            #   recursively up to outdir it self
+            elif os.path.isfile(targetpath):
+                # installed without manifest, use archive content
+                for f in get_list_func(targetpath)(targetpath):
+                    f = manifest_name(f)
+                    if f is None:
+                        continue
+                    installedfile = outdir + prefix + "/" + f
+                    if os.path.isdir(installedfile):
+                        shutil.rmtree(installedfile)
+                    elif os.path.isfile(installedfile):
+                        os.remove(installedfile)
+        
+        remove_empty_dirs(outdir + prefix, outdir)
+        
+        update_install_state(index, outdir, lambda state: state["packages"].pop("%s %s %s" % (name, version, plat), None))
 
 def build_environment_urls(index, packages, ignoredeps=False, verbose=False):
-    names = index.keys()
-    names.sort(key=lambda x: len(x), reverse=True)
-    
+    # None when the environments cannot be resolved
     plat = platform.system().lower()
+    envversions = resolve_packages(index, packages, "environments", plat, ignoredeps, verbose)
+    if envversions is None:
+        return None
+    return get_environment_urls(index, envversions, plat)
+
+def get_environment_url(verinfo, plat):
+    # environment file of a version for plat, None if it does not have one
+    envurl = verinfo.get(plat, {}).get("environment", None)
+    if envurl is None:
+        envurl = verinfo.get("common", {}).get("environment", None)
+    return envurl
+
+def get_environment_urls(index, envversions, plat=None):
+    # versions without an environment file for plat are reported and skipped
+    if plat is None:
+        plat = platform.system().lower()
     urls = {}
     
-    n = len(packages)
-    i = 0
-    
-    while i < n:
-        package = packages[i]
+    for name, version in envversions:
+        category = index[name].get("category", "")
+        envurl = get_environment_url(index[name]["versions"][version], plat)
+        if envurl is None:
+            print("%s %s has no environment for %s" % (name, version, plat))
+            continue
         
-        if package in index:
-            # No version specified
-            vers = []
-            for ver, verinfo in index[package].get("versions", {}).iteritems():
-                valid = False
-                if plat in verinfo:
-                    env = verinfo[plat].get("environment", None)
-                    if env is not None:
-                        valid = True
-                if not valid and "common" in verinfo:
-                    env = verinfo["common"].get("environment", None)
-                    if env is not None:
-                        valid = True
-                
-                if valid:
-                    vers.append(ver)
-            
-            if len(vers) > 0:
-                vers.sort(reverse=True)
-                if verbose:
-                    print("Use version %s for %s (latest)." % (vers[0], package))
-                packages[i] = "%s%s" % (package, vers[0])
-                continue
-            
-            else:
-                print("%s is not available for %s." % (package, plat))
-        
-        else:
-            found = False
-            
-            for name in names:
-                if package.startswith(name):
-                    version = package.replace(name, "")
-                    category = index[name].get("category", "")
-                    versions = index[name].get("versions", {})
-                    if version in versions:
-                        verinfo = versions[version]
-                        
-                        deps = {}
-                        if not ignoredeps:
-                            deps = verinfo.get("common", {}).get("dependencies", {})
-                            deps.update(verinfo.get(plat, {}).get("dependencies", {}))
-                        
-                        envurl = verinfo.get(plat, {}).get("environment", None)
-                        if envurl is None:
-                            envurl = verinfo.get("common", {}).get("environment", None)
-                        
-                        if envurl is not None:
-                            for depname, depver in deps.iteritems():
-                                depkey = "%s%s" % (depname, depver)
-                                if depname in packages:
-                                    # already specified without version but not yet processed
-                                    # (would have been replaced)
-                                    if verbose:
-                                        print("Use version %s for %s (fix by dependency)." % (depver, depname))
-                                    idx = packages.index(name)
-                                    packages[idx] = depkey
-                                    continue
-                                elif depkey in packages:
-                                    if verbose:
-                                        print("%s %s dependency %s %s already required." % (name, version, depname, depver))
-                                else:
-                                    if verbose:
-                                        print("Add %s %s dependency: %s %s." % (name, version, depname, depver))
-                                    packages.append(depkey)
-                                    n = len(packages)
-                            urls[(name, version)] = (category, dropbox_download_url(envurl))
-                            found = True
-                    break
-            
-            if not found:
-                print("%s not found" % package)
-        i += 1
+        urls[(name, version)] = (category, dropbox_download_url(envurl))
     
     return urls
 
-def install_environments(index, packages, outdir, ignoredeps=False, force=False, verbose=False):
-    urls = build_environment_urls(index, packages, ignoredeps, verbose)
+def install_environments(index, packages, outdir, ignoredeps=False, force=False, verbose=False, verify=False, urls=None):
+    if urls is None:
+        urls = build_environment_urls(index, packages, ignoredeps, verbose)
+        if urls is None:
+            return False
     
     downloaddir = outdir + "/downloads"
     if not os.path.isdir(downloaddir):
         os.makedirs(downloaddir)
     
+    installed = set()
+    if not force and not verify:
+        installed = set(list_installed(index, outdir, env=True))
+    
     for k, v in urls.iteritems():
         name, version = k
         category, url = v
@@ -504,7 +1753,7 @@ def install_environments(index, packages, outdir, ignoredeps=False, force=False,
         dl = True
             
         if not force:
-            if os.path.exists(outenv) and os.stat(outenv).st_size > 0:
+            if (name, version) in installed or (verify and os.path.exists(outenv) and os.stat(outenv).st_size > 0):
                 if verbose:
                     print("%s %s already installed." % (name, version))
                 continue
@@ -519,35 +1768,28 @@ def install_environments(index, packages, outdir, ignoredeps=False, force=False,
         else:
             path = targetpath
         
+        if path is None:
+            continue
+        
+        if not os.path.isdir(os.path.dirname(outenv)):
+            os.makedirs(os.path.dirname(outenv))
+        
         shutil.copy(targetpath, outenv)
+        
+        update_install_state(index, outdir, lambda state: set_environment_state(state, name, version, outenv[len(outdir) + 1:]))
 
-def uninstall_environments(index, packages, outdir, ignoredeps=False, force=False, verbose=False):
-    urls = build_environment_urls(index, packages, ignoredeps, verbose)
+def uninstall_environments(index, packages, outdir, ignoredeps=False, force=False, verbose=False, urls=None):
+    if urls is None:
+        urls = build_environment_urls(index, packages, ignoredeps, verbose)
+        if urls is None:
+            return False
     
     plat = platform.system().lower()
     
     # when including dependencies, keep packages to be removed that are
     # required by other installed packages not to be uninstalled
     if not force:
-        for pkgname, pkgver in list_installed(index, outdir):
-            pkginfo = index[pkgname]
-            verinfo = pkginfo["versions"][pkgver]
-            uninstall = False
-            
-            for k, v in urls.iteritems():
-                name, version = k
-                if name == pkgname:
-                    uninstall = (version == pkgver)
-                    break
-            
-            if not uninstall:
-                deps = verinfo.get("common", {}).get("dependencies", {})
-                deps.update(verinfo.get(plat, {}).get("dependencies", {}))
-                for depname, depver in deps.iteritems():
-                    if (depname, depver) in urls:
-                        print("Remove %s %s from uninstall list as it is required for %s %s" % (depname, depver, pkgname, pkgver))
-                        print("  (use -f/--force to ignore this check at your own risk)")
-                        del(urls[(depname, depver)])
+        keep_required(index, urls, outdir, env=True)
     
     if len(urls) == 0:
         print("Nothing to uninstall")
@@ -571,6 +1813,327 @@ def uninstall_environments(index, packages, outdir, ignoredeps=False, force=Fals
             if verbose:
                 print("Remove %s" % outenv)
             os.remove(outenv)
+        
+        update_install_state(index, outdir, lambda state: state["environments"].pop("%s %s" % (name, version), None))
+
+def write_lockfile(index, path, packages, outdir, mode="pkg", ignoredeps=False, verbose=False, plats=None):
+    # Pin the resolved packages and environments with their archives checksums
+    # Checksums missing from the index are computed from downloaded archives
+    if not plats:
+        plats = [platform.system().lower()]
+    lock = {"format": lockfile_format, "packages": [], "environments": []}
+    
+    for plat in (plats if mode in ("both", "pkg") else []):
+        pkgversions = resolve_packages(index, packages, "packages", plat, ignoredeps, verbose)
+        if pkgversions is None:
+            return False
+        urls = get_package_urls(index, pkgversions, plat)
+        for name, version in sorted(urls.keys()):
+            archives = {}
+            for url in urls[(name, version)][1]:
+                targetname = os.path.basename(url.split("?")[0])
+                checksum = get_archive_hash(index, name, version, url)
+                if checksum is None and os.path.isfile(outdir + "/downloads/" + targetname):
+                    checksum = file_hash(outdir + "/downloads/" + targetname)
+                archives[targetname] = checksum
+            lock["packages"].append({"name": name, "version": version, "platform": plat, "archives": archives})
+    
+    if mode in ("both", "env"):
+        # environments are not platform specific once installed
+        envversions = resolve_packages(index, packages, "environments", plats[0], ignoredeps, verbose)
+        if envversions is None:
+            return False
+        for name, version in envversions:
+            lock["environments"].append({"name": name, "version": version})
+        lock["environments"].sort(key=lambda x: (x["name"], x["version"]))
+    
+    with open(path, "w") as f:
+        json.dump(lock, f, indent=1, sort_keys=True)
+    
+    print("Locked %d package(s) and %d environment(s) in %s" % (len(lock["packages"]), len(lock["environments"]), path))
+    
+    return True
+
+def read_lockfile(path):
+    try:
+        with open(path, "r") as f:
+            lock = json.load(f)
+    except Exception, e:
+        print("Failed to read lockfile %s (%s)." % (path, e))
+        return None
+    if not isinstance(lock, dict) or lock.get("format", None) != lockfile_format:
+        print("Unsupported lockfile %s." % path)
+        return None
+    return lock
+
+def sync_lockfile(index, path, outdir, jobs=1, verbose=False):
+    # Install and uninstall what is needed for the current platform install
+    # state to match the lockfile, in a single pass without resolving
+    plat = platform.system().lower()
+    
+    lock = read_lockfile(path)
+    if lock is None:
+        return False
+    
+    rv = True
+    
+    # locked checksums of archives the index has none for
+    checksums = {}
+    
+    pkgs = set()
+    for entry in lock.get("packages", []):
+        if entry["platform"] != plat:
+            continue
+        name, version = entry["name"], entry["version"]
+        verinfo = index.get(name, {}).get("versions", {}).get(version, None)
+        if verinfo is None:
+            print("%s %s not found in index" % (name, version))
+            rv = False
+            continue
+        
+        # locked checksums complete the index ones, they must not differ
+        valid = True
+        for targetname, checksum in entry.get("archives", {}).iteritems():
+            if not checksum:
+                continue
+            indexhash = get_archive_hash(index, name, version, targetname)
+            if indexhash is None:
+                checksums[targetname] = checksum
+            elif indexhash.lower() != checksum.lower():
+                print("%s checksum differs from index, lockfile is out of date" % targetname)
+                valid = False
+        
+        if valid:
+            pkgs.add((name, version))
+        else:
+            rv = False
+    
+    envs = set()
+    for entry in lock.get("environments", []):
+        name, version = entry["name"], entry["version"]
+        if not version in index.get(name, {}).get("versions", {}):
+            print("%s %s not found in index" % (name, version))
+            rv = False
+            continue
+        if get_environment_url(index[name]["versions"][version], plat) is None:
+            print("%s %s has no environment for %s" % (name, version, plat))
+            rv = False
+            continue
+        envs.add((name, version))
+    
+    installedpkgs = set(list_installed(index, outdir))
+    installedenvs = set(list_installed(index, outdir, env=True))
+    
+    def known(lst):
+        rv = []
+        for name, version in sorted(lst):
+            if not version in index.get(name, {}).get("versions", {}):
+                print("%s %s not found in index, cannot uninstall" % (name, version))
+            else:
+                rv.append((name, version))
+        return rv
+    
+    # locked entries rejected above are left as they are
+    locked = set([(x["name"], x["version"]) for x in lock.get("packages", []) if x["platform"] == plat])
+    rmpkgs = known(installedpkgs - locked)
+    addpkgs = sorted(pkgs - installedpkgs)
+    locked = set([(x["name"], x["version"]) for x in lock.get("environments", [])])
+    rmenvs = known(installedenvs - locked)
+    addenvs = sorted(envs - installedenvs)
+    
+    if not (rmpkgs or addpkgs or rmenvs or addenvs):
+        print("Already in sync with %s" % path)
+        return rv
+    
+    if verbose:
+        for name, version in rmpkgs + rmenvs:
+            print("- %s %s" % (name, version))
+        for name, version in addpkgs + addenvs:
+            print("+ %s %s" % (name, version))
+    
+    if rmpkgs:
+        uninstall_packages(index, None, outdir, force=True, verbose=verbose, urls=get_package_urls(index, rmpkgs, plat))
+    if rmenvs:
+        uninstall_environments(index, None, outdir, force=True, verbose=verbose, urls=get_environment_urls(index, rmenvs, plat))
+    if addpkgs:
+        if not install_packages(index, None, outdir, verbose=verbose, jobs=jobs, pipeline=True, urls=get_package_urls(index, addpkgs, plat), checksums=checksums):
+            rv = False
+    if addenvs:
+        install_environments(index, None, outdir, verbose=verbose, urls=get_environment_urls(index, addenvs, plat))
+    
+    return rv
+
+def get_upstream_urls(index):
+    # archive or environment file name -> (download url, checksum)
+    rv = {}
+    for name, pkg in index.iteritems():
+        for version, verinfo in pkg.get("versions", {}).iteritems():
+            for key, info in verinfo.iteritems():
+                if not isinstance(info, dict):
+                    continue
+                if info.get("package", None) is not None:
+                    url = "%s/%s%s_%s.%s" % (info["package"], name, version, key, info.get("format", "tgz"))
+                    rv[os.path.basename(url)] = (dropbox_download_url(url), info.get("sha256", None))
+                if info.get("environment", None) is not None:
+                    rv[os.path.basename(info["environment"])] = (dropbox_download_url(info["environment"]), None)
+    return rv
+
+def parse_range(header, size):
+    # single 'bytes=' range -> (start, end) inclusive, None when the header is
+    # missing or not supported and False when it cannot be satisfied
+    m = re.match(r"^bytes=(\d*)-(\d*)$", (header or "").strip())
+    if m is None or (not m.group(1) and not m.group(2)):
+        return None
+    if not m.group(1):
+        length = int(m.group(2))
+        if length == 0:
+            return False
+        return (max(0, size - length), size - 1)
+    start = int(m.group(1))
+    end = (int(m.group(2)) if m.group(2) else size - 1)
+    if start >= size or end < start:
+        return False
+    return (start, min(end, size - 1))
+
+class MirrorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    
+    def __init__(self, address, outdir, index, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MirrorRequestHandler)
+        self.outdir = outdir
+        self.upstream = get_upstream_urls(index)
+        self.verbose = verbose
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+    
+    def fetch(self, filename):
+        # download an archive missing from outdir/downloads, once for all the
+        # clients asking for it
+        if not filename in self.upstream:
+            return False
+        with self.locks_lock:
+            lock = self.locks.setdefault(filename, threading.Lock())
+        with lock:
+            downloaddir = self.outdir + "/downloads"
+            if os.path.isfile(downloaddir + "/" + filename):
+                return True
+            if not os.path.isdir(downloaddir):
+                os.makedirs(downloaddir)
+            url, checksum = self.upstream[filename]
+            key = cache_key(url, checksum)
+            cachedpath = cache_lookup(key)
+            if cachedpath is not None and (not checksum or file_hash(cachedpath) == checksum.lower()):
+                clone_file(cachedpath, downloaddir + "/" + filename)
+                return True
+            path = download(url, downloaddir, checksum=checksum)
+            if path is None:
+                return False
+            cache_store(path, key, verbose=self.verbose)
+            return True
+
+class MirrorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Serves index.json and downloads/<file> from the server output directory
+    # with Range and conditional requests support
+    protocol_version = "HTTP/1.1"
+    
+    def do_HEAD(self):
+        self.send_file(False)
+    
+    def do_GET(self):
+        self.send_file(True)
+    
+    def get_path(self):
+        path = urllib.unquote(self.path.split("?")[0])
+        if path == "/index.json":
+            return self.server.outdir + "/index.json"
+        if not path.startswith("/downloads/"):
+            return None
+        filename = path[11:]
+        if not filename or "/" in filename or "\\" in filename or filename.startswith("."):
+            return None
+        if filename.endswith(".part") or filename.endswith(".tmp"):
+            return None
+        path = self.server.outdir + "/downloads/" + filename
+        if not os.path.isfile(path) and not self.server.fetch(filename):
+            return None
+        return path
+    
+    def send_file(self, body):
+        path = self.get_path()
+        if path is None or not os.path.isfile(path):
+            self.send_error(404, "File not found")
+            return
+        
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            etag = '"%x-%x"' % (int(st.st_mtime), size)
+            
+            if self.headers.getheader("If-None-Match", None) == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            
+            rng = parse_range(self.headers.getheader("Range", None), size)
+            if rng is False:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % size)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            
+            if rng is None:
+                start, end = 0, size - 1
+                self.send_response(200)
+            else:
+                start, end = rng
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+            
+            self.send_header("Content-Type", ("application/json" if path.endswith(".json") else "application/octet-stream"))
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", self.date_time_string(st.st_mtime))
+            self.end_headers()
+            
+            if not body:
+                return
+            
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(remaining, download_chunk_size))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+    
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            log("%s - %s" % (self.client_address[0], format % args))
+
+def serve(index, outdir, address, verbose=False):
+    # address is [host:]port
+    host, _, port = address.rpartition(":")
+    try:
+        server = MirrorServer((host, int(port)), os.path.abspath(outdir), index, verbose=verbose)
+    except Exception, e:
+        print("Failed to start server on %s (%s)" % (address, e))
+        return False
+    
+    print("Serving %s on %s:%d" % (os.path.abspath(outdir), (host or "0.0.0.0"), server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    
+    return True
 
 def help():
     name = os.path.splitext(os.path.basename(__file__))[0]
@@ -591,18 +2154,51 @@ OPTIONS
   -m/--mode MODE             Install mode as a string
                              One of 'env', 'pkg', 'both'
                              Default is 'pkg'
+  -j/--jobs N                Number of concurrent package downloads (1 by default)
+  -p/--pipeline              Extract tar archives while they are downloaded
+  -c/--cache-dir DIR         Shared download cache directory
+                             ('~/.dropboxpm/cache' or $DROPBOXPM_CACHE by default)
+  --cache-size SIZE          Maximum cache size (i.e. 500M, 20G; 50G by default)
+  --no-cache                 Do not use the shared download cache
   -o/--output-directory DIR  Specify output directory ('.' by default)
   -e/--exclude-dependencies  Do not follow dependencies
   -n/--installed             List installed packages
+  --prefetch                 Download packages and/or environments archives
+                             for the --platform list without installing them
+  --platform LIST            Comma separated list of target platforms for
+                             --prefetch and --lock (i.e. linux,darwin,windows;
+                             current platform by default)
+  --serve [HOST:]PORT        Serve the output directory index and downloads over
+                             HTTP, archives missing from downloads are fetched
+                             on first request
+  --mirror URL               Get the index and archives from a dropboxpm server
+                             rather than dropbox ($DROPBOXPM_MIRROR by default)
+  --lock FILE                Resolve ARGUMENTS and write a lockfile pinning the
+                             selected versions and archives checksums
+  --sync FILE                Install and uninstall packages and environments
+                             so that the install matches the lockfile
+  --verify-all               Check downloaded and cached archives against the
+                             index checksums, fetch corrupted ones again
+  --verify                   Check installed packages on the filesystem rather
+                             than trusting the install state (installed.json)
   -l/--list                  List available packages
   -v/--verbose               Verbose output
   -f/--force                 Force index update
+                             (full download, --index-ttl is ignored)
+  --index-ttl SECONDS        Refresh the index once older than SECONDS, with a
+                             conditional request
+                             ($DROPBOXPM_INDEX_TTL or 0 by default, disabled)
   -h/--help                  Show this help
 
 EXAMPLE
   python %s.py -i -m both -v alembic_devel
   python %s.py -u -m pkg -v alembic1.5.7
-""" % (name, name, name))
+  python %s.py --lock workstation.lock -m both arnold maya2017
+  python %s.py --sync workstation.lock -j 4
+  python %s.py --prefetch -m both --platform linux,darwin,windows -j 8 arnold
+  python %s.py --serve 8000 -o /mnt/mirror
+  python %s.py --mirror http://mirror:8000 -i -m both arnold
+""" % (name, name, name, name, name, name, name, name))
 
 if __name__ == "__main__":
     
@@ -615,6 +2211,15 @@ if __name__ == "__main__":
     packages = []
     op = None
     mode = "pkg"
+    jobs = 1
+    verify = False
+    pipeline = False
+    lockfile = None
+    plats = [platform.system().lower()]
+    try:
+        indexttl = int(os.environ.get("DROPBOXPM_INDEX_TTL", "0"))
+    except ValueError:
+        indexttl = 0
     
     i = 0
     n = len(args)
@@ -623,6 +2228,10 @@ if __name__ == "__main__":
             verbose = True
         elif args[i] in ("-f", "--force"):
             force = True
+        elif args[i] == "--verify":
+            verify = True
+        elif args[i] in ("-p", "--pipeline"):
+            pipeline = True
         elif args[i] in ("-e", "--exclude-dependencies"):
             excludedeps = True
         elif args[i] in ("-h", "--help"):
@@ -632,6 +2241,46 @@ if __name__ == "__main__":
             op = "list"
         elif args[i] in ("-n", "--installed"):
             op = "listinstalled"
+        elif args[i] == "--verify-all":
+            op = "verifyall"
+        elif args[i] == "--prefetch":
+            op = "prefetch"
+        elif args[i] == "--serve":
+            op = "serve"
+            i += 1
+            if i >= n:
+                print("Missing required argument for --serve")
+                sys.exit(1)
+            address = args[i]
+            if not re.match(r"^([^:]*:)?\d+$", address):
+                print("Invalid server address '%s'" % address)
+                sys.exit(1)
+        elif args[i] == "--mirror":
+            i += 1
+            if i >= n:
+                print("Missing required argument for --mirror")
+                sys.exit(1)
+            mirror_url = args[i]
+        elif args[i] == "--platform":
+            i += 1
+            if i >= n:
+                print("Missing required argument for --platform")
+                sys.exit(1)
+            plats = []
+            for plat in args[i].lower().split(","):
+                plat = plat.strip()
+                if plat and not plat in plats:
+                    plats.append(plat)
+            if len(plats) == 0:
+                print("Invalid platform list '%s'" % args[i])
+                sys.exit(1)
+        elif args[i] in ("--lock", "--sync"):
+            op = args[i][2:]
+            i += 1
+            if i >= n:
+                print("Missing required argument for %s" % args[i - 1])
+                sys.exit(1)
+            lockfile = args[i]
         elif args[i] in ("-m", "--mode"):
             i += 1
             if i >= n:
@@ -641,6 +2290,46 @@ if __name__ == "__main__":
             if not mode in ("env", "pkg", "both"):
                 print("Invalid mode '%s'" % mode)
                 sys.exit(1)
+        elif args[i] in ("-j", "--jobs"):
+            i += 1
+            if i >= n:
+                print("Missing required argument for -j/--jobs")
+                sys.exit(1)
+            try:
+                jobs = int(args[i])
+                if jobs < 1:
+                    raise ValueError()
+            except ValueError:
+                print("Invalid number of jobs '%s'" % args[i])
+                sys.exit(1)
+        elif args[i] in ("-c", "--cache-dir"):
+            i += 1
+            if i >= n:
+                print("Missing required argument for -c/--cache-dir")
+                sys.exit(1)
+            cache_dir = os.path.abspath(args[i])
+        elif args[i] == "--cache-size":
+            i += 1
+            if i >= n:
+                print("Missing required argument for --cache-size")
+                sys.exit(1)
+            try:
+                cache_size = parse_size(args[i])
+            except ValueError, e:
+                print(e)
+                sys.exit(1)
+        elif args[i] == "--index-ttl":
+            i += 1
+            if i >= n:
+                print("Missing required argument for --index-ttl")
+                sys.exit(1)
+            try:
+                indexttl = int(args[i])
+            except ValueError:
+                print("Invalid index TTL '%s'" % args[i])
+                sys.exit(1)
+        elif args[i] == "--no-cache":
+            cache_dir = None
         elif args[i] in ("-o", "--output-directory"):
             i += 1
             if i >= n:
@@ -668,50 +2357,68 @@ if __name__ == "__main__":
         print("No operation specified.")
         sys.exit(1)
     
-    index = None
-    indexpath = outdir + "/index.json"
-    dl = (force or not os.path.isfile(indexpath))
+    if mirror_url:
+        index_url = mirror_url.rstrip("/") + "/index.json"
     
-    if not dl:
-        try:
-            with open(indexpath, "r") as f:
-                index = json.load(f)
-        except:
-            # Invalid index content -> force download
-            dl = True
+    index = fetch_index(outdir, force=force, ttl=indexttl, verbose=verbose)
+    if index is None:
+        sys.exit(1)
     
-    if dl:
-        try:
-            indexurl = "https://www.dropbox.com/s/eg1wqjr1gdrx2u6/index.json?dl=1"
-            download(indexurl, outdir)
-            with open(indexpath, "r") as f:
-                index = json.load(f)
-        except Exception, e:
-            print("Failed to retrieve index (%s)" % e)
-            sys.exit(1)
+    load_compiled_index(index, outdir + "/index.json", verbose=verbose)
     
     if op == "list":
         list_packages(index)
         sys.exit(0)
     
+    if op == "verifyall":
+        sys.exit(0 if verify_all(index, outdir, jobs=(jobs if jobs > 1 else None), verbose=verbose) else 1)
+    
+    if op == "lock":
+        sys.exit(0 if write_lockfile(index, lockfile, packages, outdir, mode=mode, ignoredeps=excludedeps, verbose=verbose, plats=plats) else 1)
+    
+    if op == "serve":
+        sys.exit(0 if serve(index, outdir, address, verbose=verbose) else 1)
+    
+    if op == "prefetch":
+        sys.exit(0 if prefetch_archives(index, packages, outdir, plats, mode=mode, ignoredeps=excludedeps, force=force, verbose=verbose, jobs=jobs) else 1)
+    
+    if op == "sync":
+        sys.exit(0 if sync_lockfile(index, lockfile, outdir, jobs=jobs, verbose=verbose) else 1)
+    
     if op == "listinstalled":
         if mode in ("both", "pkg"):
             print("PACKAGES")
-            list_installed_packages(index, outdir, "  ")
+            list_installed_packages(index, outdir, "  ", verify=verify)
         if mode in ("both", "env"):
             print("ENVIRONMENTS")
-            list_installed_environments(index, outdir, "  ")
+            list_installed_environments(index, outdir, "  ", verify=verify)
         sys.exit(0)
     
+    # resolve everything first so that nothing is (un)installed when any of
+    # the requests cannot be satisfied
+    pkgurls = None
+    envurls = None
+    if mode in ("both", "pkg"):
+        pkgurls = build_package_urls(index, packages, outdir, excludedeps, verbose)
+        if pkgurls is None:
+            sys.exit(1)
+    if mode in ("both", "env"):
+        envurls = build_environment_urls(index, packages, excludedeps, verbose)
+        if envurls is None:
+            sys.exit(1)
+    
     if op in ("uninstall", "reinstall"):
         if mode in ("both", "pkg"):
-            uninstall_packages(index, packages, outdir, ignoredeps=excludedeps, force=(force or op == "reinstall"), verbose=verbose)
+            uninstall_packages(index, packages, outdir, ignoredeps=excludedeps, force=(force or op == "reinstall"), verbose=verbose, urls=pkgurls)
         if mode in ("both", "env"):
-            uninstall_environments(index, packages, outdir, ignoredeps=excludedeps, force=(force or op == "reinstall"), verbose=verbose)
+            uninstall_environments(index, packages, outdir, ignoredeps=excludedeps, force=(force or op == "reinstall"), verbose=verbose, urls=envurls)
     
     if op in ("install", "reinstall"):
+        failed = False
         if mode in ("both", "pkg"):
-            install_packages(index, packages, outdir, ignoredeps=excludedeps, force=force, verbose=verbose)
+            failed = not install_packages(index, packages, outdir, ignoredeps=excludedeps, force=force, verbose=verbose, jobs=jobs, verify=verify, pipeline=pipeline, urls=pkgurls)
         if mode in ("both", "env"):
-            install_environments(index, packages, outdir, ignoredeps=excludedeps, force=force, verbose=verbose)
+            install_environments(index, packages, outdir, ignoredeps=excludedeps, force=force, verbose=verbose, verify=verify, urls=envurls)
+        if failed:
+            sys.exit(1)
     
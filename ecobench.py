@@ -0,0 +1,300 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import platform
+import itertools
+
+import ecoenv
+
+
+# tool lists whose versions are combined by default
+default_combinations = [["MtoA", "maya", "arnold"],
+                        ["HtoA", "houdini", "arnold"],
+                        ["MtoAShaders", "maya", "arnold"],
+                        ["HtoAShaders", "houdini", "arnold"]]
+
+def timed(func, *args, **kwargs):
+    # (result or exception, elapsed seconds)
+    start = time.time()
+    try:
+        rv = func(*args, **kwargs)
+    except Exception, e:
+        rv = e
+    return (rv, time.time() - start)
+
+def get_stats(timings):
+    # timings in seconds -> milliseconds statistics
+    if len(timings) == 0:
+        return {"count": 0}
+    timings = sorted(timings)
+    n = len(timings)
+    return {"count": n,
+            "total": 1000.0 * sum(timings),
+            "mean": 1000.0 * sum(timings) / n,
+            "median": 1000.0 * timings[n / 2],
+            "p95": 1000.0 * timings[min(n - 1, int(0.95 * n))],
+            "max": 1000.0 * timings[-1]}
+
+def bench_parse(paths, repeat=1):
+    timings = []
+    for path in paths:
+        for i in xrange(repeat):
+            _, t = timed(ecoenv.load_env_file, path)
+            timings.append(t)
+    return get_stats(timings)
+
+def bench_snapshot(dirs, repeat=1):
+    # cold compilation to a temporary snapshot then up to date loads
+    fd, path = tempfile.mkstemp(suffix=".snapshot")
+    os.close(fd)
+    try:
+        cold = []
+        warm = []
+        for i in xrange(repeat):
+            os.remove(path)
+            snapshot, t = timed(ecoenv.compile_snapshot, dirs, path)
+            cold.append(t)
+            _, t = timed(ecoenv.compile_snapshot, dirs, path)
+            warm.append(t)
+        return (snapshot, get_stats(cold), get_stats(warm))
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+def bench_combinations(snapshot, combinations, plat, repeat=1, verbose=False):
+    # Resolve every version combination of each tool list, requesting exact
+    # versions, and time the resolution and the environment expansion
+    tools = ecoenv.get_tool_envs(snapshot, plat)
+    index = snapshot["index"]
+    
+    resolve = []
+    expand = []
+    results = {}
+    
+    for combination in combinations:
+        names = [x for x in combination if x in tools]
+        if len(names) != len(combination):
+            print("Skip %s (%s not available for %s)" % (" x ".join(combination), ", ".join([x for x in combination if not x in tools]), plat))
+            continue
+        
+        key = " x ".join(names)
+        results[key] = {"count": 0, "resolved": 0, "failed": 0}
+        
+        for versions in itertools.product(*[sorted(tools[x].keys(), key=ecoenv.version_key) for x in names]):
+            requests = ["%s%s" % x for x in zip(names, versions)]
+            results[key]["count"] += 1
+            
+            for i in xrange(repeat):
+                selected, t = timed(ecoenv.resolve_tools, tools, requests, index, plat)
+                resolve.append(t)
+                if isinstance(selected, Exception):
+                    break
+                _, t = timed(ecoenv.build_environment, tools, selected, plat)
+                expand.append(t)
+            
+            if isinstance(selected, Exception):
+                results[key]["failed"] += 1
+                if verbose:
+                    print("%s: %s" % (", ".join(requests), selected))
+            else:
+                results[key]["resolved"] += 1
+    
+    return (get_stats(resolve), get_stats(expand), results)
+
+def requires_graph(snapshot, plat=None):
+    # Tool versions and their requirements as
+    #   {"platform": plat,
+    #    "nodes": [{"id", "tool", "version", "path", "platforms"}, ...],
+    #    "edges": [{"from", "tool", "requirement", "matches": [ids]}, ...]}
+    index = snapshot["index"]
+    nodes = []
+    edges = []
+    
+    for tool in sorted(index.keys()):
+        for entry in index[tool]:
+            if plat is not None and not plat in entry[4]:
+                continue
+            nodeid = "%s %s" % (tool, entry[2])
+            if any(x["id"] == nodeid for x in nodes):
+                # same version defined in a later ECO_ENV directory
+                continue
+            nodes.append({"id": nodeid, "tool": tool, "version": entry[2], "path": entry[3], "platforms": list(entry[4])})
+            
+            for requirement in snapshot["files"][entry[3]]["env"].get("requires", []):
+                name, spec = ecoenv.parse_requirement(index, requirement)
+                entries = index.get(name, [])
+                lo, hi = ecoenv.find_versions(entries, [spec])
+                matches = []
+                for x in entries[lo:hi]:
+                    if (plat is None or plat in x[4]) and not "%s %s" % (name, x[2]) in matches:
+                        matches.append("%s %s" % (name, x[2]))
+                edges.append({"from": nodeid, "tool": name, "requirement": requirement, "matches": matches})
+    
+    return {"platform": plat, "nodes": nodes, "edges": edges}
+
+def dot_id(s):
+    return '"%s"' % s.replace("\\", "\\\\").replace('"', '\\"')
+
+def graph_to_dot(graph):
+    # one cluster per tool, requirement edges point to the required tool
+    # cluster and are labelled with the requirement
+    lines = ["digraph requires {",
+             "   compound=true;",
+             "   rankdir=LR;",
+             "   node [shape=box, fontsize=10];"]
+    
+    tools = []
+    for node in graph["nodes"]:
+        if not node["tool"] in tools:
+            tools.append(node["tool"])
+    
+    first = {}
+    for i, tool in enumerate(tools):
+        lines.append("   subgraph cluster_%d {" % i)
+        lines.append("      label=%s;" % dot_id(tool))
+        for node in graph["nodes"]:
+            if node["tool"] == tool:
+                first.setdefault(tool, node["id"])
+                lines.append("      %s [label=%s];" % (dot_id(node["id"]), dot_id(node["version"] or tool)))
+        lines.append("   }")
+    
+    for edge in graph["edges"]:
+        if edge["tool"] in first:
+            lines.append("   %s -> %s [lhead=cluster_%d, label=%s];" % (dot_id(edge["from"]), dot_id(first[edge["tool"]]), tools.index(edge["tool"]), dot_id(edge["requirement"])))
+        else:
+            lines.append("   %s -> %s [style=dashed, color=red];" % (dot_id(edge["from"]), dot_id(edge["requirement"])))
+    
+    lines.append("}")
+    
+    return "\n".join(lines) + "\n"
+
+def print_stats(name, stats):
+    if stats["count"] == 0:
+        print("  %-14s -" % name)
+    else:
+        print("  %-14s %6d  total %9.2fms  mean %7.3fms  median %7.3fms  p95 %7.3fms  max %7.3fms" % (name, stats["count"], stats["total"], stats["mean"], stats["median"], stats["p95"], stats["max"]))
+
+def help():
+    name = os.path.splitext(os.path.basename(__file__))[0]
+    
+    print("""NAME
+  ecobench - Ecosystem environment files benchmark
+
+SYNOPSIS
+  %s [-c/--combination LIST] [-p/--platform PLATFORM] [-n/--repeat N] [-o/--output FILE] [--dot FILE] [--graph FILE] [-v/--verbose] [-h/--help] [DIRECTORIES]
+
+ARGUMENTS
+  List of directories containing .env files
+  ($ECO_ENV or the eco launcher ECO_ENV by default)
+
+OPTIONS
+  -c/--combination LIST      Comma separated list of tools whose versions are
+                             all combined and resolved, can be repeated
+                             (MtoA,maya,arnold HtoA,houdini,arnold
+                             MtoAShaders,maya,arnold HtoAShaders,houdini,arnold
+                             by default)
+  -p/--platform PLATFORM     Resolve for PLATFORM (current platform by default)
+  -n/--repeat N              Repeat every measure N times (1 by default)
+  -o/--output FILE           Write timings and counts as JSON to FILE
+  --dot FILE                 Export the requires graph in DOT format
+  --graph FILE               Export the requires graph as JSON
+  -v/--verbose               Verbose output
+  -h/--help                  Show this help
+
+EXAMPLE
+  python %s.py -n 5 -o bench.json
+  python %s.py -c MtoA,maya,arnold --dot requires.dot
+""" % (name, name, name))
+
+if __name__ == "__main__":
+    
+    args = sys.argv[1:]
+    
+    verbose = False
+    dirs = []
+    combinations = []
+    plat = platform.system().lower()
+    repeat = 1
+    output = None
+    dotpath = None
+    graphpath = None
+    
+    i = 0
+    n = len(args)
+    while i < n:
+        if args[i] in ("-v", "--verbose"):
+            verbose = True
+        elif args[i] in ("-h", "--help"):
+            help()
+            sys.exit(0)
+        elif args[i] in ("-c", "--combination", "-p", "--platform", "-n", "--repeat", "-o", "--output", "--dot", "--graph"):
+            i += 1
+            if i >= n:
+                print("Missing required argument for %s" % args[i - 1])
+                sys.exit(1)
+            if args[i - 1] in ("-c", "--combination"):
+                combinations.append([x.strip() for x in args[i].split(",") if x.strip()])
+            elif args[i - 1] in ("-p", "--platform"):
+                plat = args[i].lower()
+                if not plat in ecoenv.platforms:
+                    print("Invalid platform '%s'" % args[i])
+                    sys.exit(1)
+            elif args[i - 1] in ("-n", "--repeat"):
+                try:
+                    repeat = int(args[i])
+                    if repeat < 1:
+                        raise ValueError()
+                except ValueError:
+                    print("Invalid repeat count '%s'" % args[i])
+                    sys.exit(1)
+            elif args[i - 1] in ("-o", "--output"):
+                output = args[i]
+            elif args[i - 1] == "--dot":
+                dotpath = args[i]
+            else:
+                graphpath = args[i]
+        else:
+            dirs.append(os.path.abspath(args[i]))
+        i += 1
+    
+    if not dirs:
+        dirs = ecoenv.get_env_dirs()
+    if not combinations:
+        combinations = default_combinations
+    
+    paths = ecoenv.list_env_files(dirs)
+    
+    print("Benchmark %d file(s) for %s" % (len(paths), plat))
+    
+    parse = bench_parse(paths, repeat)
+    snapshot, cold, warm = bench_snapshot(dirs, repeat)
+    resolve, expand, results = bench_combinations(snapshot, combinations, plat, repeat, verbose)
+    
+    print("TIMINGS")
+    print_stats("parse", parse)
+    print_stats("snapshot cold", cold)
+    print_stats("snapshot warm", warm)
+    print_stats("resolve", resolve)
+    print_stats("expand", expand)
+    print("COMBINATIONS")
+    for key in sorted(results.keys()):
+        print("  %s: %d resolved, %d failed" % (key, results[key]["resolved"], results[key]["failed"]))
+    
+    if output:
+        with open(output, "w") as f:
+            json.dump({"platform": plat,
+                       "files": len(paths),
+                       "repeat": repeat,
+                       "timings": {"parse": parse, "snapshot_cold": cold, "snapshot_warm": warm, "resolve": resolve, "expand": expand},
+                       "combinations": results}, f, indent=1, sort_keys=True)
+    
+    if dotpath or graphpath:
+        graph = requires_graph(snapshot, plat)
+        if dotpath:
+            with open(dotpath, "w") as f:
+                f.write(graph_to_dot(graph))
+        if graphpath:
+            with open(graphpath, "w") as f:
+                json.dump(graph, f, indent=1, sort_keys=True)
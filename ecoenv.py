@@ -0,0 +1,1018 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import bisect
+import cPickle
+import hashlib
+import platform
+import subprocess
+import multiprocessing
+from versions import version_key
+
+
+snapshot_format = 6
+resolve_cache_format = 2
+deploy_root = os.path.dirname(os.path.abspath(__file__))
+snapshot_path = os.environ.get("ECO_ENV_SNAPSHOT", deploy_root + "/.ecoenv.snapshot")
+resolve_cache_path = os.environ.get("ECO_ENV_CACHE", deploy_root + "/.ecoenv.cache")
+resolve_cache_size = 64
+platforms = ("darwin", "linux", "windows")
+
+def log(msg):
+    # Diagnostics go to stderr, stdout is reserved for the output of the
+    # requested operation (i.e. eval "$(ecoenv.py -t ... -e)")
+    sys.stderr.write(msg + "\n")
+
+def read_launcher_dirs(launcher=None):
+    # ECO_ENV directories as exported by the eco launcher script
+    if launcher is None:
+        launcher = deploy_root + "/eco"
+    
+    root = os.path.dirname(os.path.abspath(launcher))
+    
+    with open(launcher, "r") as f:
+        for line in f:
+            m = re.match(r"^\s*export\s+ECO_ENV=(.*)$", line.strip())
+            if m is None:
+                continue
+            value = m.group(1).strip().strip("\"'")
+            value = value.replace("${DEPLOY_ROOT}", root).replace("$DEPLOY_ROOT", root)
+            return [x for x in value.split(":") if x]
+    
+    return []
+
+def get_env_dirs(launcher=None):
+    # ECO_ENV from the environment first, then from the launcher
+    if os.environ.get("ECO_ENV", ""):
+        dirs = [x for x in os.environ["ECO_ENV"].split(os.pathsep) if x]
+    else:
+        dirs = read_launcher_dirs(launcher)
+    
+    rv = []
+    for d in dirs:
+        d = os.path.abspath(d)
+        if not d in rv:
+            rv.append(d)
+    
+    return rv
+
+def list_env_files(dirs):
+    # .env files directly in the given directories, in ECO_ENV order
+    rv = []
+    for d in dirs:
+        rv.extend(sorted(glob.glob(d + "/*.env")))
+    return rv
+
+def file_stamp(path):
+    st = os.stat(path)
+    return (st.st_mtime, st.st_size)
+
+# Ecosystem (the eco launcher) only knows plain @ tokens, the version
+# components are derived with eval('"@version".split(".")[N]') there
+legacy_version_pattern = r"""eval\(\s*'"@version"\.split\("\."\)\[(-?\d+)\]'\s*\)"""
+
+legacy_version_exp = re.compile(legacy_version_pattern)
+
+literal_exp = re.compile(r"""("(?:[^"\\\n]|\\.)*")|'((?:[^'\\\n]|\\.)*)'|(?:\#|//)[^\n]*|"""
+                         r"""\b(True|False|None)\b|,((?:\s|(?:\#|//)[^\n]*)*[}\]])|""" + legacy_version_pattern)
+
+literal_names = {"True": "true", "False": "false", "None": "null"}
+
+def literal_to_json(m):
+    if m.group(1) is not None:
+        return m.group(1)
+    if m.group(2) is not None:
+        return json.dumps(m.group(2).decode("string_escape"))
+    if m.group(3) is not None:
+        return literal_names[m.group(3)]
+    if m.group(4) is not None:
+        # trailing comma
+        return re.sub(r"(?:\#|//)[^\n]*", "", m.group(4))
+    if m.group(5) is not None:
+        # legacy version component expression, same as "@version[N]"
+        return '"@version[%s]"' % m.group(5)
+    # comment, new lines are kept for error messages
+    return ""
+
+def parse_literal(content):
+    # Parse a python/JSON like literal: dictionaries, lists, strings (single or
+    # double quoted), numbers, True/False/None (or true/false/null), comments
+    # ('#' or '//') and trailing commas
+    # eval('"@version".split(".")[N]') is read as "@version[N]", any other
+    # expression is an error
+    # The content is converted to JSON, nothing is evaluated
+    try:
+        return json.loads(literal_exp.sub(literal_to_json, content))
+    except ValueError, e:
+        raise ValueError("Invalid literal (%s)" % e)
+
+def load_env_file(path):
+    # .env files are dictionary literals, parsed without evaluation
+    # Returns (env dictionary, content sha1)
+    with open(path, "r") as f:
+        content = f.read()
+    try:
+        env = parse_literal(content)
+    except ValueError, e:
+        if "eval(" in content:
+            raise ValueError("%s, only eval('\"@version\".split(\".\")[N]') is supported" % e)
+        raise
+    if not isinstance(env, dict):
+        raise ValueError("Not a dictionary")
+    return (env, hashlib.sha1(content).hexdigest())
+
+def migrate_env_file(path, dryrun=False):
+    # Replace eval('"@version".split(".")[N]') expressions with the
+    # equivalent "@version[N]" transform, returns True if the file changed
+    # Migrated files can only be used through ecoenv, not the eco launcher
+    with open(path, "r") as f:
+        content = f.read()
+    migrated = legacy_version_exp.sub(lambda m: '"@version[%s]"' % m.group(1), content)
+    if migrated == content:
+        return False
+    if not dryrun:
+        with open(path, "w") as f:
+            f.write(migrated)
+    return True
+
+def read_snapshot(path=None):
+    if path is None:
+        path = snapshot_path
+    try:
+        with open(path, "rb") as f:
+            snapshot = cPickle.load(f)
+        if snapshot.get("format", None) != snapshot_format:
+            return None
+        return snapshot
+    except:
+        # missing or unreadable snapshot
+        return None
+
+def write_snapshot(snapshot, path=None):
+    if path is None:
+        path = snapshot_path
+    tmppath = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmppath, "wb") as f:
+        cPickle.dump(snapshot, f, cPickle.HIGHEST_PROTOCOL)
+    if os.path.exists(path) and sys.platform == "win32":
+        os.remove(path)
+    os.rename(tmppath, path)
+
+def compile_snapshot(dirs=None, path=None, force=False, verbose=False):
+    # Parse all .env files in dirs into a single snapshot file
+    # The snapshot records every file modification time and size, only files
+    # whose stamp changed are parsed again and nothing is written when the
+    # snapshot is up to date
+    # Returns the snapshot dictionary:
+    #   {"format": N, "dirs": [...], "files": {path: {"stamp": (mtime, size),
+    #                                                 "hash": content sha1,
+    #                                                 "env": dict or None,
+    #                                                 "error": str or None}},
+    #    "index": version index (see update_version_index)}
+    if dirs is None:
+        dirs = get_env_dirs()
+    
+    old = (None if force else read_snapshot(path))
+    if old is None or old.get("dirs", None) != list(dirs):
+        # the version index depends on the directories order
+        old = {"files": {}, "index": {}}
+    
+    snapshot = {"format": snapshot_format, "dirs": list(dirs), "files": {}}
+    parsed = 0
+    changed = []
+    
+    for envpath in list_env_files(dirs):
+        try:
+            stamp = file_stamp(envpath)
+        except OSError:
+            continue
+        
+        entry = old["files"].get(envpath, None)
+        if entry is None or entry["stamp"] != stamp:
+            parsed += 1
+            if verbose:
+                log("Parse %s" % envpath)
+            entry = {"stamp": stamp, "hash": None, "env": None, "error": None}
+            try:
+                entry["env"], entry["hash"] = load_env_file(envpath)
+            except Exception, e:
+                entry["error"] = str(e)
+                log("Failed to parse %s (%s)" % (envpath, e))
+            changed.append(envpath)
+        
+        snapshot["files"][envpath] = entry
+    
+    removed = [x for x in old["files"].iterkeys() if not x in snapshot["files"]]
+    snapshot["index"] = update_version_index(old["index"], snapshot, removed + changed, changed)
+    
+    if parsed > 0 or removed:
+        write_snapshot(snapshot, path)
+        if verbose:
+            log("Wrote %s (%d file(s), %d parsed)" % ((path or snapshot_path), len(snapshot["files"]), parsed))
+    elif verbose:
+        log("%s is up to date" % (path or snapshot_path))
+    
+    return snapshot
+
+def filename_version(path):
+    # <tool>_<major>_<minor>...env -> (tool, 'major.minor...')
+    m = re.match(r"^(.*?)((?:_\d+)*)$", os.path.splitext(os.path.basename(path))[0])
+    return (m.group(1), m.group(2)[1:].replace("_", "."))
+
+def env_version(envpath, env):
+    # Version of a tool env file: its 'version' field as a string, or the
+    # version in its name when the field is missing or empty
+    # Used everywhere a tool version is needed so that the index, the tool
+    # tables and the token substitutions agree
+    version = env.get("version", None)
+    if version is None or version == "":
+        return filename_version(envpath)[1]
+    return str(version)
+
+def update_version_index(index, snapshot, removed, added):
+    # Per tool version lists sorted by version_key, updated in place
+    #   {tool: [(version key, -directory order, version, path, platforms), ...]}
+    # removed and added are lists of file paths, versions are taken from the
+    # files 'version' field and from their names otherwise
+    # For a given version, files from the first ECO_ENV directories come last
+    if removed:
+        removed = set(removed)
+        for tool in index.keys():
+            index[tool] = [x for x in index[tool] if not x[3] in removed]
+            if len(index[tool]) == 0:
+                del(index[tool])
+    
+    for envpath in added:
+        env = snapshot["files"][envpath]["env"]
+        if env is None or not env.get("tool", None):
+            continue
+        version = env_version(envpath, env)
+        order = snapshot["dirs"].index(os.path.dirname(envpath))
+        bisect.insort(index.setdefault(env["tool"], []), (version_key(version), -order, version, envpath, tuple(env.get("platforms", platforms))))
+    
+    return index
+
+def find_versions(entries, specs):
+    # [lo, hi) range of a version index list matching all the specs, using
+    # binary searches only (see version_matches)
+    lo, hi = 0, len(entries)
+    for spec in specs:
+        if spec is None:
+            continue
+        if spec.endswith("+"):
+            lo = max(lo, bisect.bisect_left(entries, (version_key(spec[:-1]),)))
+        else:
+            # all keys starting with the spec key: (2,) sorts after any
+            # version key component
+            key = version_key(spec)
+            lo = max(lo, bisect.bisect_left(entries, (key,)))
+            hi = min(hi, bisect.bisect_left(entries, (key + ((2,),),)))
+    return (lo, max(lo, hi))
+
+def find_latest_version(entries, specs, plat=None):
+    # latest index entry matching the specs and available for plat
+    lo, hi = find_versions(entries, specs)
+    for i in xrange(hi - 1, lo - 1, -1):
+        if plat is None or plat in entries[i][4]:
+            return entries[i]
+    return None
+
+def load_environments(dirs=None, path=None):
+    # {env file path: env dictionary} for all valid files in dirs, using and
+    # refreshing the snapshot
+    snapshot = compile_snapshot(dirs, path)
+    return dict([(k, v["env"]) for k, v in snapshot["files"].iteritems() if v["env"] is not None])
+
+def version_matches(version, spec):
+    # spec is None (any version), 'X+' (X or newer) or 'X' (X or X.*, any
+    # version which key starts with X key, i.e. X.1, Xb1)
+    if spec is None:
+        return True
+    if spec.endswith("+"):
+        return version_key(version) >= version_key(spec[:-1])
+    key = version_key(spec)
+    return (version_key(version)[:len(key)] == key)
+
+snapshot_tools = {}
+
+def get_tools(snapshot, plat=None):
+    # tool tables are memoized per snapshot object and platform
+    entry = snapshot_tools.get((id(snapshot), plat), None)
+    if entry is None or entry[0] is not snapshot:
+        entry = (snapshot, build_tools(snapshot, plat))
+        snapshot_tools[(id(snapshot), plat)] = entry
+    return entry[1]
+
+def build_tools(snapshot, plat=None):
+    # {tool: {version: env file path}} from the snapshot
+    # The first file found in ECO_ENV order wins for a given tool version
+    tools = {}
+    for d in snapshot["dirs"]:
+        for envpath in sorted(snapshot["files"].keys()):
+            if os.path.dirname(envpath) != d:
+                continue
+            env = snapshot["files"][envpath]["env"]
+            if env is None or not env.get("tool", None):
+                continue
+            if plat is not None and not plat in env.get("platforms", platforms):
+                continue
+            tools.setdefault(env["tool"], {}).setdefault(env_version(envpath, env), envpath)
+    return tools
+
+def parse_requirement(tools, requirement):
+    # '<tool>(<version>)(+)' -> (tool, version spec or None)
+    # The longest tool name followed by a valid version wins
+    requirement = requirement.strip()
+    best = None
+    for name in tools.iterkeys():
+        if not requirement.startswith(name):
+            continue
+        rest = requirement[len(name):]
+        if re.match(r"^(\d[\w.]*\+?)?$", rest) and (best is None or len(name) > len(best)):
+            best = name
+    if best is None:
+        return (requirement, None)
+    rest = requirement[len(best):]
+    return (best, (rest if rest else None))
+
+def resolve_tools(tools, requests, index=None, plat=None):
+    # Select one version per tool for the requested tools and their requires
+    # Every tool gets the latest version matching all the requirements put on
+    # it by the requests and the currently selected tools
+    # Versions are looked up in the version index when given (tools must then
+    # only hold plat tools, see get_tools)
+    # Returns a list of (tool, version) tuples, requirements first
+    constraints = {}
+    roots = []
+    
+    for request in requests:
+        name, spec = parse_requirement(tools, request)
+        if not name in tools:
+            raise ValueError("Unknown tool '%s'" % request)
+        constraints.setdefault(name, []).append((None, spec))
+        if not name in roots:
+            roots.append(name)
+    
+    selected = {}
+    requires = {}
+    queue = list(roots)
+    iterations = 0
+    
+    while queue:
+        iterations += 1
+        if iterations > 100 * max(1, len(tools)):
+            raise ValueError("Could not find a consistent set of versions for %s" % ", ".join(requests))
+        
+        name = queue.pop(0)
+        specs = [x[1] for x in constraints.get(name, [])]
+        
+        version = None
+        if index is not None:
+            entry = find_latest_version(index.get(name, []), specs, plat)
+            if entry is not None:
+                version = entry[2]
+        else:
+            for ver in sorted(tools[name].keys(), key=version_key, reverse=True):
+                if all(version_matches(ver, x) for x in specs):
+                    version = ver
+                    break
+        
+        if version is None:
+            raise ValueError("No %s version matching %s" % (name, ", ".join([x for x in specs if x]) or "any version"))
+        
+        previous = selected.get(name, None)
+        if previous == version:
+            continue
+        
+        if previous is not None:
+            # requirements of the previously selected version are void
+            for depname in constraints.keys():
+                lst = [x for x in constraints[depname] if x[0] != (name, previous)]
+                if len(lst) != len(constraints[depname]):
+                    constraints[depname] = lst
+                    if not depname in queue:
+                        queue.append(depname)
+        
+        selected[name] = version
+        requires[name] = []
+        
+        for requirement in tools[name][version][1].get("requires", []):
+            depname, spec = parse_requirement(tools, requirement)
+            if not depname in tools:
+                raise ValueError("%s %s requires unknown tool '%s'" % (name, version, requirement))
+            requires[name].append(depname)
+            constraints.setdefault(depname, []).append(((name, version), spec))
+            if not depname in queue:
+                queue.append(depname)
+    
+    # requirements first, requests order otherwise
+    order = []
+    def visit(name, stack):
+        if name in order or name in stack or not name in selected:
+            return
+        for depname in requires.get(name, []):
+            visit(depname, stack + [name])
+        order.append(name)
+    
+    for name in roots:
+        visit(name, [])
+    
+    return [(x, selected[x]) for x in order]
+
+def version_component(version, m):
+    # @version[N] or @version[N:M], components are joined with '.'
+    parts = version.split(".")
+    if m.group(1) is not None:
+        index = int(m.group(1))
+        return (parts[index] if -len(parts) <= index < len(parts) else "")
+    start = (int(m.group(2)) if m.group(2) else None)
+    end = (int(m.group(3)) if m.group(3) else None)
+    return ".".join(parts[start:end])
+
+def substitute_tokens(value, envpath, env, plat):
+    version = env_version(envpath, env)
+    value = re.sub(r"@version\[(?:(-?\d+)|(-?\d*):(-?\d*))\]", lambda m: version_component(version, m), value)
+    for token, repl in (("@path", os.path.dirname(envpath).replace("\\", "/")),
+                        ("@tool", env.get("tool", "")),
+                        ("@version", version),
+                        ("@platform", plat)):
+        value = value.replace(token, repl)
+    return value
+
+def get_tool_variables(envpath, env, plat, enabled):
+    # [(variable, values, strict, prepend), ...] defined by a tool for plat
+    # Optional sections are used when the tool they are named after is
+    # enabled
+    sections = [env.get("environment", {})]
+    for name, section in sorted(env.get("optional", {}).iteritems()):
+        if name in enabled:
+            sections.append(section)
+    
+    rv = []
+    for section in sections:
+        for name, value in sorted(section.iteritems()):
+            strict, prepend = False, False
+            if isinstance(value, dict):
+                strict = bool(value.get("strict", False))
+                prepend = bool(value.get("prepend", False))
+                value = (value[plat] if plat in value else value.get("common", None))
+            if value is None:
+                values = []
+            elif isinstance(value, (list, tuple)):
+                values = list(value)
+            else:
+                values = [value]
+            rv.append((name, [substitute_tokens(str(x), envpath, env, plat) for x in values], strict, prepend))
+    return rv
+
+def expand_variables(values):
+    # Expand ${VAR} references to the other variables, references to
+    # variables defined outside of the tools are kept as is
+    rv = {}
+    
+    def expand(name, stack):
+        if name in rv:
+            return rv[name]
+        if name in stack:
+            return "${%s}" % name
+        def repl(m):
+            if m.group(1) in values and m.group(1) != name:
+                return expand(m.group(1), stack + [name])
+            return m.group(0)
+        rv[name] = re.sub(r"\$\{([A-Za-z_][A-Za-z0-9_]*)\}", repl, values[name])
+        return rv[name]
+    
+    for name in values.iterkeys():
+        expand(name, [])
+    
+    return rv
+
+def get_tool_envs(snapshot, plat):
+    # {tool: {version: (env file path, env dictionary)}} for plat
+    tools = {}
+    for name, versions in get_tools(snapshot, plat).iteritems():
+        tools[name] = dict([(k, (v, snapshot["files"][v]["env"])) for k, v in versions.iteritems()])
+    return tools
+
+def build_environment(tools, selected, plat):
+    # Merge and expand the variables of the selected (tool, version) list
+    # Returns {variable: (strict, value)}
+    enabled = set([x[0] for x in selected])
+    
+    pathsep = (";" if plat == "windows" else ":")
+    variables = {}
+    
+    for name, version in selected:
+        envpath, env = tools[name][version]
+        for var, values, strict, prepend in get_tool_variables(envpath, env, plat, enabled):
+            values = [x for x in values if x]
+            if not values and not strict:
+                continue
+            if not var in variables:
+                variables[var] = [False, []]
+            variables[var][0] = (variables[var][0] or strict)
+            if prepend:
+                variables[var][1][0:0] = values
+            else:
+                variables[var][1].extend([x for x in values if not x in variables[var][1]])
+    
+    values = expand_variables(dict([(k, pathsep.join(v[1])) for k, v in variables.iteritems()]))
+    
+    return dict([(k, (variables[k][0], values[k])) for k in variables.iterkeys()])
+
+def resolve_environment(snapshot, requests, plat=None):
+    # Resolve the requested tools environment for plat
+    # Returns {"tools": [(tool, version), ...],
+    #          "env": {variable: (strict, value)},
+    #          "files": {env file path: content sha1},
+    #          "versions": {tool: [versions]}}
+    # Values of non strict variables do not include the inherited environment
+    # (see apply_environment)
+    if plat is None:
+        plat = platform.system().lower()
+    
+    tools = get_tool_envs(snapshot, plat)
+    selected = resolve_tools(tools, requests, snapshot["index"], plat)
+    
+    return {"tools": selected,
+            "env": build_environment(tools, selected, plat),
+            "files": dict([(tools[x][y][0], snapshot["files"][tools[x][y][0]]["hash"]) for x, y in selected]),
+            "versions": dict([(x, sorted(tools[x].keys())) for x, _ in selected])}
+
+def apply_environment(resolved, base=None, plat=None):
+    # Final variable values for a resolved environment on top of base (the
+    # current environment by default), None for variables to unset
+    if base is None:
+        base = os.environ
+    if plat is None:
+        plat = platform.system().lower()
+    pathsep = (";" if plat == "windows" else ":")
+    
+    rv = {}
+    for name, (strict, value) in resolved["env"].iteritems():
+        if not strict and base.get(name, ""):
+            value = (value + pathsep + base[name] if value else base[name])
+        value = re.sub(r"\$\{([A-Za-z_][A-Za-z0-9_]*)\}", lambda m: base.get(m.group(1), ""), value)
+        rv[name] = (value if (value or not strict) else None)
+    return rv
+
+def read_resolve_cache(path=None):
+    if path is None:
+        path = resolve_cache_path
+    try:
+        with open(path, "rb") as f:
+            cache = cPickle.load(f)
+        if cache.get("format", None) != resolve_cache_format:
+            return None
+        return cache
+    except:
+        return None
+
+def resolve_cache_key(requests, plat):
+    return hashlib.sha1("%s|%s" % (plat, ",".join(sorted(set([x.strip() for x in requests]))))).hexdigest()
+
+def resolve_cache_valid(entry, snapshot):
+    # resolved environments are valid as long as the files they use did not
+    # change and no version of the tools involved was added or removed
+    files = snapshot["files"]
+    for envpath, h in entry["files"].iteritems():
+        if not envpath in files or files[envpath]["hash"] != h:
+            return False
+    tools = get_tools(snapshot, entry["platform"])
+    for name, versions in entry["versions"].iteritems():
+        if sorted(tools.get(name, {}).keys()) != versions:
+            return False
+    return True
+
+# in process resolved environments, key -> cache entry
+resolved_environments = {}
+
+def get_resolved_environment(snapshot, requests, plat=None, usecache=True, verbose=False):
+    # Memoized resolve_environment, backed by an on disk LRU cache of at most
+    # resolve_cache_size entries
+    if plat is None:
+        plat = platform.system().lower()
+    
+    key = resolve_cache_key(requests, plat)
+    
+    entry = resolved_environments.get(key, None)
+    if entry is not None and resolve_cache_valid(entry, snapshot):
+        entry["used"] = time.time()
+        return entry
+    
+    cache = None
+    if usecache:
+        cache = read_resolve_cache()
+        if cache is None:
+            cache = {"format": resolve_cache_format, "entries": {}}
+        entry = cache["entries"].get(key, None)
+        if entry is not None and not resolve_cache_valid(entry, snapshot):
+            if verbose:
+                log("Cached environment for %s is out of date" % ", ".join(requests))
+            entry = None
+        elif entry is not None and verbose:
+            log("Use cached environment for %s" % ", ".join(requests))
+    else:
+        entry = None
+    
+    if entry is None:
+        entry = resolve_environment(snapshot, requests, plat)
+        entry["platform"] = plat
+        entry["requests"] = list(requests)
+    
+    entry["used"] = time.time()
+    resolved_environments[key] = entry
+    
+    if cache is not None:
+        cache["entries"][key] = entry
+        # least recently used entries go first
+        keys = sorted(cache["entries"].keys(), key=lambda x: cache["entries"][x]["used"])
+        for k in keys[:max(0, len(keys) - resolve_cache_size)]:
+            if verbose:
+                log("Evict cached environment for %s" % ", ".join(cache["entries"][k]["requests"]))
+            del(cache["entries"][k])
+        try:
+            tmppath = "%s.%d.tmp" % (resolve_cache_path, os.getpid())
+            with open(tmppath, "wb") as f:
+                cPickle.dump(cache, f, cPickle.HIGHEST_PROTOCOL)
+            if os.path.exists(resolve_cache_path) and sys.platform == "win32":
+                os.remove(resolve_cache_path)
+            os.rename(tmppath, resolve_cache_path)
+        except Exception, e:
+            log("Failed to write %s (%s)" % (resolve_cache_path, e))
+    
+    return entry
+
+def shell_script(values):
+    # bash script setting up the environment
+    lines = []
+    for name in sorted(values.keys()):
+        value = values[name]
+        if value is None:
+            lines.append("unset %s" % name)
+        else:
+            lines.append("export %s=\"%s\"" % (name, re.sub(r"([\"\\$`])", r"\\\1", value)))
+    return "\n".join(lines)
+
+def lint_file(path):
+    # Checks that only need the file itself, run on a worker process
+    # Returns a dictionary with the facts needed for the requires graph checks
+    # and the problems found
+    rv = {"path": path, "tool": None, "version": "", "platforms": list(platforms), "requires": [],
+          "defines": {}, "refs": [], "strict": {}, "problems": []}
+    
+    try:
+        env, _ = load_env_file(path)
+    except Exception, e:
+        rv["problems"].append("parse error (%s)" % e)
+        return rv
+    
+    rv["tool"] = env.get("tool", None)
+    rv["version"] = env_version(path, env)
+    rv["requires"] = list(env.get("requires", []))
+    rv["platforms"] = list(env.get("platforms", platforms))
+    
+    if not rv["tool"]:
+        rv["problems"].append("missing tool name")
+    
+    for plat in rv["platforms"]:
+        if not plat in platforms:
+            rv["problems"].append("unknown platform '%s'" % plat)
+    
+    # section None is the main environment
+    sections = [(None, env.get("environment", {}))] + sorted(env.get("optional", {}).items())
+    
+    for section, variables in sections:
+        rv["defines"][section] = sorted(variables.keys())
+        where = ("" if section is None else " (optional '%s')" % section)
+        
+        for name, value in sorted(variables.iteritems()):
+            strict = False
+            if isinstance(value, dict):
+                strict = bool(value.get("strict", False))
+                for key in value.iterkeys():
+                    if not key in platforms and not key in ("common", "strict", "prepend"):
+                        rv["problems"].append("%s%s: unknown platform key '%s'" % (name, where, key))
+                values = [v for k, v in value.iteritems() if not k in ("strict", "prepend")]
+            else:
+                values = [value]
+            
+            strings = []
+            for v in values:
+                if isinstance(v, (list, tuple)):
+                    strings.extend(v)
+                elif v is not None:
+                    strings.append(v)
+            
+            for v in strings:
+                if not isinstance(v, basestring):
+                    rv["problems"].append("%s%s: invalid value %r" % (name, where, v))
+                    continue
+                for m in re.finditer(r"\$\{([^}]*)(\}?)", v):
+                    if not m.group(2) or not re.match(r"^[A-Za-z_][A-Za-z0-9_]*$", m.group(1)):
+                        rv["problems"].append("%s%s: unterminated or invalid reference '%s'" % (name, where, m.group(0)))
+                    else:
+                        rv["refs"].append((section, name, m.group(1)))
+            
+            if strict and section is None:
+                nonempty = sorted(set([str(x) for x in strings if x]))
+                if nonempty:
+                    rv["strict"][name] = nonempty
+    
+    return rv
+
+def lint_files(paths, jobs=None):
+    # Lint all files on a process pool, then check the references and strict
+    # variables against the requires graph
+    # Returns a sorted list of (path, problem) tuples
+    if jobs == 1 or len(paths) <= 1:
+        results = map(lint_file, paths)
+    else:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(lint_file, paths, chunksize=max(1, len(paths) / (4 * (jobs or multiprocessing.cpu_count()))))
+        finally:
+            pool.close()
+            pool.join()
+    
+    problems = []
+    
+    # {tool: {version: result}}, first file in ECO_ENV order wins
+    tools = {}
+    for result in results:
+        problems.extend([(result["path"], x) for x in result["problems"]])
+        if result["tool"]:
+            versions = tools.setdefault(result["tool"], {})
+            if result["version"] in versions:
+                problems.append((result["path"], "%s %s already defined in %s" % (result["tool"], result["version"], versions[result["version"]]["path"])))
+            else:
+                versions[result["version"]] = result
+    
+    def required(result):
+        # all the tool versions that may be resolved along with result
+        rv = []
+        stack = [result]
+        while stack:
+            current = stack.pop()
+            for requirement in current["requires"]:
+                name, spec = parse_requirement(tools, requirement)
+                for version, other in tools.get(name, {}).iteritems():
+                    if version_matches(version, spec) and not other in rv and other is not result:
+                        rv.append(other)
+                        stack.append(other)
+        return rv
+    
+    for result in results:
+        if not result["tool"]:
+            continue
+        
+        for requirement in result["requires"]:
+            name, spec = parse_requirement(tools, requirement)
+            if not name in tools:
+                problems.append((result["path"], "requires unknown tool '%s'" % requirement))
+            elif not any(version_matches(x, spec) for x in tools[name].iterkeys()):
+                problems.append((result["path"], "no version of %s matches requirement '%s'" % (name, requirement)))
+        
+        others = required(result)
+        
+        available = set(result["defines"].get(None, []))
+        for other in others:
+            for names in other["defines"].itervalues():
+                available.update(names)
+        
+        for section, name, ref in result["refs"]:
+            if ref in available or ref in result["defines"].get(section, []):
+                continue
+            # optional sections may use the variables of the tool they are
+            # named after
+            if section is not None and any(ref in x["defines"].get(None, []) for x in tools.get(section, {}).itervalues()):
+                continue
+            where = ("" if section is None else " (optional '%s')" % section)
+            problems.append((result["path"], "%s%s: undefined reference '${%s}'" % (name, where, ref)))
+        
+        for other in others:
+            if other["tool"] == result["tool"]:
+                continue
+            for name, values in sorted(result["strict"].iteritems()):
+                if name in other["strict"] and other["strict"][name] != values:
+                    problems.append((result["path"], "%s: strict value conflicts with %s %s" % (name, other["tool"], other["version"])))
+    
+    return sorted(set(problems))
+
+def help():
+    name = os.path.splitext(os.path.basename(__file__))[0]
+    
+    print("""NAME
+  ecoenv - Ecosystem environment files tools
+
+SYNOPSIS
+  %s [-c/--compile] [-l/--list] [-t/--tools LIST [-e/--setenv] [-r/--run COMMAND...]] [-s/--snapshot FILE] [-f/--force] [-v/--verbose] [-h/--help] [DIRECTORIES]
+
+ARGUMENTS
+  List of directories containing .env files
+  ($ECO_ENV or the eco launcher ECO_ENV by default)
+
+OPTIONS
+  -c/--compile               Compile all .env files into a single snapshot,
+                             only files modified since the last compilation
+                             are parsed again
+  -l/--list                  List the snapshot content
+  -q/--query REQUIREMENT     List the versions matching a requirement
+                             <name>(<version>)(+), latest first
+  --migrate                  Replace eval() expressions in .env files with the
+                             equivalent declarative forms (i.e. "@version[0]"),
+                             migrated files cannot be used by the eco launcher
+  --lint                     Check all .env files for parse errors, unknown
+                             platforms, invalid or undefined ${VAR} references,
+                             unknown requirements and strict conflicts
+  -j/--jobs N                Number of lint processes (one per CPU by default)
+  -t/--tools LIST            Resolve the environment for a comma separated list
+                             of tools <name>(<version>), print it by default
+  -e/--setenv                Print a bash script setting up the environment
+  -r/--run COMMAND...        Run COMMAND in the environment, all remaining
+                             arguments are passed to the command
+  -p/--platform PLATFORM     Resolve for PLATFORM (current platform by default)
+  --no-cache                 Do not use the resolved environments cache
+                             ('.ecoenv.cache' next to this script or
+                             $ECO_ENV_CACHE by default)
+  -s/--snapshot FILE         Snapshot file
+                             ('.ecoenv.snapshot' next to this script or
+                             $ECO_ENV_SNAPSHOT by default)
+  -f/--force                 Parse all files again
+  -v/--verbose               Verbose output
+  -h/--help                  Show this help
+
+EXAMPLE
+  python %s.py -c -v
+  python %s.py -l ./maya ./renderer
+  python %s.py --lint
+  python %s.py -q arnold5.0.1.4+ -p linux
+  eval "`python %s.py -t maya2017,MtoA2.0.2.3 -e`"
+  python %s.py -t maya2017,MtoA -r maya -batch
+""" % (name, name, name, name, name, name, name))
+
+if __name__ == "__main__":
+    
+    args = sys.argv[1:]
+    
+    verbose = False
+    force = False
+    dirs = []
+    op = None
+    requests = []
+    plat = platform.system().lower()
+    usecache = True
+    output = "print"
+    command = []
+    jobs = None
+    query = None
+    
+    i = 0
+    n = len(args)
+    while i < n:
+        if args[i] in ("-v", "--verbose"):
+            verbose = True
+        elif args[i] in ("-f", "--force"):
+            force = True
+        elif args[i] in ("-h", "--help"):
+            help()
+            sys.exit(0)
+        elif args[i] in ("-c", "--compile"):
+            op = "compile"
+        elif args[i] in ("-l", "--list"):
+            op = "list"
+        elif args[i] == "--lint":
+            op = "lint"
+        elif args[i] in ("-q", "--query"):
+            i += 1
+            if i >= n:
+                print("Missing required argument for -q/--query")
+                sys.exit(1)
+            op = "query"
+            query = args[i]
+        elif args[i] == "--migrate":
+            op = "migrate"
+        elif args[i] in ("-j", "--jobs"):
+            i += 1
+            if i >= n:
+                print("Missing required argument for -j/--jobs")
+                sys.exit(1)
+            try:
+                jobs = int(args[i])
+                if jobs < 1:
+                    raise ValueError()
+            except ValueError:
+                print("Invalid number of jobs '%s'" % args[i])
+                sys.exit(1)
+        elif args[i] in ("-t", "--tools"):
+            i += 1
+            if i >= n:
+                print("Missing required argument for -t/--tools")
+                sys.exit(1)
+            op = "resolve"
+            requests.extend([x.strip() for x in args[i].split(",") if x.strip()])
+        elif args[i] in ("-e", "--setenv"):
+            output = "setenv"
+        elif args[i] in ("-r", "--run"):
+            output = "run"
+            command = args[i + 1:]
+            if len(command) == 0:
+                print("Missing required argument for -r/--run")
+                sys.exit(1)
+            break
+        elif args[i] in ("-p", "--platform"):
+            i += 1
+            if i >= n:
+                print("Missing required argument for -p/--platform")
+                sys.exit(1)
+            plat = args[i].lower()
+            if not plat in platforms:
+                print("Invalid platform '%s'" % args[i])
+                sys.exit(1)
+        elif args[i] == "--no-cache":
+            usecache = False
+        elif args[i] in ("-s", "--snapshot"):
+            i += 1
+            if i >= n:
+                print("Missing required argument for -s/--snapshot")
+                sys.exit(1)
+            snapshot_path = os.path.abspath(args[i])
+        else:
+            dirs.append(args[i])
+        i += 1
+    
+    if op is None:
+        print("No operation specified.")
+        sys.exit(1)
+    
+    dirs = (get_env_dirs() if not dirs else [os.path.abspath(x) for x in dirs])
+    
+    if op == "migrate":
+        for path in list_env_files(dirs):
+            if migrate_env_file(path):
+                print("Migrated %s" % os.path.relpath(path))
+        sys.exit(0)
+    
+    if op == "lint":
+        paths = list_env_files(dirs)
+        problems = lint_files(paths, jobs)
+        for path, problem in problems:
+            print("%s: %s" % (os.path.relpath(path), problem))
+        if verbose:
+            print("%d file(s) checked, %d problem(s)" % (len(paths), len(problems)))
+        sys.exit(1 if problems else 0)
+    
+    snapshot = compile_snapshot(dirs, force=force, verbose=verbose)
+    
+    if op == "query":
+        name, spec = parse_requirement(snapshot["index"], query)
+        entries = snapshot["index"].get(name, [])
+        lo, hi = find_versions(entries, [spec])
+        found = [x for x in reversed(entries[lo:hi]) if plat in x[4]]
+        for entry in found:
+            print("%s %s %s" % (name, entry[2], os.path.relpath(entry[3])))
+        sys.exit(0 if found else 1)
+    
+    if op == "resolve":
+        try:
+            resolved = get_resolved_environment(snapshot, requests, plat, usecache=usecache, verbose=verbose)
+        except ValueError, e:
+            log(str(e))
+            sys.exit(1)
+        
+        values = apply_environment(resolved, plat=plat)
+        
+        if output == "setenv":
+            print(shell_script(values))
+        elif output == "run":
+            env = dict(os.environ)
+            for name, value in values.iteritems():
+                if value is None:
+                    env.pop(name, None)
+                else:
+                    env[name] = value
+            sys.exit(subprocess.call(command, env=env))
+        else:
+            if verbose:
+                print("TOOLS")
+                for name, version in resolved["tools"]:
+                    print("  %s %s" % (name, version))
+                print("ENVIRONMENT")
+            for name in sorted(values.keys()):
+                print("%s=%s" % (name, ("" if values[name] is None else values[name])))
+        sys.exit(0)
+    
+    if op == "list":
+        for envpath in sorted(snapshot["files"].keys()):
+            entry = snapshot["files"][envpath]
+            if entry["env"] is None:
+                print("%s: %s" % (envpath, entry["error"]))
+            else:
+                print("%s: %s %s" % (envpath, entry["env"].get("tool", ""), (env_version(envpath, entry["env"]) if entry["env"].get("tool", None) else "")))
+    
+    failed = [x for x in snapshot["files"].itervalues() if x["env"] is None]
+    
+    sys.exit(1 if failed else 0)
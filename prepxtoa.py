@@ -2,7 +2,63 @@ import os
 import re
 import sys
 import glob
+import json
 import shutil
+import fnmatch
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+
+class Snapshot(object):
+   # Directory listings shared by the rules and conditions of a scan
+   # Every directory is listed once, on first use, so the number of file
+   # system calls grows with the number of trees rather than with the number
+   # of rules and conditions evaluated on them
+   # Names starting with a dot are only matched by patterns starting with a
+   # dot, like glob does
+   def __init__(self):
+      super(Snapshot, self).__init__()
+      self.listings = {}
+
+   def listdir(self, path):
+      # set of entry names or None if path is not a directory
+      path = os.path.normpath(path)
+      if not path in self.listings:
+         try:
+            self.listings[path] = set(os.listdir(path))
+         except OSError:
+            self.listings[path] = None
+      return self.listings[path]
+
+   def isdir(self, path):
+      return (self.listdir(path) is not None)
+
+   def exists(self, path):
+      path = os.path.normpath(path)
+      names = self.listdir(os.path.dirname(path))
+      return (names is not None and os.path.basename(path) in names)
+
+   def isfile(self, path):
+      return (self.exists(path) and not self.isdir(path))
+
+   def glob(self, path, pattern):
+      # sorted glob.glob(path + "/" + pattern)
+      rv = [path]
+      for part in pattern.split("/"):
+         matches = []
+         for d in rv:
+            names = self.listdir(d)
+            if not names:
+               continue
+            if glob.has_magic(part):
+               if not part.startswith("."):
+                  names = filter(lambda x: not x.startswith("."), names)
+               matches += map(lambda x: d + "/" + x, fnmatch.filter(names, part))
+            elif part in names:
+               matches.append(d + "/" + part)
+         rv = matches
+      return sorted(rv)
+
 
 class Action(object):
    def __init__(self, condition=None, invertCondition=False):
@@ -13,7 +69,7 @@ class Action(object):
       self.condition = condition
       self.invertCondition = invertCondition
 
-   def setup(self, basedir, dryRun=False, verbose=False, **kwargs):
+   def setup(self, basedir, dryRun=False, verbose=False, snapshot=None, **kwargs):
       self.basedir = basedir
       self.verbose = verbose
       self.dryRun = dryRun
@@ -21,30 +77,47 @@ class Action(object):
          #if verbose:
          #   print("Evaluate condition: %s(%s)" % ("not " if self.invertCondition else "", self.condition))
          if self.invertCondition:
-            rv = self.condition.isFalse(basedir)
+            rv = self.condition.isFalse(basedir, snapshot)
          else:
-            rv = self.contition.isTrue(basedir)
+            rv = self.condition.isTrue(basedir, snapshot)
          #if verbose:
          #   print("=> %s" % rv)
          return rv
       else:
          return True
 
-   def execute(self, arg):
-      pass
+   def plan(self, arg, snapshot=None):
+      # (operation, source, destination directory) or None
+      return None
+
+   def signature(self):
+      return "%s(%s%s)" % (self.__class__.__name__, "not " if self.invertCondition else "", self.condition if self.condition else "")
 
 
 class Condition(object):
    def __init__(self, **kwargs):
       super(Condition, self).__init__()
       self.args = kwargs
-
-   def isTrue(self, basedir):
+      self.results = {}
+
+   def isTrue(self, basedir, snapshot=None):
+      # results are memoized per basedir for the snapshot they were evaluated
+      # on: a later scan (new snapshot) evaluates them again, without a
+      # snapshot the file system is checked every time
+      if snapshot is None:
+         return self.evaluate(basedir, Snapshot())
+      entry = self.results.get(basedir, None)
+      if entry is None or entry[0] is not snapshot:
+         entry = (snapshot, self.evaluate(basedir, snapshot))
+         self.results[basedir] = entry
+      return entry[1]
+
+   def isFalse(self, basedir, snapshot=None):
+      return not self.isTrue(basedir, snapshot)
+
+   def evaluate(self, basedir, snapshot):
       return False
 
-   def isFalse(self, basedir):
-      return not self.isTrue(basedir)
-
    def __str__(self):
       return ""
 
@@ -61,17 +134,17 @@ class FileExists(Condition):
       if self.mode == self.RE_PATTERN:
          self.exp = re.compile(self.path)
 
-   def isTrue(self, basedir):
+   def evaluate(self, basedir, snapshot):
       d = basedir
       sd = self.args.get("subdir", None)
       if sd:
          d += "/" + sd
       if self.mode == self.PLAIN:
-         return os.path.isfile(d + "/" + self.path)
+         return snapshot.isfile(d + "/" + self.path)
       elif self.mode == self.GLOB_PATTERN:
-         return (len(glob.glob(d + "/" + self.path)) > 0)
+         return (len(snapshot.glob(d, self.path)) > 0)
       elif self.mode == self.RE_PATTERN:
-         items = filter(lambda x: self.exp.match(os.path.basename(x)) is not None, glob.glob(d + "/*"))
+         items = filter(lambda x: self.exp.match(os.path.basename(x)) is not None, snapshot.glob(d, "*"))
          return (len(items) > 0)
       else:
          return False
@@ -82,73 +155,80 @@ class FileExists(Condition):
 
 class And(Condition):
    def __init__(self, c0, c1, **kwargs):
-      super(Condition, self).__init__(**kwargs)
+      super(And, self).__init__(**kwargs)
       self.c0 = c0
       self.c1 = c1
 
-   def isTrue(self, basedir):
-      return (self.c0.isTrue(basedir) and self.c1.isTrue(basedir))
+   def evaluate(self, basedir, snapshot):
+      return (self.c0.isTrue(basedir, snapshot) and self.c1.isTrue(basedir, snapshot))
 
    def __str__(self):
       return "%s and %s" % (self.c0, self.c1)
 
 class Or(Condition):
    def __init__(self, c0, c1, **kwargs):
-      super(Condition, c0, c1).__init__(**kwargs)
+      super(Or, self).__init__(**kwargs)
       self.c0 = c0
       self.c1 = c1
 
-   def isTrue(self, basedir):
-      return (self.c0.isTrue(basedir) or self.c1.isTrue(basedir))
+   def evaluate(self, basedir, snapshot):
+      return (self.c0.isTrue(basedir, snapshot) or self.c1.isTrue(basedir, snapshot))
 
    def __str__(self):
       return "%s or %s" % (self.c0, self.c1)
 
 
 class Delete(Action):
-   CreatedDirs = set()
-
    def __init__(self, condition=None, invertCondition=False):
       super(Delete, self).__init__(condition, invertCondition)
       self.deletedir = None
 
-   def setup(self, basedir, dryRun=False, verbose=False, **kwargs):
-      if not super(Delete, self).setup(basedir, dryRun=dryRun, verbose=verbose, **kwargs):
+   def setup(self, basedir, dryRun=False, verbose=False, snapshot=None, **kwargs):
+      if not super(Delete, self).setup(basedir, dryRun=dryRun, verbose=verbose, snapshot=snapshot, **kwargs):
          return False
       self.deletedir = basedir + "/_deleted"
-      if not os.path.isdir(self.deletedir):
-         if verbose:
-            if not dryRun or self.deletedir not in self.CreatedDirs:
-               print("Create directory '%s'" % self.deletedir)
-               self.CreatedDirs.add(self.deletedir)
-         if not dryRun:
-            try:
-               os.makedirs(self.deletedir)
-            except Exception, e:
-               print("ERROR: %s" % e)
-               return False
       return True
 
-   def execute(self, arg):
-      if not os.path.exists(arg):
-         return
-      if self.verbose:
-         print("Move '%s' to '%s'" % (arg, self.deletedir))
-      if not self.dryRun:
-         shutil.move(arg, self.deletedir)
+   def plan(self, arg, snapshot=None):
+      if not (snapshot.exists(arg) if snapshot else os.path.exists(arg)):
+         return None
+      return ("move", arg, self.deletedir)
 
+   @staticmethod
+   def pending(src, dst):
+      return os.path.exists(src)
+
+   @staticmethod
+   def undo(src, dst, verbose=False):
+      target = dst + "/" + os.path.basename(src)
+      if os.path.lexists(target) and not os.path.lexists(src):
+         if verbose:
+            Executor.log("Move '%s' back to '%s'" % (target, os.path.dirname(src)))
+         shutil.move(target, src)
+
+   @staticmethod
+   def apply(src, dst, verbose=False, **kwargs):
+      if not os.path.exists(src):
+         return True
+      if verbose:
+         Executor.log("Move '%s' to '%s'" % (src, dst))
+      try:
+         shutil.move(src, dst)
+      except Exception, e:
+         Executor.log("ERROR: %s" % e)
+         return False
+      return True
 
-class Copy(Action):
-   CreatedDirs = set()
 
+class Copy(Action):
    def __init__(self, todir, repl=[], condition=None, invertCondition=False):
       super(Copy, self).__init__(condition, invertCondition)
       self.todir = todir
       self.realtodir = None
       self.repl = repl
 
-   def setup(self, basedir, dryRun=False, verbose=False, **kwargs):
-      if not super(Copy, self).setup(basedir, dryRun=dryRun, verbose=verbose, **kwargs):
+   def setup(self, basedir, dryRun=False, verbose=False, snapshot=None, **kwargs):
+      if not super(Copy, self).setup(basedir, dryRun=dryRun, verbose=verbose, snapshot=snapshot, **kwargs):
          return False
       if not os.path.isabs(self.todir):
          self.realtodir = basedir + "/" + self.todir
@@ -157,33 +237,535 @@ class Copy(Action):
       if self.repl:
          args = tuple([kwargs[x] for x in self.repl])
          self.realtodir = self.realtodir % args
-      if not os.path.isdir(self.realtodir):
+      # normalized so that actions sharing a destination share its lock
+      self.realtodir = os.path.normpath(self.realtodir)
+      return True
+
+   def plan(self, arg, snapshot=None):
+      target = self.realtodir + "/" + os.path.basename(arg)
+      if (snapshot.exists(target) if snapshot else os.path.exists(target)):
+         return None
+      return ("copy", arg, self.realtodir)
+
+   @staticmethod
+   def pending(src, dst):
+      return not os.path.lexists(dst + "/" + os.path.basename(src))
+
+   @staticmethod
+   def undo(src, dst, verbose=False):
+      # only called for copies that were pending when started
+      target = dst + "/" + os.path.basename(src)
+      if not os.path.lexists(target):
+         return
+      if verbose:
+         Executor.log("Remove '%s'" % target)
+      if os.path.isdir(target) and not os.path.islink(target):
+         shutil.rmtree(target)
+      else:
+         os.remove(target)
+
+   @staticmethod
+   def apply(src, dst, verbose=False, store=None, **kwargs):
+      # the destination may have been filled by another tree in the meantime
+      target = dst + "/" + os.path.basename(src)
+      if os.path.lexists(target):
+         return True
+      if verbose:
+         Executor.log("%s '%s' to '%s'" % ("Copy" if store is None else "Link", src, dst))
+      try:
+         if os.path.isdir(src):
+            if store is None:
+               shutil.copytree(src, target, symlinks=True)
+            else:
+               store.copytree(src, target)
+         else:
+            if store is None:
+               shutil.copy2(src, dst)
+            else:
+               store.place(src, target)
+      except Exception, e:
          if verbose:
-            if not dryRun or self.realtodir not in self.CreatedDirs:
-               print("Create directory '%s'" % self.realtodir)
-               self.CreatedDirs.add(self.realtodir)
-         if not dryRun:
-            try:
-               os.makedirs(self.realtodir)
-            except Exception, e:
-               print("ERROR: %s" % e)
-               return False
+            Executor.log("FAILED: %s" % e)
+         return False
       return True
 
-   def execute(self, arg):
-      if os.path.exists(self.realtodir + "/" + os.path.basename(arg)):
+   def signature(self):
+      return "%s:%s%s" % (super(Copy, self).signature(), self.todir, self.repl)
+
+class StampDB(object):
+   # Directory modification times of prepared trees, keyed by
+   # (tool, version, host version, platform)
+   # A tree is up to date when neither its rule folders nor the rules changed
+   # since it was last prepared successfully
+   Format = 1
+
+   def __init__(self, path):
+      super(StampDB, self).__init__()
+      self.path = path
+      self.trees = {}
+      self.dirty = False
+
+   def load(self):
+      self.trees = {}
+      if os.path.isfile(self.path):
+         try:
+            with open(self.path, "r") as f:
+               data = json.load(f)
+            if data.get("format", None) == self.Format:
+               self.trees = data.get("trees", {})
+         except Exception, e:
+            print("WARNING: Ignore stamp database '%s' (%s)" % (self.path, e))
+      self.dirty = False
+
+   def save(self):
+      if not self.dirty:
          return
+      tmppath = "%s.%d.tmp" % (self.path, os.getpid())
+      with open(tmppath, "w") as f:
+         json.dump({"format": self.Format, "trees": self.trees}, f, indent=1, sort_keys=True)
+      # rename does not replace an existing file on windows
+      if os.path.exists(self.path) and sys.platform == "win32":
+         os.remove(self.path)
+      os.rename(tmppath, self.path)
+      self.dirty = False
+
+   @staticmethod
+   def key(tool, version, hostVersion, platform):
+      return "|".join([tool, version, hostVersion if hostVersion else "", platform])
+
+   @staticmethod
+   def rulesSignature(aitems):
+      items = []
+      for k in sorted(aitems.keys()):
+         for nameOrExp, action in aitems[k]:
+            items.append("%s/%s:%s" % (k, nameOrExp if type(nameOrExp) in (str, unicode) else nameOrExp.pattern, action.signature()))
+      return hashlib.sha1("\n".join(items)).hexdigest()
+
+   @staticmethod
+   def stampDirs(aitems):
+      # the tree and every folder the rules look into, relative to the tree
+      dirs = set([""])
+      for k, v in aitems.iteritems():
+         dirs.add(k)
+         for nameOrExp, _ in v:
+            if type(nameOrExp) in (str, unicode) and os.path.dirname(nameOrExp):
+               dirs.add(k + "/" + os.path.dirname(nameOrExp))
+      return sorted(dirs)
+
+   @staticmethod
+   def treeStamp(folder, dirs):
+      stamp = {}
+      for d in dirs:
+         try:
+            stamp[d] = os.stat(folder + ("/" + d if d else "")).st_mtime
+         except OSError:
+            pass
+      return stamp
+
+   def isUpToDate(self, key, folder, signature, dirs):
+      entry = self.trees.get(key, None)
+      if entry is None or entry.get("rules", None) != signature:
+         return False
+      return (entry.get("stamp", None) == self.treeStamp(folder, dirs))
+
+   def update(self, key, folder, signature, dirs):
+      self.trees[key] = {"rules": signature, "stamp": self.treeStamp(folder, dirs)}
+      self.dirty = True
+
+
+class Store(object):
+   # Content addressed store of copied files: <root>/<sha1[:2]>/<sha1>
+   # Copies of identical payloads become hard or symbolic links to the same
+   # store object instead of separate files
+   HardLink = "hardlink"
+   SymLink = "symlink"
+   Modes = (HardLink, SymLink)
+
+   def __init__(self, root, mode=HardLink):
+      super(Store, self).__init__()
+      self.root = root
+      self.mode = mode
+
+   @staticmethod
+   def hash(path):
+      h = hashlib.sha1()
+      with open(path, "rb") as f:
+         while True:
+            data = f.read(1 << 20)
+            if not data:
+               break
+            h.update(data)
+      return h.hexdigest()
+
+   def add(self, path):
+      # store object for the content of path, the payload is copied in the
+      # store so that later in place modifications of path do not leak
+      digest = self.hash(path)
+      objpath = "%s/%s/%s" % (self.root, digest[:2], digest)
+      if not os.path.isfile(objpath):
+         try:
+            os.makedirs(os.path.dirname(objpath))
+         except OSError:
+            if not os.path.isdir(os.path.dirname(objpath)):
+               raise
+         tmppath = "%s.%d.%d" % (objpath, os.getpid(), threading.current_thread().ident)
+         shutil.copy2(path, tmppath)
+         try:
+            os.rename(tmppath, objpath)
+         except OSError:
+            # on windows rename fails when another job stored the same
+            # content in the meantime, objects are never replaced
+            os.remove(tmppath)
+            if not os.path.isfile(objpath):
+               raise
+      return objpath
+
+   def place(self, src, dst):
+      # dst is the full path of the copy
+      objpath = self.add(src)
+      if self.mode == self.SymLink:
+         os.symlink(os.path.relpath(objpath, os.path.dirname(dst)), dst)
+      else:
+         try:
+            os.link(objpath, dst)
+         except OSError:
+            # store on another file system
+            shutil.copy2(objpath, dst)
+
+   def copytree(self, src, dst):
+      os.makedirs(dst)
+      for name in sorted(os.listdir(src)):
+         path = src + "/" + name
+         if os.path.islink(path):
+            os.symlink(os.readlink(path), dst + "/" + name)
+         elif os.path.isdir(path):
+            self.copytree(path, dst + "/" + name)
+         else:
+            self.place(path, dst + "/" + name)
+      shutil.copystat(src, dst)
+
+   @classmethod
+   def usage(cls, dirs):
+      # Disk usage of the files below dirs
+      # Returns {"files": file count,
+      #          "bytes": apparent size,
+      #          "disk": size of distinct inodes,
+      #          "unique": size of distinct contents}
+      # disk - unique is what deduplicating the remaining copies would save,
+      # bytes - disk is what links already save
+      rv = {"files": 0, "bytes": 0, "disk": 0, "unique": 0}
+      inodes = set()
+      digests = set()
+      for d in dirs:
+         for dirpath, dirnames, filenames in os.walk(d):
+            for name in filenames:
+               path = dirpath + "/" + name
+               try:
+                  st = os.stat(path)
+               except OSError:
+                  # broken link
+                  continue
+               rv["files"] += 1
+               rv["bytes"] += st.st_size
+               if (st.st_dev, st.st_ino) in inodes:
+                  continue
+               inodes.add((st.st_dev, st.st_ino))
+               rv["disk"] += st.st_size
+               digest = cls.hash(path)
+               if digest in digests:
+                  continue
+               digests.add(digest)
+               rv["unique"] += st.st_size
+      return rv
+
+
+class Plan(object):
+   # Operations of every tree to prepare, in execution order:
+   #   [{"folder": tree folder,
+   #     "key": stamp key,
+   #     "rules": rules signature,
+   #     "dirs": stamped folders (see StampDB),
+   #     "ops": [(operation, source, destination directory), ...]}, ...]
+   # Plans are saved as JSON and can be applied later without scanning the
+   # trees again
+   Format = 1
+
+   def __init__(self, root, trees=None):
+      super(Plan, self).__init__()
+      self.root = root
+      self.trees = (trees if trees is not None else [])
+
+   def toDict(self):
+      return {"format": self.Format, "root": self.root, "trees": self.trees}
+
+   @classmethod
+   def fromDict(cls, data):
+      if data.get("format", None) != cls.Format:
+         raise Exception("Unsupported plan format %s" % data.get("format", None))
+      trees = data["trees"]
+      for tree in trees:
+         tree["ops"] = [tuple(x) for x in tree["ops"]]
+      return cls(data["root"], trees)
+
+   def save(self, path):
+      with open(path, "w") as f:
+         json.dump(self.toDict(), f, indent=1, sort_keys=True)
+
+   @classmethod
+   def load(cls, path):
+      with open(path, "r") as f:
+         return cls.fromDict(json.load(f))
+
+   @classmethod
+   def scan(cls, root, specs, stamps=None, verbose=False):
+      # specs: [(tree glob pattern relative to root, [(key, folder name pattern), ...], rules, tool), ...]
+      # Trees up to date in stamps are skipped
+      plan = cls(root)
+      planned = set()
+      snapshot = Snapshot()
+
+      for pattern, keys, aitems, tool in specs:
+         if len(keys) == 0:
+            continue
+
+         signature = StampDB.rulesSignature(aitems)
+         dirs = StampDB.stampDirs(aitems)
+
+         for topdir in snapshot.glob(root, pattern.lstrip("/")):
+            lst = [(topdir, {})]
+            for i in xrange(len(keys)):
+               key, pat = keys[i]
+               islast = (i + 1 == len(keys))
+               newlst = []
+               for curdir, kwargs in lst:
+                  val = os.path.basename(curdir)
+                  if pat is not None and not pat.match(val):
+                     continue
+                  newkwargs = kwargs.copy()
+                  newkwargs[key] = val
+                  if islast:
+                     newlst.append((curdir, newkwargs))
+                  else:
+                     newlst += map(lambda x: (x, newkwargs.copy()), snapshot.glob(curdir, "*"))
+               lst = newlst
+
+            for folder, kwargs in lst:
+               # (tool, version, host version, platform)
+               values = [kwargs[x[0]] for x in keys]
+               treekey = StampDB.key(tool, values[0], (values[1] if len(values) > 2 else None), values[-1])
+               if stamps is not None and stamps.isUpToDate(treekey, folder, signature, dirs):
+                  if verbose:
+                     print("Skip '%s' (up to date)" % folder)
+                  continue
+
+               ops = []
+               for k in sorted(aitems.keys()):
+                  tgt = folder + "/" + k
+                  if not snapshot.isdir(tgt):
+                     continue
+                  contents = snapshot.glob(tgt, "*")
+                  for nameOrExp, action in aitems[k]:
+                     if not action.setup(folder, verbose=verbose, snapshot=snapshot, **kwargs):
+                        continue
+                     if type(nameOrExp) in (str, unicode):
+                        items = snapshot.glob(tgt, nameOrExp)
+                     else:
+                        items = filter(lambda x: nameOrExp.match(os.path.basename(x)), contents)
+                     for item in items:
+                        op = action.plan(item, snapshot)
+                        if op is None:
+                           continue
+                        # copies of the same name to the same destination from
+                        # several trees are only planned once
+                        target = (op[2] + "/" + os.path.basename(op[1]) if op[0] == "copy" else op[1])
+                        if target in planned:
+                           continue
+                        planned.add(target)
+                        ops.append(op)
+
+               plan.trees.append({"folder": folder, "key": treekey, "rules": signature, "dirs": dirs, "ops": ops})
+
+      return plan
+
+
+class Journal(object):
+   # The plan being applied followed by one JSON object per line for every
+   # directory created ({"mkdir": path}) and operation started
+   # ({"begin": [tree, op]}) or completed ({"done": [tree, op]})
+   # The journal is removed once the plan is fully applied, an existing
+   # journal means the last run was interrupted
+   def __init__(self, path):
+      super(Journal, self).__init__()
+      self.path = path
+      self.f = None
+      self.lock = threading.Lock()
+
+   def exists(self):
+      return os.path.isfile(self.path)
+
+   def start(self, plan):
+      self.f = open(self.path, "w")
+      self.write(plan.toDict())
+
+   def reopen(self):
+      self.f = open(self.path, "a")
+
+   def write(self, entry):
+      self.f.write(json.dumps(entry) + "\n")
+      self.f.flush()
+      os.fsync(self.f.fileno())
+
+   def record(self, **entry):
+      with self.lock:
+         self.write(entry)
+
+   def read(self):
+      # (plan, entries)
+      entries = []
+      with open(self.path, "r") as f:
+         plan = Plan.fromDict(json.loads(f.readline()))
+         for line in f:
+            try:
+               entries.append(json.loads(line))
+            except ValueError:
+               # last line partially written
+               break
+      return (plan, entries)
+
+   def close(self):
+      if self.f:
+         self.f.close()
+         self.f = None
+
+   def remove(self):
+      self.close()
+      if os.path.isfile(self.path):
+         os.remove(self.path)
+
+
+class Executor(object):
+   # Run planned operations, one task per tree
+   # Trees are independent and run concurrently, operations writing to the
+   # same destination directory are serialized
+   Operations = {"move": Delete, "copy": Copy}
+   LogLock = threading.Lock()
+
+   def __init__(self, jobs=1, dryRun=False, verbose=False, store=None):
+      super(Executor, self).__init__()
+      self.store = store
+      self.jobs = max(1, jobs)
+      self.dryRun = dryRun
+      self.verbose = verbose
+      self.locks = {}
+      self.locksLock = threading.Lock()
+      self.createdDirs = set()
+      self.plan = None
+      self.journal = None
+      self.done = set()
+
+   @classmethod
+   def log(cls, msg):
+      with cls.LogLock:
+         print(msg)
+
+   def lock(self, path):
+      with self.locksLock:
+         if not path in self.locks:
+            self.locks[path] = threading.Lock()
+         return self.locks[path]
+
+   def makedirs(self, path):
+      # called with the path lock held
+      if path in self.createdDirs or os.path.isdir(path):
+         return True
       if self.verbose:
-         print("Copy '%s' to '%s'" % (arg, self.realtodir))
+         self.log("Create directory '%s'" % path)
+      self.createdDirs.add(path)
       if not self.dryRun:
+         missing = []
+         d = path
+         while d and not os.path.isdir(d):
+            missing.insert(0, d)
+            d = os.path.dirname(d)
          try:
-            if os.path.isdir(arg):
-               shutil.copytree(arg, self.realtodir)
-            else:
-               shutil.copy2(arg, self.realtodir)
+            os.makedirs(path)
+         except Exception, e:
+            if not os.path.isdir(path):
+               self.log("ERROR: %s" % e)
+               return False
+         if self.journal:
+            for d in missing:
+               self.journal.record(mkdir=d)
+      return True
+
+   def executeTree(self, index):
+      # returns False if any operation failed
+      rv = True
+      for i, (op, src, dst) in enumerate(self.plan.trees[index]["ops"]):
+         if (index, i) in self.done:
+            continue
+         with self.lock(dst):
+            if not self.makedirs(dst):
+               rv = False
+               continue
+            if self.dryRun:
+               if self.verbose:
+                  self.log("%s '%s' to '%s'" % (op.capitalize(), src, dst))
+               continue
+            action = self.Operations[op]
+            if not action.pending(src, dst):
+               continue
+            if self.journal:
+               self.journal.record(begin=[index, i])
+            if not action.apply(src, dst, verbose=self.verbose, store=self.store):
+               rv = False
+            elif self.journal:
+               self.journal.record(done=[index, i])
+      return rv
+
+   def run(self, plan, journal=None, done=None):
+      # done: (tree, op) indices of the operations already applied
+      # Returns the set of tree folders with failed operations
+      # Dry runs are always serial so that the output follows the plan order
+      self.plan = plan
+      self.journal = journal
+      self.done = (done if done else set())
+      indices = range(len(plan.trees))
+      if self.dryRun or self.jobs == 1 or len(indices) <= 1:
+         results = map(self.executeTree, indices)
+      else:
+         pool = ThreadPool(min(self.jobs, len(indices)))
+         try:
+            results = pool.map(self.executeTree, indices)
+         finally:
+            pool.close()
+            pool.join()
+      return set([plan.trees[i]["folder"] for i in indices if not results[i]])
+
+   def undo(self, plan, entries):
+      # Revert journal entries, most recent first
+      # Returns False if anything could not be reverted
+      rv = True
+      for entry in reversed(entries):
+         try:
+            if "begin" in entry:
+               op, src, dst = plan.trees[entry["begin"][0]]["ops"][entry["begin"][1]]
+               if self.dryRun:
+                  self.log("Undo %s '%s' to '%s'" % (op, src, dst))
+               else:
+                  self.Operations[op].undo(src, dst, verbose=self.verbose)
+            elif "mkdir" in entry:
+               if self.dryRun:
+                  self.log("Remove directory '%s'" % entry["mkdir"])
+               elif os.path.isdir(entry["mkdir"]) and not os.listdir(entry["mkdir"]):
+                  if self.verbose:
+                     self.log("Remove directory '%s'" % entry["mkdir"])
+                  os.rmdir(entry["mkdir"])
          except Exception, e:
-            if self.verbose:
-               print("FAILED: %s" % e)
+            self.log("ERROR: %s" % e)
+            rv = False
+      return rv
+
 
 KeepMakeTxCond = And(FileExists(r"^.*OpenColorIO.*\.(so|dll|dylib).*$", FileExists.RE_PATTERN, subdir="bin"),
                      FileExists(r"^.*synColor.*\.(so|dll|dylib).*$", FileExists.RE_PATTERN, subdir="bin"))
@@ -215,80 +797,153 @@ Arnold = {"bin": [(re.compile(r"^(lib)?adlmint\.(dll|so|dylib)$"), Delete()),
 
 if __name__ == "__main__":
    if "-h" in sys.argv or "--help" in sys.argv:
-      print("Usage: python prepxtoa.py (-dr/--dry-run) (-v/--verbose) (-h/--help)")
+      print("Usage: python prepxtoa.py (-dr/--dry-run) (-f/--full) (-j/--jobs N) (-l/--link hardlink|symlink) (--store DIR) (--report) (--save-plan FILE) (--apply FILE) (--resume) (--rollback) (-v/--verbose) (-h/--help)")
+      print("  -f/--full: Process all trees, including the ones already prepared and not modified since")
+      print("  -j/--jobs: Number of trees processed concurrently (1 by default)")
+      print("  -l/--link: Copy files as links to a content addressed store")
+      print("  --store: Store directory (_store by default)")
+      print("  --report: Report the bytes saved and still duplicated in the shared shaders directories")
+      print("  --save-plan: Scan the trees and save the operations to FILE without applying them")
+      print("  --apply: Apply the operations saved in FILE without scanning the trees")
+      print("  --resume: Complete the operations of an interrupted run")
+      print("  --rollback: Revert the operations of an interrupted run")
       sys.exit(0)
 
-   dryRun = ("-dr" in sys.argv or "--dry-run" in sys.argv)
-   verbose = ("-v" in sys.argv or "--verbose" in sys.argv)
+   args = sys.argv[1:]
+
+   dryRun = False
+   verbose = False
+   full = False
+   report = False
+   resume = False
+   rollback = False
+   jobs = 1
+   link = None
+   storedir = None
+   planpaths = {}
+
+   i = 0
+   n = len(args)
+   while i < n:
+      if args[i] in ("-dr", "--dry-run"):
+         dryRun = True
+      elif args[i] in ("-v", "--verbose"):
+         verbose = True
+      elif args[i] in ("-f", "--full"):
+         full = True
+      elif args[i] == "--report":
+         report = True
+      elif args[i] == "--resume":
+         resume = True
+      elif args[i] == "--rollback":
+         rollback = True
+      elif args[i] in ("-j", "--jobs", "-l", "--link", "--store", "--save-plan", "--apply"):
+         i += 1
+         if i >= n:
+            print("Missing required argument for %s" % args[i - 1])
+            sys.exit(1)
+         if args[i - 1] in ("-j", "--jobs"):
+            try:
+               jobs = int(args[i])
+               if jobs < 1:
+                  raise ValueError()
+            except ValueError:
+               print("Invalid number of jobs '%s'" % args[i])
+               sys.exit(1)
+         elif args[i - 1] in ("-l", "--link"):
+            if not args[i] in Store.Modes:
+               print("Invalid link mode '%s', expected one of %s" % (args[i], ", ".join(Store.Modes)))
+               sys.exit(1)
+            link = args[i]
+         elif args[i - 1] == "--store":
+            storedir = os.path.abspath(args[i])
+         else:
+            planpaths[args[i - 1]] = os.path.abspath(args[i])
+      else:
+         print("Invalid argument '%s'" % args[i])
+         sys.exit(1)
+      i += 1
+
+   if resume and rollback:
+      print("--resume and --rollback cannot be used together")
+      sys.exit(1)
 
    thisdir = os.path.abspath(os.path.dirname(__file__))
 
+   if report:
+      u = Store.usage([thisdir + "/arnold/MtoAShaders", thisdir + "/arnold/HtoAShaders"])
+      print("%d file(s), %d byte(s)" % (u["files"], u["bytes"]))
+      print("%d byte(s) on disk, %d byte(s) saved by links" % (u["disk"], u["bytes"] - u["disk"]))
+      print("%d byte(s) of distinct content, %d byte(s) still duplicated" % (u["unique"], u["disk"] - u["unique"]))
+      sys.exit(0)
+
+   store = None
+   if link:
+      store = Store(storedir if storedir else thisdir + "/_store", mode=link)
+
+   stamps = StampDB(thisdir + "/.prepxtoa.stamps")
+   stamps.load()
+
    verpat = re.compile(r"[\d.]+")
    platpat = re.compile(r"^(darwin|windows|linux)$")
 
-   lst = [("/maya/MtoA/*", [("mtoaver", None), ("mayaver", verpat), ("platform", platpat)], MtoA),
-          ("/houdini/HtoA/*", [("htoaver", None), ("houver", verpat), ("platform", platpat)], HtoA),
-          ("/renderer/arnold/*", [("arniver", None), ("platform", platpat)], Arnold)]
-
-   for pattern, keys, aitems in lst:
-      if len(keys) == 0:
-         continue
-
-      for topdir in glob.glob(thisdir + pattern):
-         lst = [(topdir, {})]
-         for i in xrange(len(keys)):
-            key, pat = keys[i]
-            islast = (i + 1 == len(keys))
-            newlst = []
-            for curdir, kwargs in lst:
-               val = os.path.basename(curdir)
-               if pat is not None and not pat.match(val):
-                  continue
-               newkwargs = kwargs.copy()
-               newkwargs[key] = val
-               if islast:
-                  newlst.append((curdir, newkwargs))
-               else:
-                  newlst += map(lambda x: (x, newkwargs.copy()), glob.glob(curdir + "/*"))
-            lst = newlst
+   specs = [("/maya/MtoA/*", [("mtoaver", None), ("mayaver", verpat), ("platform", platpat)], MtoA, "MtoA"),
+            ("/houdini/HtoA/*", [("htoaver", None), ("houver", verpat), ("platform", platpat)], HtoA, "HtoA"),
+            ("/renderer/arnold/*", [("arniver", None), ("platform", platpat)], Arnold, "arnold")]
 
-         for k, v in aitems.iteritems():
-            for folder, kwargs in lst:
-               tgt = folder + "/" + k
-               if not os.path.isdir(tgt):
-                  continue
-               contents = glob.glob(tgt + "/*")
-               for nameOrExp, action in v:
-                  if not action.setup(folder, dryRun=dryRun, verbose=verbose, **kwargs):
-                     continue
-                  if type(nameOrExp) in (str, unicode):
-                     for item in glob.glob(tgt + "/" + nameOrExp):
-                        action.execute(item)
-                  else:
-                     for item in filter(lambda x: nameOrExp.match(os.path.basename(x)), contents):
-                        action.execute(item)
-         """
-         d[key1] = os.path.basename(topdir)
-         for dir2 in glob.glob(topdir + "/*"):
-            d[key2] = os.path.basename(dir2)
-            if not re.match(r"[\d.]+", d[key2]):
-               continue
-            for dir3 in glob.glob(dir2 + "/*"):
-               d[key3] = os.path.basename(dir3)
-               if not d[key3] in ("darwin", "windows", "linux"):
-                  continue
-               for k, v in aitems.iteritems():
-                  tgt = dir3 + "/" + k
-                  if not os.path.isdir(tgt):
-                     continue
-                  contents = glob.glob(tgt + "/*")
-                  for nameOrExp, action in v:
-                     if not action.setup(dir3, dryRun=dryRun, verbose=verbose, **d):
-                        continue
-                     if type(nameOrExp) in (str, unicode):
-                        for item in glob.glob(tgt + "/" + nameOrExp):
-                           action.execute(item)
-                     else:
-                        for item in filter(lambda x: nameOrExp.match(os.path.basename(x)), contents):
-                           action.execute(item)
-         """
+   executor = Executor(jobs=jobs, dryRun=dryRun, verbose=verbose, store=store)
+   journal = Journal(thisdir + "/.prepxtoa.journal")
+   done = None
+
+   if journal.exists():
+      plan, entries = journal.read()
+      if rollback:
+         if not executor.undo(plan, entries):
+            sys.exit(1)
+         if not dryRun:
+            journal.remove()
+         sys.exit(0)
+      if not resume:
+         print("ERROR: Previous run was interrupted, use --resume or --rollback")
+         sys.exit(1)
+      done = set([tuple(x["done"]) for x in entries if "done" in x])
+      # revert partially applied operations before running them again
+      executor.undo(plan, [x for x in entries if "begin" in x and not tuple(x["begin"]) in done])
+   elif resume or rollback:
+      print("No interrupted run")
+      sys.exit(0)
+   elif "--apply" in planpaths:
+      try:
+         plan = Plan.load(planpaths["--apply"])
+      except Exception, e:
+         print("ERROR: Could not load plan '%s' (%s)" % (planpaths["--apply"], e))
+         sys.exit(1)
+   else:
+      plan = Plan.scan(thisdir, specs, stamps=(None if full else stamps), verbose=verbose)
+
+   if "--save-plan" in planpaths:
+      try:
+         plan.save(planpaths["--save-plan"])
+      except Exception, e:
+         print("ERROR: Could not save plan '%s' (%s)" % (planpaths["--save-plan"], e))
+         sys.exit(1)
+      print("%d operation(s) in %d tree(s) saved to '%s'" % (sum([len(x["ops"]) for x in plan.trees]), len(plan.trees), planpaths["--save-plan"]))
+      sys.exit(0)
+
+   if dryRun:
+      executor.run(plan, done=done)
+   else:
+      if done is None:
+         journal.start(plan)
+      else:
+         journal.reopen()
+      failed = executor.run(plan, journal=journal, done=done)
+      journal.remove()
+
+      for tree in plan.trees:
+         if tree["folder"] not in failed:
+            stamps.update(tree["key"], tree["folder"], tree["rules"], tree["dirs"])
+      try:
+         stamps.save()
+      except Exception, e:
+         print("ERROR: Could not save stamp database (%s)" % e)
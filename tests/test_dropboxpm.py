@@ -0,0 +1,1001 @@
+import os
+import re
+import sys
+import json
+import stat
+import shutil
+import hashlib
+import tarfile
+import zipfile
+import tempfile
+import platform
+import threading
+import subprocess
+import time
+import unittest
+import StringIO
+import BaseHTTPServer
+import SocketServer
+from urllib2 import urlopen, Request, HTTPError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dropboxpm
+
+
+def version_info(deps=None):
+    return {"linux": {"package": "pk", "dependencies": (deps if deps else {})}}
+
+resolve_index = {"MtoA": {"versions": {"2.0.2.3": version_info({"arnold": "5.0.1.4+"}),
+                                       "2.0.1.0": version_info({"arnold": "5.0.0.0+"}),
+                                       "1.4.2.0": version_info({"arnold": "4.2.16.0"})}},
+                 "arnold": {"versions": {"5.0.1.4": version_info(),
+                                         "5.0.0.0": version_info(),
+                                         "4.2.16.0": version_info(),
+                                         "4.2.12.0": version_info()}},
+                 "A": {"versions": {"2": version_info({"C": "2"}),
+                                    "1": version_info({"C": "1"})}},
+                 "B": {"versions": {"1": version_info({"C": "<2"})}},
+                 "C": {"versions": {"1": version_info(),
+                                    "2": version_info()}}}
+
+
+class ResolvePackagesTest(unittest.TestCase):
+    def resolve(self, packages):
+        return dropboxpm.resolve_packages(resolve_index, packages, "packages", "linux")
+    
+    def test_latest(self):
+        self.assertEqual(self.resolve(["MtoA"]), [("MtoA", "2.0.2.3"), ("arnold", "5.0.1.4")])
+    
+    def test_backtrack_requester(self):
+        # MtoA 2.x requires arnold 5, only MtoA 1.4.2.0 works with arnold<5
+        self.assertEqual(self.resolve(["MtoA", "arnold<5"]), [("MtoA", "1.4.2.0"), ("arnold", "4.2.16.0")])
+    
+    def test_backtrack_indirect(self):
+        self.assertEqual(self.resolve(["A", "B"]), [("A", "1"), ("B", "1"), ("C", "1")])
+    
+    def test_conflict(self):
+        self.assertEqual(self.resolve(["MtoA", "arnold<4"]), None)
+        self.assertEqual(self.resolve(["MtoA2.0.2.3", "arnold<5"]), None)
+    
+    def test_unknown(self):
+        self.assertEqual(self.resolve(["MtoA", "unknown"]), None)
+    
+    def test_install_nothing_on_conflict(self):
+        outdir = tempfile.mkdtemp()
+        try:
+            self.assertFalse(dropboxpm.install_packages(resolve_index, ["MtoA", "arnold<4"], outdir))
+            self.assertEqual(os.listdir(outdir), [])
+        finally:
+            shutil.rmtree(outdir)
+
+
+
+class CompiledIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.indexpath = os.path.join(self.tmpdir, "index.json")
+        self.compiled = []
+        self.compile_index = dropboxpm.compile_index
+        def compile_index(index):
+            self.compiled.append(index)
+            return self.compile_index(index)
+        dropboxpm.compile_index = compile_index
+    
+    def tearDown(self):
+        dropboxpm.compile_index = self.compile_index
+        shutil.rmtree(self.tmpdir)
+    
+    def write_index(self, index, mtime):
+        with open(self.indexpath, "w") as f:
+            json.dump(index, f)
+        os.utime(self.indexpath, (mtime, mtime))
+    
+    def load(self):
+        with open(self.indexpath, "r") as f:
+            index = json.load(f)
+        return dropboxpm.load_compiled_index(index, self.indexpath)
+    
+    def test_cache_key(self):
+        self.write_index(resolve_index, 1500000000)
+        self.load()
+        self.load()
+        self.assertEqual(len(self.compiled), 1)
+        
+        # same size, different modification time
+        self.write_index(resolve_index, 1500000001)
+        self.load()
+        self.assertEqual(len(self.compiled), 2)
+        
+        # same modification time, different size
+        index = dict(resolve_index)
+        index["D"] = {"versions": {"1": version_info()}}
+        self.write_index(index, 1500000001)
+        compiled = self.load()
+        self.assertEqual(len(self.compiled), 3)
+        self.assertEqual(dropboxpm.get_compiled_versions(compiled, "packages", "D", "linux"), ["1"])
+    
+    def test_host_platform(self):
+        index = {"A": {"versions": {"1": {"common": {"package": "pk", "dependencies": {"B": "1"}}},
+                                    "2": {"linux": {"package": "pk", "dependencies": {"B": "2"}}}}}}
+        system = platform.system
+        platform.system = lambda: "Plan9"
+        try:
+            compiled = dropboxpm.compile_index(index)
+        finally:
+            platform.system = system
+        self.assertEqual(compiled, dropboxpm.compile_index(index))
+        
+        self.assertEqual(dropboxpm.get_compiled_versions(compiled, "packages", "A", "linux"), ["2", "1"])
+        self.assertEqual(dropboxpm.get_compiled_versions(compiled, "packages", "A", "freebsd"), ["1"])
+        self.assertEqual(dropboxpm.get_compiled_dependencies(compiled, "A", "2", "linux"), {"B": "2"})
+        self.assertEqual(dropboxpm.get_compiled_dependencies(compiled, "A", "1", "freebsd"), {"B": "1"})
+
+
+class ContentHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Serves server.content, honours 'Range: bytes=N-' unless server.ranges
+    # is False and records the Range header of every request
+    def do_GET(self):
+        self.server.requests.append(self.headers.getheader("Range"))
+        content = self.server.content
+        offset = 0
+        m = re.match(r"^bytes=(\d+)-$", self.headers.getheader("Range", ""))
+        if m and self.server.ranges:
+            offset = int(m.group(1))
+            if offset >= len(content):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (offset, len(content) - 1, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(content) - offset))
+        self.end_headers()
+        self.wfile.write(content[offset:])
+    
+    def log_message(self, *args):
+        pass
+
+class ContentServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class FilesHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Serves server.files by base name, after server.delays seconds, with an
+    # ETag, and records the requested names, their If-None-Match header and
+    # the maximum number of requests served concurrently
+    def do_GET(self):
+        name = os.path.basename(self.path.split("?")[0])
+        with self.server.lock:
+            self.server.requests.append(name)
+            self.server.validators.append(self.headers.getheader("If-None-Match"))
+            self.server.started.setdefault(name, time.time())
+            self.server.active += 1
+            self.server.maxactive = max(self.server.maxactive, self.server.active)
+        try:
+            time.sleep(self.server.delays.get(name, self.server.delay))
+            if not name in self.server.files:
+                self.send_error(404, "File not found")
+                return
+            content = self.server.files[name]
+            etag = '"%s"' % hashlib.sha1(content).hexdigest()
+            if self.headers.getheader("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+    
+    def log_message(self, *args):
+        pass
+
+class FilesServer(ContentServer):
+    def __init__(self):
+        ContentServer.__init__(self, ("127.0.0.1", 0), FilesHandler)
+        self.files = {}
+        self.delay = 0
+        self.delays = {}
+        self.requests = []
+        self.validators = []
+        self.started = {}
+        self.lock = threading.Lock()
+        self.active = 0
+        self.maxactive = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+    
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def make_tgz(files):
+    # {member name: content} -> .tgz archive content
+    buf = StringIO.StringIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as t:
+        for name in sorted(files.keys()):
+            info = tarfile.TarInfo(name)
+            info.size = len(files[name])
+            info.mtime = 1500000000
+            t.addfile(info, StringIO.StringIO(files[name]))
+    return buf.getvalue()
+
+class RepoTestCase(unittest.TestCase):
+    # Temporary output directory and cache, archives served by a FilesServer
+    # used as the dropboxpm mirror
+    plat = platform.system().lower()
+    
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.outdir = os.path.join(self.tmpdir, "out")
+        self.server = FilesServer()
+        self.saved = (dropboxpm.mirror_url, dropboxpm.cache_dir)
+        dropboxpm.mirror_url = self.server.url()
+        dropboxpm.cache_dir = os.path.join(self.tmpdir, "cache")
+        self.index = {}
+    
+    def tearDown(self):
+        dropboxpm.mirror_url, dropboxpm.cache_dir = self.saved
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+    
+    def add_package(self, name, version, files, checksum=True, serve=True):
+        # package with a single platform archive, returns the archive name
+        filename = "%s%s_%s.tgz" % (name, version, self.plat)
+        content = make_tgz(files)
+        info = {"package": "pk"}
+        if checksum:
+            info["sha256"] = hashlib.sha256(content).hexdigest()
+        self.index.setdefault(name, {"versions": {}})["versions"][version] = {self.plat: info}
+        if serve:
+            self.server.files[filename] = content
+        return filename
+    
+    def capture(self, func, *args, **kwargs):
+        # (func result, stdout content)
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            rv = func(*args, **kwargs)
+            return (rv, sys.stdout.getvalue())
+        finally:
+            sys.stdout = stdout
+
+
+class DownloadTest(unittest.TestCase):
+    content = "".join([chr(i % 251) for i in xrange(3 * 1024 * 1024 + 17)])
+    
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+        self.server = ContentServer(("127.0.0.1", 0), ContentHandler)
+        self.server.content = self.content
+        self.server.ranges = True
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d/pkg.tar.gz" % self.server.server_address[1]
+        self.outpath = os.path.join(self.outdir, "pkg.tar.gz")
+        self.partpath = self.outpath + ".part"
+    
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.outdir)
+    
+    def write_part(self, content):
+        with open(self.partpath, "wb") as f:
+            f.write(content)
+    
+    def read_output(self):
+        with open(self.outpath, "rb") as f:
+            return f.read()
+    
+    def test_download(self):
+        checksum = hashlib.sha256(self.content).hexdigest()
+        self.assertEqual(dropboxpm.download(self.url, self.outdir, checksum=checksum), self.outpath)
+        self.assertEqual(self.read_output(), self.content)
+        self.assertFalse(os.path.exists(self.partpath))
+        self.assertEqual(self.server.requests, [None])
+    
+    def test_resume(self):
+        # interrupted transfer, only the missing bytes are requested
+        self.write_part(self.content[:1000001])
+        checksum = hashlib.sha256(self.content).hexdigest()
+        self.assertEqual(dropboxpm.download(self.url, self.outdir, checksum=checksum), self.outpath)
+        self.assertEqual(self.read_output(), self.content)
+        self.assertFalse(os.path.exists(self.partpath))
+        self.assertEqual(self.server.requests, ["bytes=1000001-"])
+    
+    def test_open_download_resume(self):
+        self.write_part(self.content[:10])
+        u, offset, expected = dropboxpm.open_download(self.url, self.partpath)
+        try:
+            self.assertEqual(u.getcode(), 206)
+            self.assertEqual((offset, expected), (10, len(self.content)))
+            self.assertEqual(u.read(), self.content[10:])
+        finally:
+            u.close()
+    
+    def test_range_ignored(self):
+        # a 200 response carries the whole content, start over from zero
+        self.server.ranges = False
+        self.write_part(self.content[:1000001])
+        u, offset, expected = dropboxpm.open_download(self.url, self.partpath)
+        try:
+            self.assertEqual(u.getcode(), 200)
+            self.assertEqual(u.read(), self.content)
+        finally:
+            u.close()
+        self.assertEqual((offset, expected), (0, len(self.content)))
+        
+        self.assertEqual(dropboxpm.download(self.url, self.outdir), self.outpath)
+        self.assertEqual(self.read_output(), self.content)
+        self.assertEqual(self.server.requests, ["bytes=1000001-", "bytes=1000001-"])
+    
+    def test_range_not_satisfiable(self):
+        # .part file at least as large as the content
+        self.write_part(self.content + "garbage")
+        self.assertEqual(dropboxpm.download(self.url, self.outdir), self.outpath)
+        self.assertEqual(self.read_output(), self.content)
+        self.assertEqual(self.server.requests, ["bytes=%d-" % (len(self.content) + 7), None])
+    
+    def test_checksum_mismatch_refetch(self):
+        # corrupted partial content is detected once complete, the whole
+        # archive is fetched again
+        self.write_part("x" * 1000001)
+        checksum = hashlib.sha256(self.content).hexdigest()
+        self.assertEqual(dropboxpm.download(self.url, self.outdir, checksum=checksum), self.outpath)
+        self.assertEqual(self.read_output(), self.content)
+        self.assertFalse(os.path.exists(self.partpath))
+        self.assertEqual(self.server.requests, ["bytes=1000001-", None])
+    
+    def test_checksum_mismatch(self):
+        # nothing to resume, the content itself is wrong
+        checksum = hashlib.sha256("other").hexdigest()
+        self.assertEqual(dropboxpm.download(self.url, self.outdir, checksum=checksum), None)
+        self.assertFalse(os.path.exists(self.outpath))
+        self.assertFalse(os.path.exists(self.partpath))
+        self.assertEqual(self.server.requests, [None])
+    
+    def test_complete_download_incomplete(self):
+        # truncated transfer, the .part file is kept for a later resume
+        self.write_part(self.content[:10])
+        self.assertFalse(dropboxpm.complete_download(self.url, self.partpath, self.outpath, len(self.content)))
+        self.assertTrue(os.path.exists(self.partpath))
+        self.assertFalse(os.path.exists(self.outpath))
+
+
+class MirrorTest(unittest.TestCase):
+    # dropboxpm --serve on an ephemeral port, used by dropboxpm --mirror
+    script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dropboxpm.py")
+    
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.mirrordir = os.path.join(self.tmpdir, "mirror")
+        self.outdir = os.path.join(self.tmpdir, "out")
+        self.env = dict(os.environ)
+        self.env["DROPBOXPM_CACHE"] = os.path.join(self.tmpdir, "cache")
+        self.env.pop("DROPBOXPM_MIRROR", None)
+        
+        # one archive already in the mirror downloads, nothing upstream
+        self.plat = platform.system().lower()
+        self.filename = "tool1.0_%s.tgz" % self.plat
+        os.makedirs(os.path.join(self.tmpdir, "src", "bin"))
+        with open(os.path.join(self.tmpdir, "src", "bin", "tool"), "w") as f:
+            f.write("tool\n" * 10000)
+        os.makedirs(os.path.join(self.mirrordir, "downloads"))
+        self.archive = os.path.join(self.mirrordir, "downloads", self.filename)
+        with tarfile.open(self.archive, "w:gz") as t:
+            t.add(os.path.join(self.tmpdir, "src", "bin"), "bin")
+        with open(self.archive, "rb") as f:
+            self.content = f.read()
+        self.index = {"tool": {"versions": {"1.0": {self.plat: {"package": "pk", "sha256": hashlib.sha256(self.content).hexdigest()}}}}}
+        with open(os.path.join(self.mirrordir, "index.json"), "w") as f:
+            json.dump(self.index, f)
+        
+        self.server = subprocess.Popen([sys.executable, "-u", self.script, "--serve", "127.0.0.1:0", "-o", self.mirrordir],
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=self.env)
+        line = self.server.stdout.readline()
+        m = re.match(r"^Serving .* on 127\.0\.0\.1:(\d+)$", line.strip())
+        if m is None:
+            self.tearDown()
+            self.fail("Server failed to start (%s)" % line.strip())
+        self.url = "http://127.0.0.1:%s" % m.group(1)
+    
+    def tearDown(self):
+        if self.server.poll() is None:
+            self.server.terminate()
+        self.server.wait()
+        self.server.stdout.close()
+        shutil.rmtree(self.tmpdir)
+    
+    def run_client(self, *args):
+        p = subprocess.Popen([sys.executable, self.script, "--mirror", self.url, "-o", self.outdir, "-v"] + list(args),
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=self.env)
+        out, _ = p.communicate()
+        return (p.returncode, out)
+    
+    def test_index(self):
+        u = urlopen(self.url + "/index.json")
+        try:
+            self.assertEqual(json.loads(u.read()), self.index)
+            etag = u.info().getheader("ETag")
+        finally:
+            u.close()
+        self.assertTrue(etag)
+        
+        req = Request(self.url + "/index.json")
+        req.add_header("If-None-Match", etag)
+        with self.assertRaises(HTTPError) as cm:
+            urlopen(req)
+        self.assertEqual(cm.exception.code, 304)
+        
+        req = Request(self.url + "/index.json")
+        req.add_header("If-None-Match", '"0-0"')
+        u = urlopen(req)
+        self.assertEqual(u.getcode(), 200)
+        u.close()
+    
+    def test_range(self):
+        req = Request(self.url + "/downloads/" + self.filename)
+        req.add_header("Range", "bytes=100-")
+        u = urlopen(req)
+        try:
+            self.assertEqual(u.getcode(), 206)
+            self.assertEqual(u.info().getheader("Content-Range"), "bytes 100-%d/%d" % (len(self.content) - 1, len(self.content)))
+            self.assertEqual(u.read(), self.content[100:])
+        finally:
+            u.close()
+        
+        req = Request(self.url + "/downloads/" + self.filename)
+        req.add_header("Range", "bytes=%d-" % len(self.content))
+        with self.assertRaises(HTTPError) as cm:
+            urlopen(req)
+        self.assertEqual(cm.exception.code, 416)
+        
+        for path in ("/downloads/missing.tgz", "/downloads/../index.json", "/other"):
+            with self.assertRaises(HTTPError) as cm:
+                urlopen(self.url + path)
+            self.assertEqual(cm.exception.code, 404)
+    
+    def test_install(self):
+        # interrupted download left in the client, resumed through the mirror
+        os.makedirs(os.path.join(self.outdir, "downloads"))
+        with open(os.path.join(self.outdir, "downloads", self.filename + ".part"), "wb") as f:
+            f.write(self.content[:100])
+        
+        rv, out = self.run_client("-i", "tool")
+        self.assertEqual(rv, 0, out)
+        self.assertIn("Resuming %s/downloads/%s (100 bytes already downloaded)" % (self.url, self.filename), out)
+        with open(os.path.join(self.outdir, "tool", "1.0", self.plat, "bin", "tool"), "r") as f:
+            self.assertEqual(f.read(), "tool\n" * 10000)
+        
+        # expired index refreshed with a conditional request, the mirror
+        # answers 304
+        metapath = os.path.join(self.outdir, "index.json.meta")
+        with open(metapath) as f:
+            meta = json.load(f)
+        meta["fetched"] = 0
+        with open(metapath, "w") as f:
+            json.dump(meta, f)
+        rv, out = self.run_client("--index-ttl", "60", "-l")
+        self.assertEqual(rv, 0, out)
+        self.assertIn("Index is up to date.", out)
+
+
+class SyncLockfileTest(unittest.TestCase):
+    # environments served by an in process mirror of a temporary directory
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.mirrordir = os.path.join(self.tmpdir, "mirror")
+        self.outdir = os.path.join(self.tmpdir, "out")
+        os.makedirs(os.path.join(self.mirrordir, "downloads"))
+        os.makedirs(self.outdir)
+        with open(os.path.join(self.mirrordir, "downloads", "shot1.0.env"), "w") as f:
+            f.write("{}")
+        plat = platform.system().lower()
+        # 'nofile' and 'gone' versions do not provide any environment file
+        self.index = {"shot": {"versions": {"1.0": {"common": {"environment": "pk/shot1.0.env"}}}},
+                      "nofile": {"versions": {"1.0": {plat: {"package": "pk"}}}},
+                      "gone": {"versions": {"1.0": {plat: {"package": "pk"}}}}}
+        self.lockpath = os.path.join(self.tmpdir, "dropboxpm.lock")
+        
+        self.server = dropboxpm.MirrorServer(("127.0.0.1", 0), self.mirrordir, self.index)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.mirror_url = dropboxpm.mirror_url
+        dropboxpm.mirror_url = "http://127.0.0.1:%d" % self.server.server_address[1]
+    
+    def tearDown(self):
+        dropboxpm.mirror_url = self.mirror_url
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+    
+    def write_lockfile(self, envs):
+        with open(self.lockpath, "w") as f:
+            json.dump({"format": dropboxpm.lockfile_format,
+                       "packages": [],
+                       "environments": [{"name": x, "version": y} for x, y in envs]}, f)
+    
+    def test_install(self):
+        self.write_lockfile([("shot", "1.0")])
+        self.assertTrue(dropboxpm.sync_lockfile(self.index, self.lockpath, self.outdir))
+        self.assertTrue(os.path.isfile(os.path.join(self.outdir, "shot1.0.env")))
+        self.assertEqual(dropboxpm.list_installed(self.index, self.outdir, env=True), [("shot", "1.0")])
+    
+    def test_no_environment_file(self):
+        # locked or installed versions without environment are reported, the
+        # rest is still synced
+        state = {"format": dropboxpm.install_state_format, "packages": {}, "environments": {}}
+        dropboxpm.set_environment_state(state, "gone", "1.0", "gone1.0.env")
+        dropboxpm.write_install_state(self.outdir, state)
+        
+        self.write_lockfile([("nofile", "1.0"), ("shot", "1.0")])
+        self.assertFalse(dropboxpm.sync_lockfile(self.index, self.lockpath, self.outdir))
+        self.assertTrue(os.path.isfile(os.path.join(self.outdir, "shot1.0.env")))
+        self.assertEqual(dropboxpm.list_installed(self.index, self.outdir, env=True), [("gone", "1.0"), ("shot", "1.0")])
+        
+        self.assertEqual(dropboxpm.get_environment_urls(self.index, [("gone", "1.0"), ("nofile", "1.0")]), {})
+
+
+
+class InstallTest(RepoTestCase):
+    def test_jobs(self):
+        for name in ("pa", "pb", "pc", "pd"):
+            self.add_package(name, "1.0", {"bin/" + name: name})
+        self.server.delay = 0.3
+        rv, out = self.capture(dropboxpm.install_packages, self.index, ["pa", "pb", "pc", "pd"], self.outdir, jobs=4)
+        self.assertTrue(rv, out)
+        self.assertGreater(self.server.maxactive, 1)
+        self.assertEqual(sorted(self.server.requests), ["pa1.0_%s.tgz" % self.plat, "pb1.0_%s.tgz" % self.plat, "pc1.0_%s.tgz" % self.plat, "pd1.0_%s.tgz" % self.plat])
+        for name in ("pa", "pb", "pc", "pd"):
+            with open(os.path.join(self.outdir, name, "1.0", self.plat, "bin", name)) as f:
+                self.assertEqual(f.read(), name)
+        # one progress line per package
+        progress = re.findall(r"^\[(\d)/4\] Installed (\w+) 1\.0", out, re.M)
+        self.assertEqual(sorted([x[0] for x in progress]), ["1", "2", "3", "4"])
+        self.assertEqual(sorted([x[1] for x in progress]), ["pa", "pb", "pc", "pd"])
+        self.assertEqual(dropboxpm.list_installed(self.index, self.outdir), [("pa", "1.0"), ("pb", "1.0"), ("pc", "1.0"), ("pd", "1.0")])
+    
+    def test_local_archives_do_not_wait(self):
+        # an archive already downloaded is installed while the others are
+        # still being fetched
+        filename = self.add_package("pa", "1.0", {"bin/pa": "pa"})
+        os.makedirs(os.path.join(self.outdir, "downloads"))
+        with open(os.path.join(self.outdir, "downloads", filename), "wb") as f:
+            f.write(self.server.files.pop(filename))
+        self.add_package("pb", "1.0", {"bin/pb": "pb"})
+        
+        extracted = {}
+        extract_tar = dropboxpm.extract_tar
+        def slow_extract_tar(path, outdir, verbose=False):
+            time.sleep(0.5)
+            extracted[os.path.basename(path)] = time.time()
+            return extract_tar(path, outdir, verbose=verbose)
+        dropboxpm.extract_tar = slow_extract_tar
+        try:
+            rv, out = self.capture(dropboxpm.install_packages, self.index, ["pa", "pb"], self.outdir, jobs=2)
+        finally:
+            dropboxpm.extract_tar = extract_tar
+        self.assertTrue(rv, out)
+        self.assertEqual(self.server.requests, ["pb1.0_%s.tgz" % self.plat])
+        self.assertLess(self.server.started["pb1.0_%s.tgz" % self.plat], extracted[filename])
+    
+    def test_errors_in_install_order(self):
+        for name in ("pa", "pb", "pc", "pd"):
+            self.add_package(name, "1.0", {"bin/" + name: name}, serve=(name in ("pa", "pc")))
+        # pd fails first
+        self.server.delays = {"pb1.0_%s.tgz" % self.plat: 0.5}
+        rv, out = self.capture(dropboxpm.install_packages, self.index, ["pa", "pb", "pc", "pd"], self.outdir, jobs=4)
+        self.assertFalse(rv)
+        report = out[out.index("Failed to install:"):].splitlines()[1:]
+        self.assertEqual(report, ["  pb 1.0: pb1.0_%s.tgz (download failed)" % self.plat,
+                                  "  pd 1.0: pd1.0_%s.tgz (download failed)" % self.plat])
+        self.assertEqual(dropboxpm.list_installed(self.index, self.outdir), [("pa", "1.0"), ("pc", "1.0")])
+
+
+class InstallStateTest(RepoTestCase):
+    def setUp(self):
+        RepoTestCase.setUp(self)
+        self.add_package("pa", "1.0", {"bin/pa": "pa"})
+        rv, out = self.capture(dropboxpm.install_packages, self.index, ["pa"], self.outdir)
+        self.assertTrue(rv, out)
+        self.statepath = os.path.join(self.outdir, "installed.json")
+        self.lockpath = self.statepath + ".lock"
+    
+    def test_str(self):
+        # same types from installed.json and from a scan
+        for verify in (False, True):
+            installed = dropboxpm.list_installed(self.index, self.outdir, verify=verify)
+            self.assertEqual(installed, [("pa", "1.0")])
+            self.assertEqual([type(x) for x in installed[0]], [str, str])
+    
+    def test_list_only(self):
+        os.remove(self.statepath)
+        rv, out = self.capture(dropboxpm.list_installed_packages, self.index, self.outdir)
+        self.assertEqual(out, "pa 1.0\n")
+        rv, out = self.capture(dropboxpm.list_installed_packages, self.index, self.outdir, verify=True)
+        self.assertEqual(out, "pa 1.0\n")
+        self.assertFalse(os.path.exists(self.statepath))
+    
+    def test_stale_lock(self):
+        # owner process is gone, whatever the lock age
+        p = subprocess.Popen([sys.executable, "-c", "pass"])
+        p.wait()
+        with open(self.lockpath, "w") as f:
+            f.write("%s %d" % (platform.node(), p.pid))
+        start = time.time()
+        dropboxpm.update_install_state(self.index, self.outdir, lambda x: None)
+        self.assertLess(time.time() - start, 5)
+        self.assertFalse(os.path.exists(self.lockpath))
+    
+    def test_held_lock(self):
+        # owner process is alive, the lock is waited for even when old
+        with open(self.lockpath, "w") as f:
+            f.write("%s %d" % (platform.node(), os.getpid()))
+        os.utime(self.lockpath, (1500000000, 1500000000))
+        done = []
+        def update():
+            self.capture(dropboxpm.update_install_state, self.index, self.outdir, lambda x: None)
+            done.append(True)
+        t = threading.Thread(target=update)
+        t.start()
+        time.sleep(0.5)
+        self.assertEqual(done, [])
+        os.remove(self.lockpath)
+        t.join(5)
+        self.assertEqual(done, [True])
+
+
+class PipelineTest(RepoTestCase):
+    def setUp(self):
+        RepoTestCase.setUp(self)
+        # random data does not compress, the archive is truncated after the
+        # first member
+        self.filename = self.add_package("pa", "1.0", {"bin/a": os.urandom(256 * 1024), "bin/b": os.urandom(256 * 1024)})
+        self.prefix = os.path.join(self.outdir, "pa", "1.0", self.plat)
+    
+    def install(self):
+        return self.capture(dropboxpm.install_packages, self.index, ["pa"], self.outdir, jobs=2, pipeline=True)
+    
+    def test_install(self):
+        rv, out = self.install()
+        self.assertTrue(rv, out)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.prefix, "bin"))), ["a", "b"])
+        self.assertEqual(sorted(dropboxpm.read_manifest(dropboxpm.get_manifest_path(self.outdir, self.filename))), ["bin/a", "bin/b"])
+        with open(os.path.join(self.outdir, "downloads", self.filename), "rb") as f:
+            self.assertEqual(f.read(), self.server.files[self.filename])
+        self.assertEqual(dropboxpm.list_installed(self.index, self.outdir), [("pa", "1.0")])
+    
+    def test_broken_stream(self):
+        content = self.server.files[self.filename]
+        self.server.files[self.filename] = content[:len(content) * 3 / 4]
+        rv, out = self.install()
+        self.assertFalse(rv, out)
+        self.assertIn("Rollback %s extraction" % self.filename, out)
+        self.assertFalse(os.path.exists(os.path.join(self.outdir, "pa")))
+        self.assertFalse(os.path.exists(os.path.join(self.outdir, "downloads", self.filename)))
+        self.assertEqual(dropboxpm.list_installed(self.index, self.outdir), [])
+        
+        # next install goes through
+        self.server.files[self.filename] = content
+        rv, out = self.install()
+        self.assertTrue(rv, out)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.prefix, "bin"))), ["a", "b"])
+
+
+class PrefetchTest(RepoTestCase):
+    def setUp(self):
+        RepoTestCase.setUp(self)
+        # pa archives: common plus one per platform, pb for linux only
+        self.archives = {}
+        verinfo = {}
+        for key in ("common", "darwin", "linux", "windows"):
+            filename = "pa1.0_%s.tgz" % key
+            content = make_tgz({"%s/pa" % key: key})
+            self.server.files[filename] = content
+            self.archives[filename] = content
+            verinfo[key] = {"package": "pk", "sha256": hashlib.sha256(content).hexdigest()}
+        self.index = {"pa": {"versions": {"1.0": verinfo}},
+                      "pb": {"versions": {"1.0": {"linux": {"package": "pk"}}}}}
+        self.server.files["pb1.0_linux.tgz"] = make_tgz({"pb": "pb"})
+    
+    def test_platforms(self):
+        self.server.delay = 0.3
+        rv, out = self.capture(dropboxpm.prefetch_archives, self.index, ["pa"], self.outdir, ["darwin", "linux", "windows"], jobs=3)
+        self.assertTrue(rv, out)
+        self.assertIn("Prefetched 4 archive(s) for darwin, linux, windows (4 downloaded)", out)
+        # the common archive is only fetched once
+        self.assertEqual(sorted(self.server.requests), sorted(self.archives.keys()))
+        self.assertGreater(self.server.maxactive, 1)
+        for filename, content in self.archives.iteritems():
+            with open(os.path.join(self.outdir, "downloads", filename), "rb") as f:
+                self.assertEqual(f.read(), content)
+        # nothing is installed
+        self.assertEqual(sorted(os.listdir(self.outdir)), ["downloads"])
+        
+        # already downloaded
+        rv, out = self.capture(dropboxpm.prefetch_archives, self.index, ["pa"], self.outdir, ["darwin", "linux", "windows"])
+        self.assertTrue(rv, out)
+        self.assertIn("(0 downloaded)", out)
+        self.assertEqual(len(self.server.requests), 4)
+        
+        # other output directories use the cache
+        rv, out = self.capture(dropboxpm.prefetch_archives, self.index, ["pa"], os.path.join(self.tmpdir, "other"), ["darwin"])
+        self.assertTrue(rv, out)
+        self.assertEqual(len(self.server.requests), 4)
+    
+    def test_unavailable(self):
+        # resolution fails for a platform, nothing is downloaded
+        rv, out = self.capture(dropboxpm.prefetch_archives, self.index, ["pb"], self.outdir, ["linux", "darwin"])
+        self.assertFalse(rv)
+        self.assertEqual(self.server.requests, [])
+
+
+class ManifestTest(RepoTestCase):
+    def test_uninstall(self):
+        filename = self.add_package("pa", "1.0", {"bin/pa": "pa", "lib/pa/plugins/a.so": "a"})
+        rv, out = self.capture(dropboxpm.install_packages, self.index, ["pa"], self.outdir)
+        self.assertTrue(rv, out)
+        manifestpath = dropboxpm.get_manifest_path(self.outdir, filename)
+        self.assertEqual(sorted(dropboxpm.read_manifest(manifestpath)), ["bin/pa", "lib/pa/plugins/a.so"])
+        
+        prefix = os.path.join(self.outdir, "pa", "1.0", self.plat)
+        with open(os.path.join(prefix, "lib", "user.txt"), "w") as f:
+            f.write("user")
+        # the archive is not needed anymore
+        os.remove(os.path.join(self.outdir, "downloads", filename))
+        
+        rv, out = self.capture(dropboxpm.uninstall_packages, self.index, ["pa"], self.outdir, force=True)
+        self.assertFalse(os.path.exists(manifestpath))
+        self.assertEqual(os.listdir(prefix), ["lib"])
+        self.assertEqual(os.listdir(os.path.join(prefix, "lib")), ["user.txt"])
+        self.assertEqual(dropboxpm.list_installed(self.index, self.outdir), [])
+        
+        # empty directories are removed up to the output directory
+        os.remove(os.path.join(prefix, "lib", "user.txt"))
+        rv, out = self.capture(dropboxpm.install_packages, self.index, ["pa"], self.outdir)
+        self.assertTrue(rv, out)
+        rv, out = self.capture(dropboxpm.uninstall_packages, self.index, ["pa"], self.outdir, force=True)
+        self.assertFalse(os.path.exists(os.path.join(self.outdir, "pa")))
+
+
+class VerifyAllTest(RepoTestCase):
+    def test_verify_all(self):
+        filename = self.add_package("pa", "1.0", {"bin/pa": "pa"})
+        self.add_package("p_b", "1.0", {"bin/pb": "pb"})
+        rv, out = self.capture(dropboxpm.install_packages, self.index, ["pa"], self.outdir)
+        self.assertTrue(rv, out)
+        downloaddir = os.path.join(self.outdir, "downloads")
+        archive = os.path.join(downloaddir, filename)
+        with open(archive, "ab") as f:
+            f.write("garbage")
+        # unrelated files, one starting with an index name
+        for name in ("p_b1.0.tgz", "notes_%s.txt" % self.plat, filename + ".bak"):
+            with open(os.path.join(downloaddir, name), "w") as f:
+                f.write(name)
+        
+        rv, out = self.capture(dropboxpm.verify_all, self.index, self.outdir, jobs=1)
+        self.assertTrue(rv, out)
+        self.assertEqual(out.count("CORRUPT"), 1)
+        self.assertIn("CORRUPT %s" % archive, out)
+        with open(archive, "rb") as f:
+            self.assertEqual(f.read(), self.server.files[filename])
+        self.assertEqual(sorted(os.listdir(downloaddir)), sorted([filename, filename + ".bak", "notes_%s.txt" % self.plat, "p_b1.0.tgz"]))
+
+
+class SyncChecksumTest(RepoTestCase):
+    # locked checksums of archives the index has none for
+    def sync(self, checksum):
+        lockpath = os.path.join(self.tmpdir, "dropboxpm.lock")
+        with open(lockpath, "w") as f:
+            json.dump({"format": dropboxpm.lockfile_format,
+                       "packages": [{"name": "pa", "version": "1.0", "platform": self.plat,
+                                     "archives": {self.filename: checksum}}],
+                       "environments": []}, f)
+        return self.capture(dropboxpm.sync_lockfile, self.index, lockpath, self.outdir)
+    
+    def setUp(self):
+        RepoTestCase.setUp(self)
+        self.filename = self.add_package("pa", "1.0", {"bin/pa": "pa"}, checksum=False)
+        self.checksum = hashlib.sha256(self.server.files[self.filename]).hexdigest()
+    
+    def test_mismatch(self):
+        index = json.loads(json.dumps(self.index))
+        rv, out = self.sync(hashlib.sha256("other").hexdigest())
+        self.assertFalse(rv, out)
+        self.assertEqual(self.index, index)
+        self.assertEqual(dropboxpm.list_installed(self.index, self.outdir), [])
+    
+    def test_match(self):
+        index = json.loads(json.dumps(self.index))
+        rv, out = self.sync(self.checksum)
+        self.assertTrue(rv, out)
+        self.assertEqual(self.index, index)
+        self.assertEqual(dropboxpm.list_installed(self.index, self.outdir), [("pa", "1.0")])
+        self.assertEqual(os.listdir(dropboxpm.cache_dir), [dropboxpm.cache_key("", self.checksum)])
+
+
+class ZipTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.zippath = os.path.join(self.tmpdir, "a.zip")
+        self.outdir = os.path.join(self.tmpdir, "out")
+        os.mkdir(self.outdir)
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def add_dir(self, z, name, unix=True):
+        info = zipfile.ZipInfo(name, (2017, 1, 1, 0, 0, 0))
+        if unix:
+            info.create_system = 3
+            info.external_attr = (stat.S_IFDIR | 0755) << 16
+        else:
+            info.create_system = 0
+            info.external_attr = 0x10
+        z.writestr(info, "")
+    
+    def test_directory_entries(self):
+        # directory entries without trailing '/', flagged by their attributes
+        with zipfile.ZipFile(self.zippath, "w") as z:
+            self.add_dir(z, "unix")
+            self.add_dir(z, "dos", unix=False)
+            self.add_dir(z, "slash/")
+            z.writestr("bin/a", "a")
+        names = dropboxpm.extract_zip(self.zippath, self.outdir)
+        self.assertEqual(sorted(names), ["bin/a", "dos/", "slash/", "unix/"])
+        for name in ("unix", "dos", "slash"):
+            self.assertTrue(os.path.isdir(os.path.join(self.outdir, name)))
+        dropboxpm.remove_manifest_files(names, self.outdir)
+        self.assertEqual(os.listdir(self.outdir), [])
+
+
+class CacheTest(RepoTestCase):
+    def setUp(self):
+        RepoTestCase.setUp(self)
+        self.filename = self.add_package("pa", "1.0", {"bin/pa": "pa"})
+        self.content = self.server.files[self.filename]
+        self.cachepath = os.path.join(dropboxpm.cache_dir, dropboxpm.cache_key("", hashlib.sha256(self.content).hexdigest()))
+    
+    def install(self, outdir):
+        rv, out = self.capture(dropboxpm.install_packages, self.index, ["pa"], outdir, verbose=True)
+        self.assertTrue(rv, out)
+        with open(os.path.join(outdir, "pa", "1.0", self.plat, "bin", "pa")) as f:
+            self.assertEqual(f.read(), "pa")
+        return out
+    
+    def read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+    
+    def test_shared(self):
+        # two output directories, a single download
+        outa = os.path.join(self.tmpdir, "a")
+        outb = os.path.join(self.tmpdir, "b")
+        self.install(outa)
+        self.assertIn("pa 1.0 found in cache.", self.install(outb))
+        self.assertEqual(self.server.requests, [self.filename])
+        self.assertEqual(stat.S_IMODE(os.stat(self.cachepath).st_mode), 0444)
+        
+        # copies never share their content
+        patha = os.path.join(outa, "downloads", self.filename)
+        pathb = os.path.join(outb, "downloads", self.filename)
+        self.assertNotEqual(os.stat(patha).st_ino, os.stat(self.cachepath).st_ino)
+        self.assertNotEqual(os.stat(pathb).st_ino, os.stat(self.cachepath).st_ino)
+        with open(patha, "ab") as f:
+            f.write("garbage")
+        self.assertEqual(self.read(pathb), self.content)
+        self.assertEqual(self.read(self.cachepath), self.content)
+        
+        # using the cache entry does not touch the other copies
+        os.utime(pathb, (1500000000, 1500000000))
+        self.assertEqual(dropboxpm.cache_lookup(os.path.basename(self.cachepath)), self.cachepath)
+        self.assertEqual(os.stat(pathb).st_mtime, 1500000000)
+    
+    def test_corrupted_entry(self):
+        self.install(os.path.join(self.tmpdir, "a"))
+        os.chmod(self.cachepath, 0644)
+        with open(self.cachepath, "ab") as f:
+            f.write("garbage")
+        out = self.install(os.path.join(self.tmpdir, "b"))
+        self.assertIn("Cached %s is corrupted" % self.filename, out)
+        self.assertEqual(self.server.requests, [self.filename, self.filename])
+        self.assertEqual(self.read(self.cachepath), self.content)
+        self.assertEqual(stat.S_IMODE(os.stat(self.cachepath).st_mode), 0444)
+    
+    def test_evict(self):
+        self.add_package("pb", "1.0", {"bin/pb": "pb" * 1000})
+        self.install(os.path.join(self.tmpdir, "a"))
+        cache_size = dropboxpm.cache_size
+        dropboxpm.cache_size = 1
+        try:
+            rv, out = self.capture(dropboxpm.install_packages, self.index, ["pb"], os.path.join(self.tmpdir, "a"))
+        finally:
+            dropboxpm.cache_size = cache_size
+        self.assertTrue(rv, out)
+        # the least recently used entry goes, the one just stored is kept
+        self.assertEqual(os.listdir(dropboxpm.cache_dir), [dropboxpm.cache_key("", self.index["pb"]["versions"]["1.0"][self.plat]["sha256"])])
+
+
+
+class FetchIndexTest(RepoTestCase):
+    def setUp(self):
+        RepoTestCase.setUp(self)
+        os.makedirs(self.outdir)
+        self.index_url = dropboxpm.index_url
+        dropboxpm.index_url = self.server.url() + "/index.json"
+        self.server.files["index.json"] = json.dumps({"pa": {"versions": {}}})
+    
+    def tearDown(self):
+        dropboxpm.index_url = self.index_url
+        RepoTestCase.tearDown(self)
+    
+    def fetch(self, **kwargs):
+        return self.capture(dropboxpm.fetch_index, self.outdir, **kwargs)[0]
+    
+    def age(self, seconds):
+        metapath = os.path.join(self.outdir, "index.json.meta")
+        with open(metapath) as f:
+            meta = json.load(f)
+        meta["fetched"] -= seconds
+        with open(metapath, "w") as f:
+            json.dump(meta, f)
+    
+    def test_local_copy(self):
+        self.assertEqual(self.fetch(), {"pa": {"versions": {}}})
+        self.assertEqual(self.fetch(), {"pa": {"versions": {}}})
+        self.assertEqual(self.server.requests, ["index.json"])
+    
+    def test_ttl(self):
+        self.fetch(ttl=60)
+        self.server.files["index.json"] = json.dumps({"pb": {"versions": {}}})
+        self.assertEqual(self.fetch(ttl=60), {"pa": {"versions": {}}})
+        self.assertEqual(len(self.server.requests), 1)
+        
+        # expired, conditional request
+        self.age(120)
+        self.assertEqual(self.fetch(ttl=60), {"pb": {"versions": {}}})
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertTrue(self.server.validators[1])
+        
+        # unchanged, 304
+        self.age(120)
+        self.assertEqual(self.fetch(ttl=60), {"pb": {"versions": {}}})
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.server.validators[2], '"%s"' % hashlib.sha1(self.server.files["index.json"]).hexdigest())
+    
+    def test_force(self):
+        # within the TTL, unconditional
+        self.fetch(ttl=60)
+        self.server.files["index.json"] = json.dumps({"pb": {"versions": {}}})
+        self.assertEqual(self.fetch(ttl=60, force=True), {"pb": {"versions": {}}})
+        self.assertEqual(self.fetch(force=True), {"pb": {"versions": {}}})
+        self.assertEqual(self.server.validators, [None, None, None])
+    
+    def test_failed_refresh(self):
+        self.fetch()
+        del(self.server.files["index.json"])
+        self.assertEqual(self.fetch(force=True), {"pa": {"versions": {}}})
+        shutil.rmtree(self.outdir)
+        os.makedirs(self.outdir)
+        self.assertEqual(self.fetch(), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ecoenv
+
+
+class EnvVersionTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.envdir = os.path.join(self.tmpdir, "env")
+        os.mkdir(self.envdir)
+        self.snapshot_path = os.path.join(self.tmpdir, "snapshot")
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def write_env(self, name, env):
+        with open(os.path.join(self.envdir, name), "w") as f:
+            json.dump(env, f)
+    
+    def compile(self):
+        return ecoenv.compile_snapshot([self.envdir], self.snapshot_path)
+    
+    def test_no_version_field(self):
+        self.write_env("foo_1_2.env", {"tool": "foo",
+                                       "environment": {"FOO_VERSION": "@version",
+                                                       "FOO_MAJOR": "@version[0]"}})
+        snapshot = self.compile()
+        envpath = os.path.join(self.envdir, "foo_1_2.env")
+        self.assertEqual(ecoenv.get_tools(snapshot, "linux"), {"foo": {"1.2": envpath}})
+        self.assertEqual([x[2] for x in snapshot["index"]["foo"]], ["1.2"])
+        resolved = ecoenv.resolve_environment(snapshot, ["foo"], "linux")
+        self.assertEqual(resolved["tools"], [("foo", "1.2")])
+        self.assertEqual(resolved["env"]["FOO_VERSION"][1], "1.2")
+        self.assertEqual(resolved["env"]["FOO_MAJOR"][1], "1")
+    
+    def test_non_string_version(self):
+        self.write_env("bar_2_5.env", {"tool": "bar",
+                                       "version": 2.5,
+                                       "requires": ["foo1.2"],
+                                       "environment": {"BAR_VERSION": "@version"}})
+        self.write_env("foo_1_2.env", {"tool": "foo", "environment": {}})
+        snapshot = self.compile()
+        resolved = ecoenv.resolve_environment(snapshot, ["bar2.5"], "linux")
+        self.assertEqual(sorted(resolved["tools"]), [("bar", "2.5"), ("foo", "1.2")])
+        self.assertEqual(resolved["env"]["BAR_VERSION"][1], "2.5")
+    
+    def test_diagnostics_on_stderr(self):
+        # stdout of 'ecoenv.py -e' is evaluated by the calling shell
+        self.write_env("foo_1_2.env", {"tool": "foo", "environment": {}})
+        with open(os.path.join(self.envdir, "bar_1_0.env"), "w") as f:
+            f.write('{"tool": "bar", ')
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+        try:
+            ecoenv.compile_snapshot([self.envdir], self.snapshot_path, verbose=True)
+            out, err = sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        self.assertEqual(out, "")
+        self.assertIn("Failed to parse %s" % os.path.join(self.envdir, "bar_1_0.env"), err)
+
+
+class ParseLiteralTest(unittest.TestCase):
+    def test_legacy_version_component(self):
+        # Ecosystem compatible form, read as "@version[N]"
+        env = ecoenv.parse_literal("""{"tool": 'houdini',
+                                       "environment": {"MAJOR": eval('"@version".split(".")[0]'),
+                                                       "BUILD": eval( '"@version".split(".")[-1]' ),}}""")
+        self.assertEqual(env["environment"], {"MAJOR": "@version[0]", "BUILD": "@version[-1]"})
+    
+    def test_other_expressions(self):
+        self.assertRaises(ValueError, ecoenv.parse_literal, '{"A": eval("1 + 1")}')
+        self.assertRaises(ValueError, ecoenv.parse_literal, '{"A": "@version".split(".")[0]}')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,371 @@
+import os
+import re
+import sys
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import prepxtoa
+
+
+class TreeTestCase(unittest.TestCase):
+    # Temporary directory filled with write_file
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def write_file(self, path, content=""):
+        path = os.path.join(self.tmpdir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+
+class PrepTestCase(TreeTestCase):
+    # MtoA 2.0.1 trees for maya 2017 and 2018 with a shader shared by both
+    def setUp(self):
+        TreeTestCase.setUp(self)
+        for mayaver in ("2017", "2018"):
+            tree = "maya/MtoA/2.0.1/%s/linux" % mayaver
+            self.write_file(tree + "/bin/kick", "kick")
+            self.write_file(tree + "/bin/libmtoa.so", "mtoa")
+            self.write_file(tree + "/shaders/mtoa_shaders.so", "shaders")
+            self.write_file(tree + "/shaders/maya%s.so" % mayaver, mayaver)
+        self.shadersdir = os.path.join(self.tmpdir, "arnold", "MtoAShaders", "2.0.1", "linux", "shaders")
+    
+    def tree(self, mayaver):
+        return os.path.join(self.tmpdir, "maya", "MtoA", "2.0.1", mayaver, "linux")
+    
+    def specs(self, rules=None):
+        if rules is None:
+            rules = {"bin": [(re.compile(r"^kick$"), prepxtoa.Delete())],
+                     "shaders": [("*", prepxtoa.Copy("../../../../../arnold/MtoAShaders/%s/%s/shaders", ["mtoaver", "platform"]))]}
+        return [("/maya/MtoA/*", [("mtoaver", None), ("mayaver", re.compile(r"[\d.]+")), ("platform", re.compile(r"^linux$"))], rules, "MtoA")]
+    
+    def scan(self, stamps=None, rules=None):
+        return prepxtoa.Plan.scan(self.tmpdir, self.specs(rules), stamps=stamps)
+    
+    def apply(self, plan, **kwargs):
+        return prepxtoa.Executor(**kwargs).run(plan)
+    
+    def expected(self):
+        # listing once the trees are prepared
+        rv = {}
+        for mayaver in ("2017", "2018"):
+            tree = "maya/MtoA/2.0.1/%s/linux" % mayaver
+            rv[tree + "/bin/libmtoa.so"] = "mtoa"
+            rv[tree + "/_deleted/kick"] = "kick"
+            rv[tree + "/shaders/mtoa_shaders.so"] = "shaders"
+            rv[tree + "/shaders/maya%s.so" % mayaver] = mayaver
+            rv["arnold/MtoAShaders/2.0.1/linux/shaders/maya%s.so" % mayaver] = mayaver
+        rv["arnold/MtoAShaders/2.0.1/linux/shaders/mtoa_shaders.so"] = "shaders"
+        return rv
+    
+    def listing(self):
+        # every file below the temporary directory with its content
+        rv = {}
+        for dirpath, dirnames, filenames in os.walk(self.tmpdir):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                with open(path, "r") as f:
+                    rv[os.path.relpath(path, self.tmpdir)] = f.read()
+        return rv
+
+
+class StampDBTest(PrepTestCase):
+    def test_skip_prepared(self):
+        stamps = prepxtoa.StampDB(os.path.join(self.tmpdir, ".prepxtoa.stamps"))
+        stamps.load()
+        plan = self.scan(stamps)
+        self.assertEqual(len(plan.trees), 2)
+        self.assertEqual(self.apply(plan), set())
+        for tree in plan.trees:
+            stamps.update(tree["key"], tree["folder"], tree["rules"], tree["dirs"])
+        stamps.save()
+        
+        stamps = prepxtoa.StampDB(stamps.path)
+        stamps.load()
+        self.assertEqual(self.scan(stamps).trees, [])
+        
+        # new content in a rule folder
+        self.write_file("maya/MtoA/2.0.1/2018/linux/bin/kick", "kick")
+        os.utime(os.path.join(self.tree("2018"), "bin"), (1500000000, 1500000000))
+        self.assertEqual([x["folder"] for x in self.scan(stamps).trees], [self.tree("2018")])
+        
+        # modified rules
+        rules = {"bin": [(re.compile(r"^kick$"), prepxtoa.Delete())]}
+        self.assertEqual(len(self.scan(stamps, rules).trees), 2)
+    
+    def test_invalid_database(self):
+        path = self.write_file(".prepxtoa.stamps", "{")
+        stamps = prepxtoa.StampDB(path)
+        stamps.load()
+        self.assertEqual(stamps.trees, {})
+        self.assertEqual(len(self.scan(stamps).trees), 2)
+
+
+class ExecutorTest(PrepTestCase):
+    def test_plan(self):
+        plan = self.scan()
+        ops = [x["ops"] for x in plan.trees]
+        self.assertEqual(ops[0], [("move", self.tree("2017") + "/bin/kick", self.tree("2017") + "/_deleted"),
+                                  ("copy", self.tree("2017") + "/shaders/maya2017.so", self.shadersdir),
+                                  ("copy", self.tree("2017") + "/shaders/mtoa_shaders.so", self.shadersdir)])
+        # the shared shader is only copied from the first tree
+        self.assertEqual(ops[1], [("move", self.tree("2018") + "/bin/kick", self.tree("2018") + "/_deleted"),
+                                  ("copy", self.tree("2018") + "/shaders/maya2018.so", self.shadersdir)])
+    
+    def check_apply(self, jobs):
+        self.assertEqual(self.apply(self.scan(), jobs=jobs), set())
+        self.assertEqual(self.listing(), self.expected())
+        # nothing left to do
+        self.assertEqual(sum([len(x["ops"]) for x in self.scan().trees]), 0)
+    
+    def test_serial(self):
+        self.check_apply(1)
+    
+    def test_jobs(self):
+        self.check_apply(2)
+    
+    def test_dry_run(self):
+        before = self.listing()
+        self.assertEqual(self.apply(self.scan(), jobs=2, dryRun=True), set())
+        self.assertEqual(self.listing(), before)
+    
+    def test_failure(self):
+        # failed operations are reported per tree, the other trees complete
+        plan = self.scan()
+        os.remove(os.path.join(self.tree("2018"), "shaders", "maya2018.so"))
+        self.assertEqual(self.apply(plan, jobs=2), set([self.tree("2018")]))
+        self.assertTrue(os.path.isfile(os.path.join(self.shadersdir, "maya2017.so")))
+        self.assertTrue(os.path.isfile(os.path.join(self.tree("2018"), "_deleted", "kick")))
+
+
+class StoreTest(PrepTestCase):
+    def setUp(self):
+        PrepTestCase.setUp(self)
+        # same content under another name
+        self.write_file("maya/MtoA/2.0.1/2018/linux/shaders/copy_shaders.so", "shaders")
+        self.storedir = os.path.join(self.tmpdir, "_store")
+    
+    def test_hardlink(self):
+        store = prepxtoa.Store(self.storedir)
+        self.assertEqual(self.apply(self.scan(), jobs=2, store=store), set())
+        a = os.path.join(self.shadersdir, "mtoa_shaders.so")
+        b = os.path.join(self.shadersdir, "copy_shaders.so")
+        self.assertEqual(os.stat(a).st_ino, os.stat(b).st_ino)
+        self.assertEqual(os.stat(a).st_nlink, 3)
+        # sources are copied to the store, not linked
+        src = os.path.join(self.tree("2017"), "shaders", "mtoa_shaders.so")
+        self.assertNotEqual(os.stat(src).st_ino, os.stat(a).st_ino)
+        with open(src, "a") as f:
+            f.write("modified")
+        with open(a, "r") as f:
+            self.assertEqual(f.read(), "shaders")
+        
+        u = prepxtoa.Store.usage([self.shadersdir])
+        self.assertEqual(u, {"files": 4, "bytes": 2 * len("shaders") + 8, "disk": len("shaders") + 8, "unique": len("shaders") + 8})
+    
+    def test_symlink(self):
+        store = prepxtoa.Store(self.storedir, mode=prepxtoa.Store.SymLink)
+        self.assertEqual(self.apply(self.scan(), store=store), set())
+        path = os.path.join(self.shadersdir, "mtoa_shaders.so")
+        self.assertTrue(os.path.islink(path))
+        self.assertFalse(os.path.isabs(os.readlink(path)))
+        self.assertEqual(os.path.realpath(path), os.path.realpath(os.path.join(self.shadersdir, "copy_shaders.so")))
+        self.assertTrue(os.path.realpath(path).startswith(os.path.realpath(self.storedir) + os.sep))
+    
+    def test_copytree(self):
+        self.write_file("maya/MtoA/2.0.1/2017/linux/shaders/sub/a.txt", "shaders")
+        os.symlink("a.txt", os.path.join(self.tree("2017"), "shaders", "sub", "b.txt"))
+        store = prepxtoa.Store(self.storedir)
+        self.assertEqual(self.apply(self.scan(), store=store), set())
+        sub = os.path.join(self.shadersdir, "sub")
+        self.assertEqual(os.stat(sub + "/a.txt").st_ino, os.stat(os.path.join(self.shadersdir, "mtoa_shaders.so")).st_ino)
+        self.assertEqual(os.readlink(sub + "/b.txt"), "a.txt")
+    
+    def test_report(self):
+        shutil.copy(prepxtoa.__file__.replace(".pyc", ".py"), self.tmpdir)
+        store = prepxtoa.Store(self.storedir)
+        self.assertEqual(self.apply(self.scan(), store=store), set())
+        p = subprocess.Popen([sys.executable, os.path.join(self.tmpdir, "prepxtoa.py"), "--report"], stdout=subprocess.PIPE)
+        out = p.communicate()[0]
+        self.assertEqual(p.returncode, 0)
+        self.assertEqual(out.splitlines(), ["4 file(s), 22 byte(s)",
+                                            "15 byte(s) on disk, 7 byte(s) saved by links",
+                                            "15 byte(s) of distinct content, 0 byte(s) still duplicated"])
+
+
+class JournalTest(PrepTestCase):
+    def setUp(self):
+        PrepTestCase.setUp(self)
+        self.journal = prepxtoa.Journal(os.path.join(self.tmpdir, ".prepxtoa.journal"))
+        # staticmethod object, restored as is
+        self.apply_copy = prepxtoa.Copy.__dict__["apply"]
+    
+    def tearDown(self):
+        prepxtoa.Copy.apply = self.apply_copy
+        PrepTestCase.tearDown(self)
+    
+    def interrupt(self, count):
+        # run the plan and interrupt it on copy number count + 1, leaving a
+        # partial copy behind
+        copies = []
+        apply_copy = prepxtoa.Copy.apply
+        def interrupted_copy(src, dst, **kwargs):
+            copies.append(src)
+            if len(copies) > count:
+                with open(dst + "/" + os.path.basename(src), "w") as f:
+                    f.write("partial")
+                raise KeyboardInterrupt()
+            return apply_copy(src, dst, **kwargs)
+        prepxtoa.Copy.apply = staticmethod(interrupted_copy)
+        plan = self.scan()
+        self.journal.start(plan)
+        try:
+            self.assertRaises(KeyboardInterrupt, prepxtoa.Executor().run, plan, journal=self.journal)
+        finally:
+            self.journal.close()
+            prepxtoa.Copy.apply = self.apply_copy
+        self.assertTrue(self.journal.exists())
+    
+    def test_plan_file(self):
+        path = os.path.join(self.tmpdir, "plan.json")
+        plan = self.scan()
+        plan.save(path)
+        loaded = prepxtoa.Plan.load(path)
+        self.assertEqual(loaded.trees, plan.trees)
+        self.assertEqual(self.apply(loaded), set())
+        self.assertEqual(self.listing(), dict(self.expected(), **{"plan.json": open(path).read()}))
+    
+    def test_rollback(self):
+        before = self.listing()
+        self.interrupt(1)
+        plan, entries = self.journal.read()
+        self.assertTrue(prepxtoa.Executor().undo(plan, entries))
+        self.journal.remove()
+        self.assertEqual(self.listing(), before)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "arnold")))
+    
+    def test_resume(self):
+        self.interrupt(2)
+        plan, entries = self.journal.read()
+        done = set([tuple(x["done"]) for x in entries if "done" in x])
+        self.assertEqual(len(done), 4)
+        executor = prepxtoa.Executor()
+        executor.undo(plan, [x for x in entries if "begin" in x and not tuple(x["begin"]) in done])
+        self.journal.reopen()
+        self.assertEqual(executor.run(plan, journal=self.journal, done=done), set())
+        self.journal.remove()
+        self.assertEqual(self.listing(), self.expected())
+    
+    def test_command_line(self):
+        shutil.copy(prepxtoa.__file__.replace(".pyc", ".py"), self.tmpdir)
+        def run_script(*args):
+            p = subprocess.Popen([sys.executable, os.path.join(self.tmpdir, "prepxtoa.py")] + list(args), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            return (p.communicate()[0], p.returncode)
+        self.assertEqual(run_script("--resume"), ("No interrupted run\n", 0))
+        self.interrupt(1)
+        out, rv = run_script()
+        self.assertEqual(rv, 1)
+        self.assertIn("Previous run was interrupted", out)
+        self.assertEqual(run_script("--resume"), ("", 0))
+        self.assertFalse(self.journal.exists())
+        listing = self.listing()
+        del(listing["prepxtoa.py"])
+        del(listing[".prepxtoa.stamps"])
+        self.assertEqual(listing, self.expected())
+
+
+class SnapshotTest(PrepTestCase):
+    def test_glob(self):
+        self.write_file("maya/MtoA/2.0.1/2017/linux/bin/.hidden")
+        snapshot = prepxtoa.Snapshot()
+        bindir = os.path.join(self.tree("2017"), "bin")
+        self.assertEqual(snapshot.glob(bindir, "*"), [bindir + "/kick", bindir + "/libmtoa.so"])
+        self.assertEqual(snapshot.glob(bindir, ".*"), [bindir + "/.hidden"])
+        self.assertEqual(snapshot.glob(self.tree("2017"), "*/kick"), [bindir + "/kick"])
+        self.assertEqual(snapshot.glob(bindir, "missing"), [])
+        self.assertTrue(snapshot.isfile(bindir + "/kick"))
+        self.assertFalse(snapshot.isfile(bindir))
+        self.assertTrue(snapshot.isdir(bindir))
+        self.assertFalse(snapshot.exists(bindir + "/missing"))
+    
+    def test_listed_once(self):
+        listed = []
+        listdir = os.listdir
+        def counted_listdir(path):
+            listed.append(os.path.normpath(path))
+            return listdir(path)
+        os.listdir = counted_listdir
+        try:
+            self.scan()
+        finally:
+            os.listdir = listdir
+        self.assertEqual(len(listed), len(set(listed)))
+
+
+class ConditionTest(TreeTestCase):
+    def test_snapshot(self):
+        # results are reused for a snapshot only
+        os.makedirs(os.path.join(self.tmpdir, "bin"))
+        cond = prepxtoa.FileExists("libai.so", subdir="bin")
+        snapshot = prepxtoa.Snapshot()
+        self.assertFalse(cond.isTrue(self.tmpdir, snapshot))
+        self.write_file("bin/libai.so")
+        self.assertFalse(cond.isTrue(self.tmpdir, snapshot))
+        self.assertTrue(cond.isTrue(self.tmpdir, prepxtoa.Snapshot()))
+        os.remove(os.path.join(self.tmpdir, "bin", "libai.so"))
+        self.assertFalse(cond.isTrue(self.tmpdir))
+    
+    def test_combined(self):
+        self.write_file("bin/libOpenColorIO.so")
+        cond = prepxtoa.And(prepxtoa.FileExists(r"^.*OpenColorIO.*\.so$", prepxtoa.FileExists.RE_PATTERN, subdir="bin"),
+                            prepxtoa.FileExists("bin/*synColor*", prepxtoa.FileExists.GLOB_PATTERN))
+        self.assertFalse(cond.isTrue(self.tmpdir, prepxtoa.Snapshot()))
+        self.write_file("bin/libsynColor.so")
+        self.assertTrue(cond.isTrue(self.tmpdir, prepxtoa.Snapshot()))
+
+
+class CommandLineTest(TreeTestCase):
+    # prepxtoa.py run from a temporary deploy tree
+    def setUp(self):
+        TreeTestCase.setUp(self)
+        shutil.copy(prepxtoa.__file__.replace(".pyc", ".py"), self.tmpdir)
+    
+    def run_script(self, *args):
+        # (exit code, output)
+        p = subprocess.Popen([sys.executable, os.path.join(self.tmpdir, "prepxtoa.py")] + list(args), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        out = p.communicate()[0]
+        return (p.returncode, out)
+    
+    def test_invalid(self):
+        for args, msg in [(["-j"], "Missing required argument for -j"),
+                          (["-j", "two"], "Invalid number of jobs 'two'"),
+                          (["--jobs", "0"], "Invalid number of jobs '0'"),
+                          (["-l", "copy"], "Invalid link mode 'copy'"),
+                          (["-dr", "--link"], "Missing required argument for --link"),
+                          (["--store"], "Missing required argument for --store"),
+                          (["--full", "3"], "Invalid argument '3'"),
+                          (["--dryrun"], "Invalid argument '--dryrun'"),
+                          (["--resume", "--rollback"], "cannot be used together"),
+                          (["--apply", os.path.join(self.tmpdir, "missing.json")], "Could not load plan")]:
+            rv, out = self.run_script(*args)
+            self.assertEqual(rv, 1, args)
+            self.assertIn(msg, out)
+            self.assertNotIn("Traceback", out)
+    
+    def test_valid(self):
+        rv, out = self.run_script("-dr", "-f", "-j", "2", "-l", "symlink", "--store", os.path.join(self.tmpdir, "store"))
+        self.assertEqual(rv, 0, out)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ecoenv
+import dropboxpm
+from versions import version_key
+
+
+class VersionKeyTest(unittest.TestCase):
+    def test_order(self):
+        # non numeric suffixes sort before numbers at the same position
+        ordered = ["1.9", "2", "2.devel", "2.0", "2.0b1", "2.0b2", "2.0.1", "2.1", "2.1b1", "10.0"]
+        self.assertEqual(sorted(reversed(ordered), key=version_key), ordered)
+    
+    def test_separators(self):
+        self.assertEqual(version_key("2.0-devel"), version_key("2.0.devel"))
+        self.assertEqual(version_key("2016_5"), version_key("2016.5"))
+    
+    def test_shared(self):
+        self.assertTrue(ecoenv.version_key is version_key)
+        self.assertTrue(dropboxpm.version_key is version_key)
+    
+    def test_matches(self):
+        # ecoenv 'X' specs and find_versions agree
+        entries = sorted([(version_key(x), 0, x) for x in ("2", "2.0", "2.0b1", "2.0.1", "2.1", "20")])
+        for spec in ("2", "2.0", "2.0b1", "2.1", "2+", "2.0.1+"):
+            lo, hi = ecoenv.find_versions(entries, [spec])
+            self.assertEqual([x[2] for x in entries[lo:hi]], [x[2] for x in entries if ecoenv.version_matches(x[2], spec)], spec)
+        self.assertTrue(dropboxpm.version_matches("2.0b1", dropboxpm.parse_version_spec("2.0+,<2.0.1")))
+
+
+if __name__ == "__main__":
+    unittest.main()
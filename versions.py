@@ -0,0 +1,24 @@
+import re
+
+
+# Version ordering shared by dropboxpm.py and ecoenv.py
+# Versions are split into numeric and non numeric parts, '.', '_' and '-'
+# only separate them:
+#   "4.2.16.0" -> ((1, 4), (1, 2), (1, 16), (1, 0))
+#   "2.0b1"    -> ((1, 2), (1, 0), (0, 'b'), (1, 1))
+# Numeric parts compare as numbers, non numeric ones (i.e. 'devel', 'b')
+# as strings and before numeric ones at the same position, a version sorts
+# before the longer ones it is a prefix of:
+#   2.devel < 2.0 < 2.0b1 < 2.0.1 < 2.1 < 2.1b1 < 10.0
+# (2,) sorts after any part, key + ((2,),) bounds the keys starting with key
+
+version_part_exp = re.compile(r"\d+|[^\d._-]+")
+
+def version_key(version):
+    key = []
+    for part in version_part_exp.findall(version):
+        if part.isdigit():
+            key.append((1, int(part)))
+        else:
+            key.append((0, part))
+    return tuple(key)